@@ -0,0 +1,290 @@
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.documents import Document
+from collections import defaultdict
+from typing import List, Optional
+import numpy as np
+import threading
+import asyncio
+import hashlib
+import time
+import re
+
+class FakeChatModel:
+    """
+    Deterministic stand-in for AzureChatOpenAI.
+
+    invoke / ainvoke / astream sleep for `latency` seconds and answer with text derived
+    from the prompt, so runs are repeatable and cost nothing. The answer is the prompt
+    itself, which keeps restructured table pages about as long as with the real model.
+    """
+
+    def __init__(self, latency: float = 0.05, stream_chunks: int = 20):
+        self.latency = latency
+        self.stream_chunks = stream_chunks
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _answer(self, prompt) -> str:
+        with self._lock:
+            self.calls += 1
+        return str(prompt)
+
+    def invoke(self, prompt, **kwargs) -> AIMessage:
+        time.sleep(self.latency)
+        return AIMessage(content=self._answer(prompt))
+
+    async def ainvoke(self, prompt, **kwargs) -> AIMessage:
+        await asyncio.sleep(self.latency)
+        return AIMessage(content=self._answer(prompt))
+
+    async def astream(self, prompt, **kwargs):
+        answer = self._answer(prompt)
+        size = max(1, len(answer) // self.stream_chunks)
+        for start in range(0, len(answer), size):
+            await asyncio.sleep(self.latency / self.stream_chunks)
+            yield AIMessageChunk(content=answer[start:start + size])
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic stand-in for AzureOpenAIEmbeddings: the vector of a text is a unit
+    vector seeded by its SHA-256, so identical texts always get identical vectors.
+    Every request sleeps `latency` seconds plus `latency_per_input` per input text.
+    """
+
+    embedding_ctx_length = 8191
+
+    def __init__(self, dimensions: int = 1536, latency: float = 0.02, latency_per_input: float = 0.0005):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.latency_per_input = latency_per_input
+        self.requests = 0
+        self.inputs = 0
+        self._lock = threading.Lock()
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def _count(self, inputs: int) -> float:
+        with self._lock:
+            self.requests += 1
+            self.inputs += inputs
+        return self.latency + self.latency_per_input * inputs
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self._count(len(texts)))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self._count(1))
+        return self._vector(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await asyncio.sleep(self._count(len(texts)))
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await asyncio.sleep(self._count(1))
+        return self._vector(text)
+
+
+class InMemoryVectorStore:
+    """
+    Stand-in for SherlockPGVector with the methods used by ingestion and retrieval.
+
+    Search is exact cosine similarity over a NumPy matrix; metadata filters are
+    equality on every key. hybrid_search_with_scores fuses the vector ranking with a
+    term-overlap ranking by reciprocal rank, like the SQL hybrid retriever. The
+    *_with_embeddings searches also return the query and stored embeddings.
+    """
+
+    def __init__(self, embedding_function: Embeddings, collection_name: str, rrf_k: int = 60):
+        self.embedding_function = embedding_function
+        self.collection_name = collection_name
+        self.rrf_k = rrf_k
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._embeddings = {}
+        self._matrix = None
+        self._ids = []
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None, **kwargs):
+        metadatas = metadatas or [{} for _ in texts]
+        with self._lock:
+            for text, embedding, metadata, id_ in zip(texts, embeddings, metadatas, ids):
+                self._rows[id_] = Document(id=id_, page_content=text, metadata=dict(metadata))
+                self._embeddings[id_] = np.asarray(embedding, dtype=np.float32)
+            self._matrix = None
+        return ids
+
+    def _index(self):
+        with self._lock:
+            if self._matrix is None:
+                self._ids = list(self._rows)
+                self._matrix = (np.stack([self._embeddings[id_] for id_ in self._ids])
+                                if self._ids else np.zeros((0, 0), dtype=np.float32))
+            return self._ids, self._matrix
+
+    @staticmethod
+    def _matches(metadata: dict, filter: Optional[dict]) -> bool:
+        return not filter or all(metadata.get(key) == value for key, value in filter.items())
+
+    def _vector_ranking(self, embedding, k, filter):
+        ids, matrix = self._index()
+        if not ids:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = matrix @ (query / np.linalg.norm(query))
+        ranked = []
+        for ix in np.argsort(-scores):
+            doc = self._rows[ids[ix]]
+            if self._matches(doc.metadata, filter):
+                ranked.append((doc, float(scores[ix])))
+                if len(ranked) == k:
+                    break
+        return ranked
+
+    def similarity_search_with_relevance_scores(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs):
+        return self._vector_ranking(self.embedding_function.embed_query(query), k, filter)
+
+    async def asimilarity_search_with_relevance_scores(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs):
+        return self._vector_ranking(await self.embedding_function.aembed_query(query), k, filter)
+
+    def _with_embeddings(self, embedding, hits):
+        return embedding, [(doc, score, self._embeddings[doc.id]) for doc, score in hits]
+
+    def similarity_search_with_embeddings(self, query: str, k: int = 4, filter: Optional[dict] = None):
+        embedding = self.embedding_function.embed_query(query)
+        return self._with_embeddings(embedding, self._vector_ranking(embedding, k, filter))
+
+    async def asimilarity_search_with_embeddings(self, query: str, k: int = 4, filter: Optional[dict] = None):
+        embedding = await self.embedding_function.aembed_query(query)
+        return self._with_embeddings(embedding, self._vector_ranking(embedding, k, filter))
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_relevance_scores(query, k=k, filter=filter)]
+
+    def _hybrid(self, query, embedding, k, filter, candidates=50):
+        vector_ranked = self._vector_ranking(embedding, candidates, filter)
+        terms = set(re.findall(r"\w+", query.lower()))
+        lexical = []
+        for doc in self._rows.values():
+            if self._matches(doc.metadata, filter):
+                overlap = len(terms & set(re.findall(r"\w+", doc.page_content.lower())))
+                if overlap:
+                    lexical.append((overlap, doc))
+        lexical.sort(key=lambda pair: -pair[0])
+
+        fused = defaultdict(float)
+        docs = {}
+        for rank, (doc, _) in enumerate(vector_ranked, start=1):
+            fused[doc.id] += 1.0 / (self.rrf_k + rank)
+            docs[doc.id] = doc
+        for rank, (_, doc) in enumerate(lexical[:candidates], start=1):
+            fused[doc.id] += 1.0 / (self.rrf_k + rank)
+            docs.setdefault(doc.id, doc)
+        best = sorted(fused.items(), key=lambda pair: -pair[1])[:k]
+        return [(docs[id_], score) for id_, score in best]
+
+    def hybrid_search_with_scores(self, query: str, k: int = 15, filter: Optional[dict] = None):
+        return self._hybrid(query, self.embedding_function.embed_query(query), k, filter)
+
+    async def ahybrid_search_with_scores(self, query: str, k: int = 15, filter: Optional[dict] = None):
+        return self._hybrid(query, await self.embedding_function.aembed_query(query), k, filter)
+
+    def hybrid_search_with_embeddings(self, query: str, k: int = 15, filter: Optional[dict] = None):
+        embedding = self.embedding_function.embed_query(query)
+        return self._with_embeddings(embedding, self._hybrid(query, embedding, k, filter))
+
+    async def ahybrid_search_with_embeddings(self, query: str, k: int = 15, filter: Optional[dict] = None):
+        embedding = await self.embedding_function.aembed_query(query)
+        return self._with_embeddings(embedding, self._hybrid(query, embedding, k, filter))
+
+    def get_by_metadata(self, key: str, values: List[str], filter: Optional[dict] = None) -> List[Document]:
+        values = set(values)
+        return [doc for doc in list(self._rows.values())
+                if doc.metadata.get(key) in values and self._matches(doc.metadata, filter)]
+
+    async def aget_by_metadata(self, key: str, values: List[str], filter: Optional[dict] = None) -> List[Document]:
+        return self.get_by_metadata(key, values, filter)
+
+
+class LocalCorpusVersions:
+    """Stand-in for CorpusVersions that keeps the answer cache versions in memory."""
+
+    def __init__(self):
+        self._versions = {}
+
+    def ensure_table(self):
+        pass
+
+    def get(self, user_id: str, doc_type: str) -> int:
+        return self._versions.get((user_id, doc_type), 0)
+
+    def bump(self, user_id: str, doc_type: str) -> int:
+        self._versions[(user_id, doc_type)] = self.get(user_id, doc_type) + 1
+        return self._versions[(user_id, doc_type)]
+
+
+class FakeEncoding:
+    """
+    Offline stand-in for a tiktoken encoding: one token per word or punctuation mark (with
+    its leading whitespace), which is close to BPE counts on English prose. Token ids are
+    assigned on first sight, so decode(encode(text)) == text.
+    """
+
+    _pieces = re.compile(r"\s*\w+|\s*[^\w\s]|\s+")
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._vocabulary = []
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        tokens = []
+        with self._lock:
+            for piece in self._pieces.findall(text):
+                token = self._ids.get(piece)
+                if token is None:
+                    token = self._ids[piece] = len(self._vocabulary)
+                    self._vocabulary.append(piece)
+                tokens.append(token)
+        return tokens
+
+    def decode(self, tokens: List[int], **kwargs) -> str:
+        return "".join(self._vocabulary[token] for token in tokens)
+
+
+def install_fake_encodings(names=("cl100k_base", "o200k_base")) -> None:
+    """Serve the named tiktoken encodings from FakeEncoding, so nothing is downloaded."""
+    import tiktoken.registry
+    with tiktoken.registry._lock:
+        for name in names:
+            tiktoken.registry.ENCODINGS[name] = FakeEncoding(name)
+
+
+class DiscardingHistoryWriter:
+    """Stand-in for ChatHistoryWriter that counts records instead of writing them to Postgres."""
+
+    def __init__(self):
+        self.enqueued = 0
+
+    def enqueue(self, *record, **kwargs) -> bool:
+        self.enqueued += 1
+        return True
+
+    def flush(self):
+        return True
+
+    def stop(self, timeout=10):
+        pass
+
+    def stats(self) -> dict:
+        return {"queue_depth": 0, "enqueued": self.enqueued}
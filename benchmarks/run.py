@@ -0,0 +1,438 @@
+"""
+Offline benchmarks of the ingestion and query paths.
+
+The Azure models are replaced by deterministic fakes with configurable latency
+(benchmarks/fakes.py) and the vector stores by an in-memory stand-in, or by
+separate bench_* collections in a local Postgres+pgvector (--store pgvector,
+uses DATABASE_URL). Chat history writes are discarded and the answer cache
+corpus versions are kept in memory. Inputs are synthetic PDFs
+with a mix of prose and table-heavy pages (benchmarks/synthetic_pdf.py).
+
+The tiktoken encodings (cl100k_base for embedding inputs, o200k_base for context
+packing) are replaced by a local word-level stand-in, so no BPE file is downloaded.
+Pass --real-tokenizer to use tiktoken's; without network access, point
+TIKTOKEN_CACHE_DIR at a directory holding the downloaded BPE files.
+
+    python -m benchmarks.run all --pages 100 --concurrency 1 2 4 8
+    python -m benchmarks.run ingest --pages 200 --llm-latency 0.5
+    python -m benchmarks.run query --queries 200 --concurrency 1 8 32 --path async
+    python -m benchmarks.run compare benchmarks/results/a.json benchmarks/results/b.json
+
+Each run writes a JSON file to benchmarks/results/ with per-stage latency
+(calls, mean, p50, p99), pages/sec, queries/sec and p50/p99 per concurrency
+level, and memory (peak traced allocations per run, and peak RSS).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+import contextlib
+import subprocess
+import tracemalloc
+import functools
+import inspect
+import threading
+import argparse
+import platform
+import resource
+import tempfile
+import asyncio
+import random
+import json
+import time
+import uuid
+import sys
+import io
+import os
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+DOC_TYPE = "benchmark"
+USER_ID = "benchmark-user"
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def latency_summary(samples) -> dict:
+    return {
+        "calls": len(samples),
+        "total_s": round(sum(samples), 4),
+        "mean_ms": round(1000 * sum(samples) / len(samples), 3) if samples else None,
+        "p50_ms": round(1000 * percentile(samples, 50), 3) if samples else None,
+        "p99_ms": round(1000 * percentile(samples, 99), 3) if samples else None,
+    }
+
+
+class StageTimer:
+    """Collects call durations per stage by wrapping methods of the objects under test."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def wrap(self, obj, name, stage):
+        """Replace obj.name with a timed version (sync, async or generator)."""
+        original = getattr(obj, name)
+
+        if asyncio.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - started)
+        elif inspect.isgeneratorfunction(original):
+            @functools.wraps(original)
+            def timed(*args, **kwargs):
+                # Time spent producing each item, not time the consumer holds it
+                iterator = iter(original(*args, **kwargs))
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    self.record(stage, time.perf_counter() - started)
+                    yield item
+        else:
+            @functools.wraps(original)
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - started)
+
+        setattr(obj, name, timed)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {stage: latency_summary(samples) for stage, samples in sorted(self.samples.items())}
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    # The pipeline prints per page and per rephrase; keep benchmark output readable
+    if verbose:
+        yield
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+
+
+class Benchmark:
+    """
+    Sets up the fakes in the shared registry and runs the ingestion and query benchmarks.
+    Service modules are imported here, after the cache directories have been pointed
+    at a scratch directory, so benchmark runs never touch the real caches.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="sherlock-bench-")
+        os.environ["CONTENT_CACHE_DIR"] = os.path.join(self.workdir, "content_cache")
+        os.environ.pop("EMBED_CACHE_DIR", None)
+
+        from benchmarks.fakes import (FakeChatModel, FakeEmbeddings, DiscardingHistoryWriter, LocalCorpusVersions,
+                                      install_fake_encodings)
+        if not args.real_tokenizer:
+            install_fake_encodings()
+        from services.answer_cache import answer_cache
+        from services.embedding_cache import CachedEmbeddings, query_embedding_cache
+        from services.registry import registry
+        from services import pipline_run
+
+        self.registry = registry
+        self.llm = FakeChatModel(latency=args.llm_latency)
+        self.raw_embed = FakeEmbeddings(dimensions=args.dimensions, latency=args.embed_latency,
+                                        latency_per_input=args.embed_latency_per_input)
+        # Wrapped like the Azure embeddings in Call_Models, so the query embedding cache is exercised
+        self.embed = CachedEmbeddings(self.raw_embed, query_embedding_cache, model_name="fake-embedding")
+        registry.override(llm=self.llm, embed=self.embed)
+        pipline_run.chat_history_obj.writer = DiscardingHistoryWriter()
+        answer_cache.versions = LocalCorpusVersions()
+
+    def make_stores(self, run_name):
+        if self.args.store == "pgvector":
+            from services.vectorDB import PGVectorDB
+            vector_db = PGVectorDB(self.embed)
+            stores = {name: vector_db.call_vectorDB(f"bench_{run_name}_{name}") for name in ("parent_embedding", "child_embedding")}
+            async_stores = {name: vector_db.call_vectorDB(f"bench_{run_name}_{name}", async_mode=True) for name in stores}
+        else:
+            from benchmarks.fakes import InMemoryVectorStore
+            stores = {name: InMemoryVectorStore(self.embed, name) for name in ("parent_embedding", "child_embedding")}
+            async_stores = stores
+
+        self.registry.override(stores={
+            **{(name, False): store for name, store in stores.items()},
+            **{(name, True): store for name, store in async_stores.items()},
+        })
+        return stores
+
+    def drop_stores(self, stores):
+        if self.args.store == "pgvector":
+            for store in stores.values():
+                store.delete_collection()
+
+    def make_pdf(self, seed):
+        from benchmarks.synthetic_pdf import write_pdf
+        path = os.path.join(self.workdir, f"synthetic_{seed}.pdf")
+        info = write_pdf(path, pages=self.args.pages, table_ratio=self.args.table_ratio, seed=seed)
+        return path, info
+
+    def ingest(self, pdf_path, concurrency, stores):
+        """Run PDF_reader.create_embeddings once and return throughput, stage latencies and memory."""
+        from services import pdf_preprocessing
+
+        pdf_preprocessing.TABLE_CONCURRENCY = concurrency
+        pdf_preprocessing.EMBED_CONCURRENCY = concurrency
+        pdf_preprocessing.PAGE_WINDOW = self.args.page_window
+
+        timer = StageTimer()
+        reader = pdf_preprocessing.PDF_reader(DOC_TYPE, user_id=USER_ID)
+        timer.wrap(reader, "iter_pages", "extract")
+        timer.wrap(reader, "table_identification", "restructure")
+        timer.wrap(reader, "table_processing", "restructure_llm")
+        timer.wrap(reader, "create_child_docs", "split")
+        timer.wrap(reader, "embed_texts", "embed")
+        for name, store in stores.items():
+            timer.wrap(store, "add_embeddings", f"write_{name}")
+
+        requests_before = self.raw_embed.requests
+        tracemalloc.start()
+        started = time.perf_counter()
+        with quiet(self.args.verbose):
+            reader.create_embeddings(pdf_path, file_id=str(uuid.uuid4()))
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            "concurrency": concurrency,
+            "page_window": self.args.page_window,
+            "pages": reader.total_pages,
+            "seconds": round(elapsed, 4),
+            "pages_per_second": round(reader.total_pages / elapsed, 3),
+            "embedding_requests": self.raw_embed.requests - requests_before,
+            "peak_traced_mb": round(peak / 2 ** 20, 2),
+            "stages": timer.summary(),
+            "cache": reader.cache_summary(),
+        }
+
+    def run_ingestion(self) -> dict:
+        """One cold run per concurrency level (fresh PDF, empty caches), then a warm re-run of the last PDF."""
+        results = {"runs": []}
+        pdf_path, info = None, None
+        for level, concurrency in enumerate(self.args.concurrency):
+            pdf_path, info = self.make_pdf(seed=self.args.seed + level)
+            stores = self.make_stores(f"ingest_{level}")
+            run = self.ingest(pdf_path, concurrency, stores)
+            self.drop_stores(stores)
+            results["runs"].append(run)
+            print(f"ingest  concurrency={concurrency:<3} {run['pages_per_second']:>8} pages/s  "
+                  f"peak {run['peak_traced_mb']} MB")
+
+        stores = self.make_stores("ingest_warm")
+        results["warm_rerun"] = self.ingest(pdf_path, self.args.concurrency[-1], stores)
+        self.drop_stores(stores)
+        print(f"ingest  warm re-run      {results['warm_rerun']['pages_per_second']:>8} pages/s")
+        results["pdf"] = info
+        return results
+
+    def questions(self, count, batch):
+        # A different batch per run, so query embeddings cached by an earlier run are not reused
+        from benchmarks.synthetic_pdf import WORDS
+        rng = random.Random(f"{self.args.seed}-{batch}")
+        return [f"What is the {' '.join(rng.sample(WORDS, 3))} for {rng.choice(WORDS)} {ix}?" for ix in range(count)]
+
+    def run_query_level(self, inference, questions, concurrency, path) -> dict:
+        from services.pipline_run import chat_history_obj
+
+        timer = StageTimer()
+        for name in ("conversation_rephrase", "aconversation_rephrase"):
+            timer.wrap(inference, name, "rephrase")
+        for name in ("get_docs_v2", "aget_docs_v2"):
+            timer.wrap(inference, name, "retrieve")
+        timer.wrap(self.llm, "invoke", "llm")
+        timer.wrap(self.llm, "ainvoke", "llm")
+        timer.wrap(self.raw_embed, "embed_query", "embed_query")
+        timer.wrap(self.raw_embed, "aembed_query", "embed_query")
+
+        # Each session asks `turns` questions, so follow-ups go through rephrasing
+        turns = self.args.turns
+        sessions = [questions[ix:ix + turns] for ix in range(0, len(questions), turns)]
+        latencies = []
+
+        def run_session_sync(session_questions):
+            session_id = chat_history_obj.start_session(user_id=USER_ID)
+            for question in session_questions:
+                started = time.perf_counter()
+                inference.get_answer(question, DOC_TYPE, USER_ID, session_id=session_id)
+                latencies.append(time.perf_counter() - started)
+
+        async def run_sessions_async():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def run_session(session_questions):
+                async with semaphore:
+                    session_id = chat_history_obj.start_session(user_id=USER_ID)
+                    for question in session_questions:
+                        started = time.perf_counter()
+                        await inference.aget_answer(question, DOC_TYPE, USER_ID, session_id=session_id)
+                        latencies.append(time.perf_counter() - started)
+
+            await asyncio.gather(*(run_session(session_questions) for session_questions in sessions))
+
+        started = time.perf_counter()
+        with quiet(self.args.verbose):
+            if path == "sync":
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    list(executor.map(run_session_sync, sessions))
+            else:
+                asyncio.run(run_sessions_async())
+        elapsed = time.perf_counter() - started
+
+        for name in ("conversation_rephrase", "aconversation_rephrase", "get_docs_v2", "aget_docs_v2"):
+            delattr(inference, name)
+        for name in ("invoke", "ainvoke"):
+            delattr(self.llm, name)
+        for name in ("embed_query", "aembed_query"):
+            delattr(self.raw_embed, name)
+
+        return {
+            "path": path,
+            "concurrency": concurrency,
+            "queries": len(latencies),
+            "seconds": round(elapsed, 4),
+            "queries_per_second": round(len(latencies) / elapsed, 3),
+            "latency": latency_summary(latencies),
+            "stages": timer.summary(),
+        }
+
+    def run_queries(self) -> dict:
+        """Ingest one synthetic corpus, then run the query path at every concurrency level."""
+        from services.answer_cache import answer_cache
+        from services.pipline_run import RUN_Inference
+
+        pdf_path, info = self.make_pdf(seed=self.args.seed + 1000)
+        stores = self.make_stores("query")
+        self.ingest(pdf_path, max(self.args.concurrency), stores)
+
+        # Distinct questions, so the answer cache only matters when explicitly enabled
+        if not self.args.answer_cache:
+            answer_cache.threshold = float("inf")
+
+        inference = RUN_Inference()
+        results = {"corpus": info, "answer_cache": self.args.answer_cache, "runs": []}
+        for path in (["sync", "async"] if self.args.path == "both" else [self.args.path]):
+            for concurrency in self.args.concurrency:
+                questions = self.questions(self.args.queries, batch=f"{path}-{concurrency}")
+                run = self.run_query_level(inference, questions, concurrency, path)
+                results["runs"].append(run)
+                print(f"query   {path:<5} concurrency={concurrency:<3} {run['queries_per_second']:>8} q/s  "
+                      f"p50 {run['latency']['p50_ms']} ms  p99 {run['latency']['p99_ms']} ms")
+
+        self.drop_stores(stores)
+        results["answer_cache_stats"] = answer_cache.stats()
+        return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, output=None):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{results['command']}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+
+def compare(baseline_path, candidate_path):
+    """Print throughput and latency of two result files side by side."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+
+    def rows(results):
+        for run in results.get("ingestion", {}).get("runs", []):
+            yield f"ingest concurrency={run['concurrency']} pages/s", run["pages_per_second"]
+        for run in results.get("query", {}).get("runs", []):
+            key = f"query {run['path']} concurrency={run['concurrency']}"
+            yield f"{key} q/s", run["queries_per_second"]
+            yield f"{key} p50 ms", run["latency"]["p50_ms"]
+            yield f"{key} p99 ms", run["latency"]["p99_ms"]
+
+    baseline_rows = dict(rows(baseline))
+    print(f"{'metric':<45} {'baseline':>12} {'candidate':>12} {'change':>9}")
+    for name, value in rows(candidate):
+        before = baseline_rows.get(name)
+        change = f"{100 * (value - before) / before:+.1f}%" if before and value is not None else ""
+        print(f"{name:<45} {str(before):>12} {str(value):>12} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline ingestion and query benchmarks with local stand-ins")
+    parser.add_argument("command", choices=["ingest", "query", "all", "compare"])
+    parser.add_argument("files", nargs="*", help="compare: baseline and candidate result files")
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--table-ratio", type=float, default=0.3)
+    parser.add_argument("--page-window", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--queries", type=int, default=64)
+    parser.add_argument("--turns", type=int, default=2, help="Questions per chat session")
+    parser.add_argument("--path", choices=["sync", "async", "both"], default="both")
+    parser.add_argument("--answer-cache", action="store_true", help="Keep the semantic answer cache enabled")
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--embed-latency", type=float, default=0.02)
+    parser.add_argument("--embed-latency-per-input", type=float, default=0.0005)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--store", choices=["memory", "pgvector"], default="memory")
+    parser.add_argument("--real-tokenizer", action="store_true",
+                        help="Use tiktoken's BPE encodings (downloaded unless TIKTOKEN_CACHE_DIR has them)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        if len(args.files) != 2:
+            parser.error("compare needs a baseline and a candidate result file")
+        compare(*args.files)
+        return
+
+    benchmark = Benchmark(args)
+    results = {
+        "command": args.command,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("files", "output", "verbose")},
+    }
+    if args.command in ("ingest", "all"):
+        results["ingestion"] = benchmark.run_ingestion()
+    if args.command in ("query", "all"):
+        results["query"] = benchmark.run_queries()
+
+    # ru_maxrss is in KiB on Linux
+    results["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+    save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+from typing import List
+import random
+
+WORDS = (
+    "revenue margin quarter forecast policy coverage claim premium asset liability "
+    "contract clause schedule supplier invoice payment balance audit report review "
+    "customer region growth risk capital equity segment operating expense income "
+    "statement summary analysis compliance tax rate period annual budget target"
+).split()
+
+LINES_PER_PAGE = 55
+CHARS_PER_LINE = 95
+
+def _escape(line: str) -> str:
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def text_page(rng: random.Random) -> List[str]:
+    """Prose lines with few numbers (stays on the plain text path)."""
+    lines = []
+    while len(lines) < LINES_PER_PAGE:
+        line = ""
+        while len(line) < CHARS_PER_LINE - 12:
+            line += rng.choice(WORDS) + " "
+        lines.append(line.strip().capitalize() + ".")
+    return lines
+
+def table_page(rng: random.Random) -> List[str]:
+    """A short heading and a numeric table, well above the table detection threshold."""
+    lines = [" ".join(rng.choice(WORDS) for _ in range(8)).capitalize() + ".", ""]
+    lines.append("Item | Q1 | Q2 | Q3 | Q4 | Total | Change %")
+    for _ in range(LINES_PER_PAGE - 3):
+        values = [round(rng.uniform(100, 99999), 2) for _ in range(4)]
+        change = round(rng.uniform(-25, 25), 1)
+        lines.append(" | ".join([rng.choice(WORDS).capitalize()] + [str(v) for v in values]
+                                + [str(round(sum(values), 2)), str(change)]))
+    return lines
+
+def write_pdf(path: str, pages: int = 50, table_ratio: float = 0.3, seed: int = 0) -> dict:
+    """
+    Write a synthetic PDF whose text PyPDF2 can extract, with a mix of prose and table-heavy pages.
+
+    Args:
+        path (str): Output file.
+        pages (int): Number of pages.
+        table_ratio (float): Share of pages holding a numeric table.
+        seed (int): Different seeds give different page texts (and so no cache hits across runs).
+
+    Returns:
+        dict: Page counts and file size.
+    """
+    rng = random.Random(seed)
+    page_lines = [table_page(rng) if rng.random() < table_ratio else text_page(rng) for _ in range(pages)]
+
+    # Objects: 1 catalog, 2 page tree, 3 font, then a (page, content stream) pair per page
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        ("<< /Type /Pages /Kids [%s] /Count %d >>" % (
+            " ".join(f"{4 + 2 * ix} 0 R" for ix in range(pages)), pages)).encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    for ix, lines in enumerate(page_lines):
+        stream = "BT /F1 9 Tf 11 TL 40 800 Td\n" + "\n".join(f"({_escape(line)}) Tj T*" for line in lines) + "\nET"
+        stream = stream.encode("latin-1")
+        objects.append(("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+                        "/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (5 + 2 * ix)).encode())
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref_offset = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        output += b"%010d 00000 n \n" % offset
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+
+    with open(path, "wb") as f:
+        f.write(output)
+
+    table_pages = sum(1 for lines in page_lines if lines[2].startswith("Item |"))
+    return {"pages": pages, "table_pages": table_pages, "text_pages": pages - table_pages, "bytes": len(output)}
@@ -1,8 +1,22 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
 from starlette.middleware.cors import CORSMiddleware
 from fastapi.middleware import Middleware
 from routers import apis
+from services.ingestion_jobs import ingestion_jobs
+from services.registry import registry
+from services.pipline_run import chat_history_obj
+from services.answer_cache import answer_cache
+from services.embedding_cache import query_embedding_cache
+from services.doc_type_catalog import doc_type_catalog
+from services.db_pool import db_pool
+from services.metrics import (HTTP_REQUESTS, HTTP_SECONDS, SLOW_REQUEST_SECONDS, metrics,
+                              start_trace, end_trace, format_trace)
+import contextvars
 import logging
+import time
+import uuid
 
 logger = logging.getLogger(__name__)
 
@@ -15,4 +29,120 @@ middleware = [Middleware(
         ]
 
 app = FastAPI(middleware=middleware)
-app.include_router(apis.router)
\ No newline at end of file
+app.include_router(apis.router)
+
+#Gauges read from the components at scrape time
+metrics.register_callback("sherlock_chat_history_writer", "Chat history write-behind queue", lambda: chat_history_obj.writer.stats())
+metrics.register_callback("sherlock_chat_recent_turns", "Recent-turns buffer", lambda: chat_history_obj.recent_turns.stats())
+metrics.register_callback("sherlock_db_pool", "psycopg2 connection pool", db_pool.stats)
+metrics.register_callback("sherlock_answer_cache", "Semantic answer cache", answer_cache.stats)
+metrics.register_callback("sherlock_query_embedding_cache", "Query embedding cache", query_embedding_cache.stats)
+metrics.register_callback("sherlock_doc_type_catalog", "Doc type catalog cache", doc_type_catalog.stats)
+
+def _report_request(request: Request, status_code: int, elapsed: float):
+    route = request.scope.get("route")
+    route_path = route.path if route is not None else "unmatched"
+    HTTP_REQUESTS.inc(method=request.method, route=route_path, status=status_code)
+    HTTP_SECONDS.observe(elapsed, method=request.method, route=route_path)
+    if elapsed > SLOW_REQUEST_SECONDS:
+        print(f"Slow request {request.method} {route_path}: {format_trace(elapsed)}")
+
+async def _traced_body(body_iterator, finish):
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        finish()
+
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    """
+    Tag each request with an id (the client's X-Request-Id, or a new one), returned in the
+    X-Request-Id header. Pipeline stages record their timings under it; requests slower
+    than SLOW_REQUEST_SECONDS print their stage trace.
+
+    A streamed body (SSE answers) runs retrieval and generation after the response is
+    returned, so such a request is timed and reported once its body is fully sent.
+    """
+    request_id = request.headers.get("X-Request-Id") or str(uuid.uuid4())
+    trace_tokens = start_trace(request_id)
+    started = time.perf_counter()
+    status_code = 500
+    streaming = False
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        response.headers["X-Request-Id"] = request_id
+        body_iterator = getattr(response, "body_iterator", None)
+        if body_iterator is not None:
+            #The body is sent from another task: report from a copy of this context, which
+            #shares the trace list the streaming stages append to
+            trace_context = contextvars.copy_context()
+            response.body_iterator = _traced_body(
+                body_iterator,
+                lambda: trace_context.run(_report_request, request, status_code, time.perf_counter() - started),
+            )
+            streaming = True
+        return response
+    finally:
+        if not streaming:
+            _report_request(request, status_code, time.perf_counter() - started)
+        end_trace(trace_tokens)
+
+@app.on_event("startup")
+async def warm_up_models():
+    # Build models and vector stores before the first request instead of at import time
+    await run_in_threadpool(registry.warm_up)
+
+@app.on_event("startup")
+async def create_chat_history_indexes():
+    # Index used to load a session's recent turns when it is not in the in-memory buffer
+    await run_in_threadpool(chat_history_obj.ensure_indexes)
+
+@app.on_event("startup")
+async def create_answer_cache_versions():
+    # Corpus version counters shared by every worker and the bulk_ingest CLI
+    await run_in_threadpool(answer_cache.versions.ensure_table)
+
+@app.on_event("startup")
+async def start_doc_type_catalog():
+    # Unique (user_id, doc_type) index for idempotent add-option, then listen for changes made by other workers
+    await run_in_threadpool(doc_type_catalog.db_op.ensure_doc_type_constraint)
+    doc_type_catalog.start()
+
+@app.on_event("startup")
+async def prepare_upload_table():
+    # Unique doc_id for batched upload registration, (user_id, doc_type) index for document listing
+    await run_in_threadpool(doc_type_catalog.db_op.ensure_upload_table)
+
+@app.on_event("startup")
+def start_ingestion_workers():
+    # Resumes jobs left unfinished by a previous process
+    ingestion_jobs.start()
+
+@app.on_event("shutdown")
+def stop_ingestion_workers():
+    ingestion_jobs.stop()
+
+@app.on_event("shutdown")
+def stop_doc_type_catalog():
+    doc_type_catalog.stop()
+
+@app.on_event("shutdown")
+def flush_chat_history():
+    # Write the chat turns still queued by the write-behind writer
+    chat_history_obj.writer.stop()
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 200 once models, vector stores and the database are reachable."""
+    if not registry.is_ready():
+        await run_in_threadpool(registry.warm_up)
+
+    status = registry.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Stage latencies, token and embedding counters, DB timings and queue depths in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
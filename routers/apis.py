@@ -1,5 +1,5 @@
-from typing import List
-from fastapi import APIRouter, File, Form, UploadFile
+from typing import List, Optional
+from fastapi import APIRouter, File, Form, Response, UploadFile
 import logging
 
 from fastapi.responses import StreamingResponse
@@ -18,6 +18,8 @@ class ChatRequestBody(BaseModel):
     user_id: str
     doc_type: str
     prompt: str
+    stream: bool = False
+    session_id: Optional[str] = None
 
 @router.post("/upload-files")
 async def upload_files_and_conversations(
@@ -30,14 +32,57 @@ async def upload_files_and_conversations(
 
     return response
 
-@router.post("/sherlock-conversation")
-async def chat(request: ChatRequestBody):
-    """Get answer to query from PDF documents"""
+@router.get("/upload-status/{job_id}")
+async def upload_status(job_id: str):
+    """Get ingestion progress of an upload job"""
+
+    response = await api_service.upload_status(job_id)
+
+    return response
 
+@router.post("/sherlock-conversation")
+async def chat(request: ChatRequestBody, http_response: Response):
+    """
+    Get answer to query from PDF documents.
+    Pass the X-Session-Id response header back as session_id to continue a conversation.
+    """
+
+    request.session_id = api_service.start_session(request.session_id, request.user_id)
+
+    if request.stream:
+        return StreamingResponse(
+            api_service.stream_conversations(request),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Session-Id": request.session_id},
+        )
+
+    http_response.headers["X-Session-Id"] = request.session_id
     response = await api_service.conversations(request)
 
     return response
 
+@router.get("/documents")
+async def list_documents(
+            user_id: str,
+            doc_type: Optional[str] = None
+        ):
+    """Documents uploaded by a user, newest first"""
+
+    response = await api_service.list_documents(user_id, doc_type)
+
+    return response
+
+@router.delete("/documents/{doc_id}")
+async def delete_document(
+            doc_id: str,
+            user_id: str
+        ):
+    """Delete an uploaded document and its chunks (409 while it is still being ingested)"""
+
+    response = await api_service.delete_document(user_id, doc_id)
+
+    return response
+
 @router.post("/add-option")
 async def add_new_option(
             user_id: str,
@@ -57,3 +102,12 @@ async def manage_options(
     response = await api_service.manage_category(user_id)
 
     return response
+
+
+@router.get("/cache-stats")
+async def get_cache_stats():
+    """Hit rates of the answer and query embedding caches"""
+
+    response = await api_service.cache_stats()
+
+    return response
@@ -0,0 +1,223 @@
+from services.db_pool import db_pool
+from psycopg2 import pool as pg_pool
+from collections import OrderedDict
+from dotenv import load_dotenv
+from typing import List, Optional
+import numpy as np
+import threading
+import psycopg2
+import time
+import os
+
+load_dotenv()
+
+class CorpusVersions:
+    """
+    Corpus version of each tenant (user_id, doc_type), in a Postgres counter table.
+
+    Every API worker, the ingestion workers and the bulk_ingest CLI bump and read the
+    same row, so an ingestion in any process makes the cached answers of every process stale.
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or db_pool
+
+    def ensure_table(self):
+        query = """
+        CREATE TABLE IF NOT EXISTS public.answer_cache_versions (
+            user_id TEXT NOT NULL,
+            doc_type TEXT NOT NULL,
+            version BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, doc_type)
+        )
+        """
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query)
+        except (psycopg2.Error, pg_pool.PoolError) as e:
+            print(f"Error creating answer cache version table: {e}")
+
+    def get(self, user_id: str, doc_type: str) -> Optional[int]:
+        """Current version of a tenant (0 if never bumped), or None if it could not be read."""
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        "SELECT version FROM public.answer_cache_versions WHERE user_id = %s AND doc_type = %s",
+                        (user_id, doc_type),
+                    )
+                    row = cur.fetchone()
+        except (psycopg2.Error, pg_pool.PoolError) as e:
+            print(f"Error reading answer cache version: {e}")
+            return None
+        return row[0] if row else 0
+
+    def bump(self, user_id: str, doc_type: str) -> Optional[int]:
+        """Increment the version of a tenant and return it (None on error)."""
+        query = """
+        INSERT INTO public.answer_cache_versions (user_id, doc_type, version)
+        VALUES (%s, %s, 1)
+        ON CONFLICT (user_id, doc_type) DO UPDATE SET version = answer_cache_versions.version + 1
+        RETURNING version
+        """
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, (user_id, doc_type))
+                    return cur.fetchone()[0]
+        except (psycopg2.Error, pg_pool.PoolError) as e:
+            print(f"Error bumping answer cache version: {e}")
+            return None
+
+
+class AnswerCache:
+    """
+    Semantic cache of final answers per tenant (user_id, doc_type).
+
+    A lookup embeds nothing itself: it compares the question embedding (already
+    computed, and cached, for retrieval) with the stored question embeddings of
+    the tenant, and returns the stored answer when the cosine similarity reaches
+    the threshold. Each tenant has a corpus version (CorpusVersions, shared by all
+    processes) that is bumped when files are ingested into or deleted from its doc_type;
+    entries stored under an older version are dropped on the next lookup.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries_per_tenant: int = 200, ttl: float = 86400,
+                 versions: Optional[CorpusVersions] = None):
+        """
+        Args:
+            threshold (float): Minimum cosine similarity for a hit.
+            max_entries_per_tenant (int): LRU bound on entries per (user_id, doc_type).
+            ttl (float): Seconds an answer stays valid.
+            versions (CorpusVersions): Corpus version store. Defaults to the Postgres one.
+        """
+        self.threshold = threshold
+        self.max_entries_per_tenant = max_entries_per_tenant
+        self.ttl = ttl
+        self.versions = versions or CorpusVersions()
+        self._lock = threading.Lock()
+        self._tenants = {}
+        #Corpus version the entries of each tenant were stored under
+        self._tenant_versions = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def corpus_version(self, user_id: str, doc_type: str) -> Optional[int]:
+        """Current corpus version of a tenant, or None if the version store is unreachable."""
+        return self.versions.get(user_id, doc_type)
+
+    def _drop_stale(self, key, corpus_version: int) -> None:
+        #Caller holds the lock
+        if self._tenant_versions.get(key) != corpus_version:
+            if self._tenants.pop(key, None):
+                self.invalidations += 1
+            self._tenant_versions[key] = corpus_version
+
+    def lookup(self, user_id: str, doc_type: str, embedding: List[float],
+               corpus_version: Optional[int] = None) -> Optional[str]:
+        """
+        Return the cached answer of the most similar question above the threshold, or None.
+        Pass the corpus_version just read with corpus_version() to skip reading it again.
+        Without a readable corpus version nothing is served, since it could be stale.
+        """
+        key = (user_id, doc_type)
+        if corpus_version is None:
+            corpus_version = self.corpus_version(user_id, doc_type)
+        now = time.time()
+        with self._lock:
+            if corpus_version is None:
+                self.misses += 1
+                return None
+            self._drop_stale(key, corpus_version)
+            entries = self._tenants.get(key)
+            if entries:
+                for entry_id in [entry_id for entry_id, entry in entries.items() if now - entry["created"] > self.ttl]:
+                    del entries[entry_id]
+
+            if not entries:
+                self.misses += 1
+                return None
+
+            entry_ids = list(entries)
+            matrix = np.stack([entries[entry_id]["embedding"] for entry_id in entry_ids])
+            similarities = matrix @ self._normalize(embedding)
+            best = int(np.argmax(similarities))
+
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            entry = entries[entry_ids[best]]
+            entries.move_to_end(entry_ids[best])
+            self.hits += 1
+            self.seconds_saved += entry["latency"]
+            return entry["answer"]
+
+    def store(self, user_id: str, doc_type: str, question: str, embedding: List[float],
+              answer: str, latency: float, corpus_version: Optional[int] = None) -> None:
+        """
+        Cache an answer. Pass the corpus_version read before generation started, so an
+        answer generated while new files were being ingested is not cached as current.
+        Reads the current corpus version from the version store (blocking).
+        """
+        key = (user_id, doc_type)
+        current_version = self.corpus_version(user_id, doc_type)
+        if current_version is None or (corpus_version is not None and corpus_version != current_version):
+            return
+        with self._lock:
+            self._drop_stale(key, current_version)
+            entries = self._tenants.setdefault(key, OrderedDict())
+            entries[question] = {
+                "embedding": self._normalize(embedding),
+                "answer": answer,
+                "latency": latency,
+                "created": time.time(),
+            }
+            entries.move_to_end(question)
+            while len(entries) > self.max_entries_per_tenant:
+                entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id: str, doc_type: str) -> None:
+        """
+        Bump the corpus version of a tenant and drop its answers (called after ingestion).
+        Other processes drop theirs on their next lookup of the tenant.
+        """
+        key = (user_id, doc_type)
+        self.versions.bump(user_id, doc_type)
+        with self._lock:
+            self._tenants.pop(key, None)
+            self._tenant_versions.pop(key, None)
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "tenants": len(self._tenants),
+                "entries": sum(len(entries) for entries in self._tenants.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "seconds_saved": round(self.seconds_saved, 3),
+            }
+
+
+answer_cache = AnswerCache(
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)),
+    max_entries_per_tenant=int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 200)),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", 86400)),
+)
@@ -1,10 +1,20 @@
 import os
+import json
 import shutil
+import hashlib
+import tempfile
+import uuid
 
 from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from services.pipline_run import *
 from services.pdf_preprocessing import *
 from services.user_doc_types import *
+from services.ingestion_jobs import ingestion_jobs
+from services.content_cache import content_cache
+from services.answer_cache import answer_cache
+from services.embedding_cache import query_embedding_cache
+from services.doc_type_catalog import doc_type_catalog
 
 
 # Define the upload directory
@@ -12,80 +22,195 @@ UPLOAD_DIR = "saved_files"
 # Create directory if it doesn't exist
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 db_op = DatabaseOperations()
-options_data = db_op.extract_table_data()
 
 #Inference object
 inference_obj = RUN_Inference()
 
 processed_files = {}
 
+# Set SYNC_INFERENCE=true to fall back to the blocking inference path (run in a threadpool)
+SYNC_INFERENCE = os.getenv("SYNC_INFERENCE", "false").lower() == "true"
+
+# Uploads are copied to disk in chunks of this size, never read in memory whole
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", 1024 * 1024))
+
+async def save_upload(uploaded_file, file_path):
+    """
+    Stream an upload to file_path in UPLOAD_CHUNK_BYTES chunks, hashing it on the way.
+    The file is written under a unique temporary name (concurrent uploads of the same
+    file name never share it) and only moved into place by the caller.
+
+    Returns:
+        tuple: (temporary path, sha256 hex digest)
+    """
+    digest = hashlib.sha256()
+    await uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(file_path), prefix=f"{os.path.basename(file_path)}.",
+                                     suffix=".part", delete=False) as f:
+        try:
+            while True:
+                chunk = await uploaded_file.read(UPLOAD_CHUNK_BYTES)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                await run_in_threadpool(f.write, chunk)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    return f.name, digest.hexdigest()
+
 # Helper function to get available document types
 def get_doc_types() -> List[str]:
-    options_data = db_op.extract_table_data()
-    if options_data is not None and 'doc_type' in options_data and not options_data['doc_type'].empty:
-        return list(options_data['doc_type'])
-    return []
+    return doc_type_catalog.all_doc_types()
 
 async def upload_files_conversation(files, doc_type, user_id):
 
-    # Initialize PDF reader
-    pdf_reader = PDF_reader(doc_type)
-
     # Process uploaded files
     newly_uploaded = []
+    doc_ids = []
+    duplicate_files = []
     for uploaded_file in files:
         if not uploaded_file.filename.lower().endswith('.pdf'):
             continue
             
         file_name = uploaded_file.filename
-        file_path = os.path.join(f"{UPLOAD_DIR}\{user_id}", file_name)
-        # file_key = f"{doc_type}_{file_name}"
-
-        # Record upload in database
-        db_op.document_upload_info(file_name, user_id)
+        user_dir = os.path.join(UPLOAD_DIR, user_id)
 
         # Create the directory structure if it doesn't exist
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.makedirs(user_dir, exist_ok=True)
+
+        # Dedup on content, not on file name: renamed copies are skipped, changed files are re-ingested
+        tmp_path, file_hash = await save_upload(uploaded_file, os.path.join(user_dir, file_name))
+        if await run_in_threadpool(content_cache.find_file, file_hash, user_id, doc_type):
+            os.remove(tmp_path)
+            duplicate_files.append(file_name)
+            continue
 
-        if not os.path.exists(file_path):
-            await uploaded_file.seek(0)
-            with open(file_path, "wb") as f:
-                f.write(await uploaded_file.read())
-            newly_uploaded.append(file_name)
+        # Stored under its own doc_id: a later upload with the same name never overwrites
+        # the bytes a queued or running job is about to read
+        doc_id = str(uuid.uuid4())
+        file_path = os.path.join(user_dir, doc_id, file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(tmp_path, file_path)
+        newly_uploaded.append((file_name, file_path))
+        doc_ids.append(doc_id)
 
+    # Record the new uploads in one round trip; each doc_id is the file_id of the file's chunks
+    job_id = None
     if newly_uploaded:
-        for file_name in newly_uploaded:
-            pdf_reader.create_embeddings(filename=file_path)
+        await run_in_threadpool(
+            db_op.register_uploads, user_id, doc_type, [file_name for file_name, _ in newly_uploaded], doc_ids
+        )
+
+        # Parsing and embedding run in the background ingestion workers
+        job_id = await run_in_threadpool(ingestion_jobs.create_job, user_id, doc_type, newly_uploaded, file_ids=doc_ids)
     
     return {
-        "message": f"Successfully uploaded and processed {len(newly_uploaded)} files.",
-        "uploaded_files": newly_uploaded
+        "message": f"Successfully uploaded {len(newly_uploaded)} files. Processing started.",
+        "uploaded_files": [file_name for file_name, _ in newly_uploaded],
+        "duplicate_files": duplicate_files,
+        "job_id": job_id
     }
 
+async def upload_status(job_id):
+
+    job = await run_in_threadpool(ingestion_jobs.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found")
+
+    return job
+
+
+async def list_documents(user_id, doc_type=None):
+
+    documents = await run_in_threadpool(db_op.list_user_documents, user_id, doc_type)
+
+    return {"user_id": user_id, "documents": documents}
+
+async def delete_document(user_id, doc_id):
+
+    # Chunks written after the delete would be orphaned: wait for the ingestion to finish
+    if await run_in_threadpool(ingestion_jobs.is_ingesting, doc_id):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"Document {doc_id} is still being ingested")
+
+    deleted = await run_in_threadpool(db_op.delete_user_document, user_id, doc_id)
+    if deleted is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Document {doc_id} not found")
+
+    # A re-upload of the same file must be ingested again, and cached answers may cite it
+    await run_in_threadpool(content_cache.remove_file, doc_id)
+    if deleted["doc_type"]:
+        await run_in_threadpool(answer_cache.invalidate, user_id, deleted["doc_type"])
+
+    return {"doc_id": doc_id, **deleted}
 
 async def add_new_category(user_id, new_option):
 
-    db_op.update_table_data(user_id,new_option)
+    added = await run_in_threadpool(doc_type_catalog.add, user_id, new_option)
 
     return {
         "status_code": 200,
-        "message": "Option added successfully!"
+        "message": "Option added successfully!" if added else "Option already exists."
     }
 
 async def manage_category(user_id):
 
-    data = db_op.extract_table_data_by_user_id(user_id)
+    data = await run_in_threadpool(doc_type_catalog.get, user_id)
 
     return data
 
+def start_session(session_id=None, user_id=None):
+    """Return the client's session id, or start a new session if it sent none."""
+    return chat_history_obj.start_session(session_id, user_id)
+
 async def conversations(request):
 
     # Get answer
-    response = inference_obj.get_answer(
-        request.prompt, 
-        selected_doc_type=request.doc_type, 
-        user_id=request.user_id
-    )
+    if SYNC_INFERENCE:
+        response = await run_in_threadpool(
+            inference_obj.get_answer,
+            request.prompt, 
+            selected_doc_type=request.doc_type, 
+            user_id=request.user_id,
+            session_id=request.session_id
+        )
+    else:
+        response = await inference_obj.aget_answer(
+            request.prompt, 
+            selected_doc_type=request.doc_type, 
+            user_id=request.user_id,
+            session_id=request.session_id
+        )
 
     return response
 
+async def stream_conversations(request):
+    """
+    Stream the answer as server-sent events: one `data` event per token,
+    followed by an `end` event (or an `error` event if generation fails).
+    """
+    try:
+        async for token in inference_obj.astream_answer(
+            request.prompt, 
+            selected_doc_type=request.doc_type, 
+            user_id=request.user_id,
+            session_id=request.session_id
+        ):
+            yield f"data: {json.dumps({'token': token})}\n\n"
+    except Exception as e:
+        print(f"Error streaming answer: {e}")
+        yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+        return
+
+    yield "event: end\ndata: {}\n\n"
+
+async def cache_stats():
+
+    return {
+        "answer_cache": answer_cache.stats(),
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "recent_turns_buffer": chat_history_obj.recent_turns.stats(),
+        "chat_history_writer": chat_history_obj.writer.stats(),
+        "doc_type_catalog": doc_type_catalog.stats()
+    }
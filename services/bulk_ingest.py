@@ -0,0 +1,262 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from services.get_model import RateLimiter, RateLimitedChatModel, RateLimitedEmbeddings
+from services.content_cache import content_cache
+from services.answer_cache import answer_cache
+from services.pdf_preprocessing import PDF_reader
+from services.pdf_extraction import parse_pdf
+from services.user_doc_types import DatabaseOperations
+from services.registry import registry
+from dotenv import load_dotenv
+from typing import List, Optional
+import multiprocessing
+import threading
+import argparse
+import tiktoken
+import sqlite3
+import json
+import time
+import uuid
+import os
+
+load_dotenv()
+
+class BulkCheckpoint:
+    """
+    Per-file progress of bulk ingestion runs, in a local sqlite file.
+
+    A file keeps its file_id across runs, so an interrupted file resumes after its last
+    committed embedding batch, and files already completed are skipped.
+    """
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bulk_files (
+                file_path TEXT,
+                user_id TEXT,
+                doc_type TEXT,
+                file_id TEXT,
+                file_hash TEXT,
+                status TEXT,
+                registered INTEGER DEFAULT 0,
+                pages INTEGER DEFAULT 0,
+                error TEXT,
+                updated_at REAL,
+                PRIMARY KEY (file_path, user_id, doc_type)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get(self, file_path: str, user_id: str, doc_type: str) -> dict:
+        """Return the checkpoint of a file, creating it (status 'pending', new file_id) if unknown."""
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR IGNORE INTO bulk_files (file_path, user_id, doc_type, file_id, status, updated_at)
+                VALUES (?, ?, ?, ?, 'pending', ?)""",
+                (file_path, user_id, doc_type, str(uuid.uuid4()), time.time()),
+            )
+            self._conn.commit()
+            row = self._conn.execute(
+                "SELECT * FROM bulk_files WHERE file_path = ? AND user_id = ? AND doc_type = ?",
+                (file_path, user_id, doc_type),
+            ).fetchone()
+        return dict(row)
+
+    def update(self, file_path: str, user_id: str, doc_type: str, **fields) -> None:
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE bulk_files SET {assignments} WHERE file_path = ? AND user_id = ? AND doc_type = ?",
+                (*fields.values(), file_path, user_id, doc_type),
+            )
+            self._conn.commit()
+
+    def summary(self, user_id: str, doc_type: str) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT status, count(*) AS files, sum(pages) AS pages FROM bulk_files
+                WHERE user_id = ? AND doc_type = ? GROUP BY status""",
+                (user_id, doc_type),
+            ).fetchall()
+        return {row["status"]: {"files": row["files"], "pages": row["pages"] or 0} for row in rows}
+
+
+class BulkIngester:
+    """
+    Ingest every PDF of a directory for one (user_id, doc_type).
+
+    PDFs are parsed in a process pool (parse_workers), and the parsed pages are fed to
+    file_workers threads that restructure, embed and write them to the parent_embedding /
+    child_embedding collections through the shared, rate-limited models. Parsing runs
+    ahead of the writers by at most one file per worker, so memory stays bounded.
+    """
+
+    def __init__(self, user_id: str, doc_type: str, checkpoint: BulkCheckpoint,
+                 parse_workers: int = 4, file_workers: int = 2, retry_failed: bool = False):
+        """
+        Args:
+            user_id (str): Owner of the documents.
+            doc_type (str): Document type the files are ingested under.
+            checkpoint (BulkCheckpoint): Per-file progress store.
+            parse_workers (int): Parsing processes.
+            file_workers (int): Files restructured and embedded concurrently.
+            retry_failed (bool): Also retry files that failed in a previous run.
+        """
+        self.user_id = user_id
+        self.doc_type = doc_type
+        self.checkpoint = checkpoint
+        self.parse_workers = parse_workers
+        self.file_workers = file_workers
+        self.retry_failed = retry_failed
+        self.db_op = DatabaseOperations()
+        self._lock = threading.Lock()
+        self.done = 0
+        self.total = 0
+
+    def find_files(self, directory: str) -> List[str]:
+        paths = []
+        for root, _, file_names in os.walk(directory):
+            paths.extend(os.path.abspath(os.path.join(root, name)) for name in file_names if name.lower().endswith(".pdf"))
+        return sorted(paths)
+
+    def pending_files(self, paths: List[str]) -> List[str]:
+        """Files not completed (or deduplicated) by a previous run."""
+        statuses = ["pending", "running", "failed"] if self.retry_failed else ["pending", "running"]
+        return [path for path in paths
+                if self.checkpoint.get(path, self.user_id, self.doc_type)["status"] in statuses]
+
+    def _update(self, path, **fields):
+        self.checkpoint.update(path, self.user_id, self.doc_type, **fields)
+
+    def ingest_file(self, path: str, pages: List[str], file_hash: str) -> None:
+        file_name = os.path.basename(path)
+        row = self.checkpoint.get(path, self.user_id, self.doc_type)
+        started = time.perf_counter()
+        claimed = False
+        try:
+            # Claimed before embedding, so identical files on other writer threads are skipped
+            # instead of ingested twice (a resumed file finds its own claim)
+            owner_file_id = content_cache.claim_file(file_hash, self.user_id, self.doc_type, row["file_id"], file_name)
+            if owner_file_id != row["file_id"]:
+                self._update(path, status="duplicate", file_hash=file_hash, error=None)
+                self._report(file_name, f"duplicate of {owner_file_id}")
+                return
+            claimed = True
+
+            if not row["registered"]:
+                # Registered under the checkpoint's file_id, so the upload record points at the chunks
+                self.db_op.register_uploads(self.user_id, self.doc_type, [file_name], doc_ids=[row["file_id"]])
+                self._update(path, registered=1)
+
+            self._update(path, status="running", file_hash=file_hash, pages=len(pages), error=None)
+            pdf_reader = PDF_reader(self.doc_type, user_id=self.user_id)
+            pdf_reader.create_embeddings(path, file_id=row["file_id"], pages=pages)
+            content_cache.add_file(file_hash, self.user_id, self.doc_type, row["file_id"], file_name)
+            # Answers cached by the API workers for this tenant are now stale
+            answer_cache.invalidate(self.user_id, self.doc_type)
+            self._update(path, status="completed")
+            self._report(file_name, f"{len(pages)} pages in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            if claimed:
+                content_cache.release_file(file_hash, self.user_id, self.doc_type, row["file_id"])
+            self._update(path, status="failed", error=str(e))
+            self._report(file_name, f"failed: {e}")
+
+    def _report(self, file_name, message):
+        with self._lock:
+            self.done += 1
+            print(f"[{self.done}/{self.total}] {file_name}: {message}")
+
+    def run(self, directory: str) -> dict:
+        paths = self.pending_files(self.find_files(directory))
+        self.total = len(paths)
+        print(f"{self.total} files to ingest for user {self.user_id}, doc_type {self.doc_type}")
+        started = time.perf_counter()
+
+        remaining = iter(paths)
+        parsing, writing = {}, set()
+        # spawn: the parent already runs threads, which fork does not copy safely
+        with ProcessPoolExecutor(self.parse_workers, mp_context=multiprocessing.get_context("spawn")) as parsers, \
+                ThreadPoolExecutor(self.file_workers, thread_name_prefix="bulk-ingest") as writers:
+
+            def fill():
+                # Parsed files waiting for a writer count against the limit (back-pressure)
+                while len(parsing) + len(writing) < self.parse_workers + self.file_workers:
+                    path = next(remaining, None)
+                    if path is None:
+                        return
+                    parsing[parsers.submit(parse_pdf, path)] = path
+
+            fill()
+            while parsing or writing:
+                finished, _ = wait(set(parsing) | writing, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    if future in parsing:
+                        path = parsing.pop(future)
+                        try:
+                            pages, file_hash = future.result()
+                        except Exception as e:
+                            self._update(path, status="failed", error=f"parse error: {e}")
+                            self._report(os.path.basename(path), f"parse failed: {e}")
+                            continue
+                        writing.add(writers.submit(self.ingest_file, path, pages, file_hash))
+                    else:
+                        writing.discard(future)
+                fill()
+
+        elapsed = time.perf_counter() - started
+        summary = self.checkpoint.summary(self.user_id, self.doc_type)
+        pages = sum(row["pages"] for status, row in summary.items() if status == "completed")
+        return {"files_this_run": self.total, "seconds": round(elapsed, 1), "by_status": summary,
+                "completed_pages": pages}
+
+
+def rate_limit_models(llm_rpm: float, embed_rpm: float, embed_tpm: Optional[float] = None):
+    """Route every LLM and embedding call of this process through shared rate limiters."""
+    encoding = tiktoken.get_encoding("cl100k_base")
+    registry.override(
+        llm=RateLimitedChatModel(registry.llm, RateLimiter(llm_rpm)),
+        embed=RateLimitedEmbeddings(
+            registry.embed,
+            RateLimiter(embed_rpm),
+            RateLimiter(embed_tpm) if embed_tpm else None,
+            count_tokens=lambda text: len(encoding.encode(text)),
+        ),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest a directory of PDFs for one user and doc_type")
+    parser.add_argument("directory")
+    parser.add_argument("--user-id", required=True)
+    parser.add_argument("--doc-type", required=True)
+    parser.add_argument("--parse-workers", type=int, default=int(os.getenv("BULK_PARSE_WORKERS", os.cpu_count() or 4)))
+    parser.add_argument("--file-workers", type=int, default=int(os.getenv("BULK_FILE_WORKERS", 4)))
+    parser.add_argument("--llm-rpm", type=float, default=float(os.getenv("BULK_LLM_RPM", 300)))
+    parser.add_argument("--embed-rpm", type=float, default=float(os.getenv("BULK_EMBED_RPM", 600)))
+    parser.add_argument("--embed-tpm", type=float, default=float(os.getenv("BULK_EMBED_TPM", 0)) or None)
+    parser.add_argument("--checkpoint", default=os.getenv("BULK_CHECKPOINT_DB", os.path.join("saved_files", "bulk_ingest.sqlite")))
+    parser.add_argument("--retry-failed", action="store_true")
+    args = parser.parse_args()
+
+    rate_limit_models(args.llm_rpm, args.embed_rpm, args.embed_tpm)
+    ingester = BulkIngester(
+        args.user_id,
+        args.doc_type,
+        BulkCheckpoint(args.checkpoint),
+        parse_workers=args.parse_workers,
+        file_workers=args.file_workers,
+        retry_failed=args.retry_failed,
+    )
+    print(json.dumps(ingester.run(args.directory), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,98 +1,474 @@
 import os
-from fastapi import HTTPException, status
-from services.get_model import Call_Models
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2 import pool as pg_pool
+from sqlalchemy.exc import SQLAlchemyError
+from services.db_pool import db_pool, get_engine
+from services.metrics import db_operation, timed_db, timed_stage
+from collections import OrderedDict, deque
 import pandas as pd
+import threading
 import datetime
+import queue
+import uuid
+import time
+
+class RecentTurnsBuffer:
+    """
+    Bounded in-process buffer of the last turns of each chat session.
+
+    Sessions are evicted least recently used first (max_sessions) or after ttl
+    seconds without activity. get() returns None for a session that is not
+    buffered ("cold"), in which case the caller loads it from the database.
+    """
+
+    def __init__(self, max_sessions=1000, max_turns=10, ttl=3600):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id):
+        """Return the buffered turns of a session (oldest first), or None if cold."""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or time.time() - entry["touched"] > self.ttl:
+                self._sessions.pop(session_id, None)
+                self.misses += 1
+                return None
+            entry["touched"] = time.time()
+            self._sessions.move_to_end(session_id)
+            self.hits += 1
+            return list(entry["turns"])
+
+    def load(self, session_id, turns):
+        """Buffer the turns of a cold session (oldest first)."""
+        with self._lock:
+            self._sessions[session_id] = {"turns": deque(turns, maxlen=self.max_turns), "touched": time.time()}
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def append(self, session_id, turn):
+        """
+        Add a turn to a buffered session. Cold sessions are left alone: their older
+        turns are only in the database and are loaded on the next lookup.
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is not None:
+                entry["turns"].append(turn)
+                entry["touched"] = time.time()
+                self._sessions.move_to_end(session_id)
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "hits": self.hits, "misses": self.misses}
+
+
+class ChatHistoryWriter:
+    """
+    Write-behind queue for chat_history_table.
+
+    enqueue() never touches the database: records are written by a background
+    thread in multi-row INSERTs, when batch_size records are queued or every
+    flush_interval seconds. A batch that fails on a connection error is kept and
+    retried on the next flush. Any other failure is retried row by row, and rows that
+    still fail (e.g. a NUL byte in the text) are dropped, so a bad record never blocks
+    the queue. Otherwise records are only dropped when the queue and the retry
+    backlog (max_queue records each) are full, i.e. the database is down for long.
+    stop() flushes everything still queued.
+    """
+
+    INSERT_QUERY = """
+        INSERT INTO public.chat_history_table
+        (user_id, session_id, doc_category, question, response, time_stamp)
+        VALUES %s
+        """
+
+    def __init__(self, pool, batch_size=100, flush_interval=1.0, max_queue=10000):
+        """
+        Args:
+            pool (ConnectionPool): Pool the batches are written with.
+            batch_size (int): Records per INSERT, and queue depth that triggers a flush.
+            flush_interval (float): Maximum seconds a record waits in the queue.
+            max_queue (int): Queued records beyond which new records are dropped.
+        """
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.max_pending = max_queue
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+        self.dead_lettered = 0
+        self.last_flush_seconds = 0.0
+        self.last_error = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="chat-history-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=10):
+        """Stop the background thread after flushing every queued record."""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush()
+
+    def enqueue(self, user_id, session_id, doc_category, question, response, time_stamp=None):
+        """Queue a record without blocking. Returns False if the queue is full and the record was dropped."""
+        record = (user_id, session_id, doc_category, question, response, time_stamp or datetime.datetime.now())
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            print(f"Chat history queue full, dropped record for session {session_id}")
+            return False
+        with self._lock:
+            self.enqueued += 1
+        #Also restarts a writer thread that died
+        if (self._thread is None or not self._thread.is_alive()) and not self._stopping.is_set():
+            self.start()
+        return True
+
+    def _run(self):
+        while not self._stopping.is_set():
+            deadline = time.monotonic() + self.flush_interval
+            while self._queue.qsize() < self.batch_size and not self._stopping.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._stopping.wait(min(remaining, 0.05))
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Chat history writer error: {e}")
+                with self._lock:
+                    self.failures += 1
+                    self.last_error = str(e)
+
+    #Errors after which the same rows may succeed later (database or pool unavailable)
+    RETRYABLE_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, pg_pool.PoolError)
+
+    def _insert(self, rows):
+        with db_operation("chat_history_insert_batch"), self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, self.INSERT_QUERY, rows, page_size=self.batch_size)
+
+    def _insert_rows(self, batch):
+        """
+        Write a batch that failed as a whole one row at a time, dropping the rows that fail.
+        Returns the number of rows handled (written or dropped); a retryable error stops early.
+        """
+        for ix, row in enumerate(batch):
+            try:
+                self._insert([row])
+            except self.RETRYABLE_ERRORS:
+                return ix
+            except Exception as e:
+                print(f"Dropping chat history record of session {row[1]}: {e}")
+                with self._lock:
+                    self.dead_lettered += 1
+                    self.last_error = str(e)
+                continue
+            with self._lock:
+                self.written += 1
+        return len(batch)
+
+    def flush(self):
+        """
+        Write every queued record. Records of a batch that failed on a connection error stay
+        pending for the next flush; the backlog holds at most max_pending records.
+        """
+        with self._flush_lock:
+            while len(self._pending) < self.max_pending:
+                try:
+                    self._pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                started = time.monotonic()
+                try:
+                    self._insert(batch)
+                except self.RETRYABLE_ERRORS as e:
+                    print(f"Error inserting chat history batch of {len(batch)}: {e}")
+                    with self._lock:
+                        self.failures += 1
+                        self.last_error = str(e)
+                    return False
+                except Exception as e:
+                    #Data errors: isolate the bad rows instead of retrying the batch forever
+                    print(f"Error inserting chat history batch of {len(batch)}, retrying row by row: {e}")
+                    with self._lock:
+                        self.failures += 1
+                    handled = self._insert_rows(batch)
+                    del self._pending[:handled]
+                    if handled < len(batch):
+                        return False
+                    continue
+
+                del self._pending[:len(batch)]
+                with self._lock:
+                    self.written += len(batch)
+                    self.batches += 1
+                    self.last_flush_seconds = time.monotonic() - started
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self._queue.qsize(),
+                "pending_retry": len(self._pending),
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "batches": self.batches,
+                "failures": self.failures,
+                "dropped": self.dropped,
+                "dead_lettered": self.dead_lettered,
+                "last_flush_seconds": round(self.last_flush_seconds, 6),
+                "last_error": self.last_error,
+            }
+
 
 class ChatHistory:
+
+    #A session is only ever read back for the user that owns it
+    SESSION_QUERY = """
+        SELECT * FROM public.chat_history_table
+        WHERE session_id = %s AND user_id IS NOT DISTINCT FROM %s
+        ORDER BY time_stamp DESC LIMIT %s
+        """
+
+    #Number of recent turns used to rephrase a follow-up question
+    HISTORY_TURNS = 3
     
     def __init__(self):
-        self.conn_params = {
-            "dbname": os.getenv("DATABASE_NAME"),   # Database name
-            "user": os.getenv("DB_USER"),           # PostgreSQL username
-            "password": os.getenv("DB_PASSWORD"),   # PostgreSQL password
-            "host": os.getenv("HOST"),              # Database host
-            "port": os.getenv("PORT")               # Default PostgreSQL port
-        }
+        self.pool = db_pool
+        self.recent_turns = RecentTurnsBuffer(
+            max_sessions=int(os.getenv("CHAT_BUFFER_SESSIONS", 1000)),
+            max_turns=int(os.getenv("CHAT_BUFFER_TURNS", 10)),
+            ttl=float(os.getenv("CHAT_BUFFER_TTL", 3600)),
+        )
+        self.writer = ChatHistoryWriter(
+            self.pool,
+            batch_size=int(os.getenv("CHAT_HISTORY_BATCH_SIZE", 100)),
+            flush_interval=float(os.getenv("CHAT_HISTORY_FLUSH_SECONDS", 1.0)),
+            max_queue=int(os.getenv("CHAT_HISTORY_QUEUE_MAX", 10000)),
+        )
+
+    def ensure_indexes(self):
+        """
+        Create the (session_id, time_stamp) index used when a cold session is loaded from the database.
+        """
+        query = """
+        CREATE INDEX IF NOT EXISTS ix_chat_history_session_time
+        ON public.chat_history_table (session_id, time_stamp DESC)
+        """
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query)
+        except psycopg2.Error as e:
+            print(f"Error creating chat history index: {e}")
+
+    def start_session(self, session_id=None, user_id=None):
+        """
+        Return session_id, or a new session id if None. A new session is buffered
+        empty right away, so its first history lookup does not query the database.
+        Sessions are keyed by (user_id, session_id): a session id sent by another
+        user starts an empty history for that user instead of reading the owner's turns.
+        """
+        if session_id:
+            return session_id
+        session_id = str(uuid.uuid4())
+        self.recent_turns.load((user_id, session_id), [])
+        return session_id
+
+    def _remember_turn(self, user_id, session_id, doc_category, question, response, time_stamp=None):
+        self.recent_turns.append((user_id, session_id), {
+            "user_id": user_id,
+            "session_id": session_id,
+            "doc_category": doc_category,
+            "question": question,
+            "response": response,
+            "time_stamp": time_stamp or datetime.datetime.now(),
+        })
+
+    def _history_frame(self, turns, doc_category=None):
+        """The HISTORY_TURNS most recent buffered turns (newest first) as a DataFrame."""
+        if doc_category:
+            turns = [turn for turn in turns if turn["doc_category"] == doc_category]
+        turns = turns[::-1][:self.HISTORY_TURNS]
+        return pd.DataFrame(turns) if turns else pd.DataFrame()
     
     def _get_connection(self):
         """
-        Create and return a new database connection.
-        Uses connection parameters stored in self.conn_params.
+        Borrow a connection from the shared pool.
+        Use as a context manager; the connection is returned to the pool on exit.
+        """
+        return self.pool.connection()
+
+    def _aget_connection(self):
+        """
+        Borrow an async connection from the shared SQLAlchemy engine also used by the PGVector stores.
+        Used by the async chat path so DB I/O does not block the event loop.
         """
-        return psycopg2.connect(**self.conn_params)
+        return get_engine(async_mode=True).connect()
 
+    @timed_stage("history_write")
     def update_chat_history(self, user_id, session_id, doc_category, question, response):
         """
-        Insert a new record into the chat history table.
+        Record a chat turn. The turn is added to the recent-turns buffer and queued
+        for the write-behind writer, so the caller never waits on the database.
+        Write errors are logged by the writer and never fail the answer.
         
         Parameters:
         session_id (str): Unique identifier for the chat session
         doc_category (str): Category of document being discussed
         question (str): User's question
         response (str): System's response
-        time (datetime, optional): Timestamp of the interaction. Defaults to current time if None.
         
         Returns:
-        bool: True if insertion was successful, False otherwise
+        bool: True if the record was queued, False if the queue was full
         """
+        time_stamp = datetime.datetime.now()
+        self._remember_turn(user_id, session_id, doc_category, question, response, time_stamp)
+        return self.writer.enqueue(user_id, session_id, doc_category, question, response, time_stamp)
             
-        # Use parameterized query to properly handle string values
-        query = """
-        INSERT INTO public.chat_history_table 
-        (user_id, session_id, doc_category, question, response)
-        VALUES (%s, %s, %s, %s, %s)
+    async def aupdate_chat_history(self, user_id, session_id, doc_category, question, response):
         """
+        Async version of update_chat_history. Queuing does not block, so it runs inline.
         
+        Returns:
+        bool: True if the record was queued, False if the queue was full
+        """
+        return self.update_chat_history(user_id, session_id, doc_category, question, response)
+
+    def _history_query(self, doc_category=None, session_id=None, user_id=None):
+        """
+        Build the query and parameters used to fetch the 3 most recent chat history entries.
+        """
+        query = "SELECT * FROM public.chat_history_table WHERE 1=1"
+        params = []
+
+        if user_id:
+            query += " AND user_id = %s"
+            params.append(user_id)
+        
+        if doc_category:
+            query += " AND doc_category = %s"
+            params.append(doc_category)
+        
+        if session_id:
+            query += " AND session_id = %s"
+            params.append(session_id)
+        
+        query += " ORDER BY time_stamp DESC LIMIT 3"
+        return query, tuple(params)
+
+    @timed_db("chat_history_load_session")
+    def _load_session(self, session_id, user_id=None):
+        """
+        Load the recent turns of a cold session of user_id from the database into the buffer.
+        Returns the turns oldest first (empty, and nothing buffered, on error).
+        """
         try:
             with self._get_connection() as conn:
-                with conn.cursor() as cur:
-                    # Pass values as a tuple to properly handle quoting and escaping
-                    cur.execute(query, (user_id, session_id, doc_category, question, response))
-                    conn.commit()
-                    print(f"Successfully inserted record for session {session_id}.")
-                    return True
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(self.SESSION_QUERY, (session_id, user_id, self.recent_turns.max_turns))
+                    turns = [dict(row) for row in cur.fetchall()][::-1]
         except psycopg2.Error as e:
-            print(f"Error inserting data: {e}")
-            # Print the actual query and parameters for debugging
-            print(f"Query: {query}")
-            print(f"Parameters: {(session_id, doc_category, question, response)}")
-            raise HTTPException(status_code= status.HTTP_404_NOT_FOUND, detail = str(e))
-            
-    def get_chat_history(self, doc_category=None, session_id=None):
+            print(f"Error retrieving chat history: {e}")
+            return []
+        self.recent_turns.load((user_id, session_id), turns)
+        return turns
+
+    @timed_db("chat_history_load_session")
+    async def _aload_session(self, session_id, user_id=None):
+        """Async version of _load_session."""
+        try:
+            async with self._aget_connection() as conn:
+                result = await conn.exec_driver_sql(self.SESSION_QUERY, (session_id, user_id, self.recent_turns.max_turns))
+                turns = [dict(row) for row in result.mappings().all()][::-1]
+        except SQLAlchemyError as e:
+            print(f"Error retrieving chat history: {e}")
+            return []
+        self.recent_turns.load((user_id, session_id), turns)
+        return turns
+
+    def get_chat_history(self, doc_category=None, session_id=None, user_id=None):
         """
-        Retrieve chat history from the database based on document category.
+        Retrieve chat history based on document category.
         Returns the 3 most recent entries in descending order of timestamp.
+        Sessions are served from the recent-turns buffer; only a cold session hits the database.
         
         Parameters:
         doc_category (str, optional): If provided, retrieves only chats from this category
         session_id (str, optional): If provided, retrieves only chats from this session
+        user_id (str, optional): Owner of the session; only this user's chats are returned
         
         Returns:
         pandas.DataFrame: Contains the retrieved chat history (max 3 records)
         """
+        if session_id:
+            turns = self.recent_turns.get((user_id, session_id))
+            if turns is None:
+                turns = self._load_session(session_id, user_id)
+            return self._history_frame(turns, doc_category)
+
+        query, params = self._history_query(doc_category, session_id, user_id)
         try:
-            with self._get_connection() as conn:
+            with db_operation("chat_history_query"), self._get_connection() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    query = "SELECT * FROM public.chat_history_table WHERE 1=1"
-                    params = []
-                    
-                    if doc_category:
-                        query += " AND doc_category = %s"
-                        params.append(doc_category)
-                    
-                    if session_id:
-                        query += " AND session_id = %s"
-                        params.append(session_id)
-                    
-                    query += " ORDER BY time_stamp DESC LIMIT 3"
-                    
-                    cur.execute(query, tuple(params))
+                    cur.execute(query, params)
                     results = cur.fetchall()
                     df_chat_history = pd.DataFrame(results) if results else pd.DataFrame()
                     return df_chat_history
         except psycopg2.Error as e:
             print(f"Error retrieving chat history: {e}")
             return pd.DataFrame()
+
+    async def aget_chat_history(self, doc_category=None, session_id=None, user_id=None):
+        """
+        Async version of get_chat_history, using the shared async engine.
+        
+        Returns:
+        pandas.DataFrame: Contains the retrieved chat history (max 3 records)
+        """
+        if session_id:
+            turns = self.recent_turns.get((user_id, session_id))
+            if turns is None:
+                turns = await self._aload_session(session_id, user_id)
+            return self._history_frame(turns, doc_category)
+
+        query, params = self._history_query(doc_category, session_id, user_id)
+        try:
+            with db_operation("chat_history_query"):
+                async with self._aget_connection() as conn:
+                    result = await conn.exec_driver_sql(query, params)
+                    results = [dict(row) for row in result.mappings().all()]
+            df_chat_history = pd.DataFrame(results) if results else pd.DataFrame()
+            return df_chat_history
+        except SQLAlchemyError as e:
+            print(f"Error retrieving chat history: {e}")
+            return pd.DataFrame()
@@ -0,0 +1,239 @@
+from services.embedding_cache import EmbeddingCache
+from dotenv import load_dotenv
+from typing import List, Optional, Tuple
+import threading
+import hashlib
+import sqlite3
+import time
+import os
+
+load_dotenv()
+
+CONTENT_CACHE_DIR = os.getenv("CONTENT_CACHE_DIR", os.path.join("saved_files", "content_cache"))
+
+
+def sha256_text(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def sha256_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Hash a file in chunks so large PDFs are never fully loaded in memory."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentCache:
+    """
+    Content-addressed index used by ingestion.
+
+    - file_hashes: SHA-256 of every ingested file per (user_id, doc_type), so an
+      identical file is skipped outright whatever its name. A file being ingested
+      holds a 'running' claim on its hash until it completes.
+    - page_cache: restructured output of table_processing keyed by the SHA-256 of
+      the extracted page text, shared across files and users.
+    - embedding_batches: embedding batches already written for a file being ingested,
+      so an interrupted ingestion resumes after the last committed batch.
+
+    page_cache and embedding_batches are pruned every prune_every writes: pages older
+    than page_ttl (then the oldest above max_pages), and batch markers older than
+    batch_ttl, which only outlive an ingestion that failed and was never resumed.
+    """
+
+    def __init__(self, cache_dir: str, page_ttl: float = 30 * 86400, max_pages: Optional[int] = 50000,
+                 batch_ttl: float = 7 * 86400, prune_every: int = 1000):
+        """
+        Args:
+            cache_dir (str): Directory of content_index.sqlite.
+            page_ttl (float): Seconds a restructured page is kept.
+            max_pages (int, optional): Maximum number of cached pages. Only the TTL applies if None.
+            batch_ttl (float): Seconds the committed-batch markers of an unfinished file are kept.
+            prune_every (int): Writes between two prunes.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.page_ttl = page_ttl
+        self.max_pages = max_pages
+        self.batch_ttl = batch_ttl
+        self.prune_every = prune_every
+        self._writes_since_prune = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "content_index.sqlite"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                file_hash TEXT,
+                user_id TEXT,
+                doc_type TEXT,
+                file_id TEXT,
+                file_name TEXT,
+                created_at REAL,
+                status TEXT DEFAULT 'completed',
+                PRIMARY KEY (file_hash, user_id, doc_type)
+            );
+            CREATE TABLE IF NOT EXISTS page_cache (
+                page_hash TEXT PRIMARY KEY,
+                restructured TEXT,
+                created_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS embedding_batches (
+                file_id TEXT,
+                batch_key TEXT,
+                created_at REAL,
+                PRIMARY KEY (file_id, batch_key)
+            );
+            CREATE INDEX IF NOT EXISTS ix_page_cache_created ON page_cache (created_at);
+            CREATE INDEX IF NOT EXISTS ix_embedding_batches_created ON embedding_batches (created_at);
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(file_hashes)")}
+        if "status" not in columns:
+            self._conn.execute("ALTER TABLE file_hashes ADD COLUMN status TEXT DEFAULT 'completed'")
+        self._conn.commit()
+        self.prune()
+
+    def _wrote(self) -> None:
+        #Caller holds the lock
+        self._writes_since_prune += 1
+
+    def prune(self) -> dict:
+        """Delete expired and surplus cached pages and stale batch markers. Returns the counts."""
+        now = time.time()
+        with self._lock:
+            self._writes_since_prune = 0
+            pages = self._conn.execute(
+                "DELETE FROM page_cache WHERE created_at < ?", (now - self.page_ttl,)
+            ).rowcount
+            if self.max_pages is not None:
+                pages += self._conn.execute(
+                    """DELETE FROM page_cache WHERE page_hash IN (
+                        SELECT page_hash FROM page_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)""",
+                    (self.max_pages,),
+                ).rowcount
+            batches = self._conn.execute(
+                "DELETE FROM embedding_batches WHERE created_at < ?", (now - self.batch_ttl,)
+            ).rowcount
+            self._conn.commit()
+        return {"page_cache": pages, "embedding_batches": batches}
+
+    def find_file(self, file_hash: str, user_id: str, doc_type: str) -> Optional[str]:
+        """Return the file_id of an identical file ingested (or being ingested) for this user and doc_type."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id FROM file_hashes WHERE file_hash = ? AND user_id = ? AND doc_type = ?",
+                (file_hash, user_id, doc_type),
+            ).fetchone()
+        return row[0] if row else None
+
+    def add_file(self, file_hash: str, user_id: str, doc_type: str, file_id: str, file_name: str) -> None:
+        """Record a completed file (replacing its claim, if any)."""
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR REPLACE INTO file_hashes (file_hash, user_id, doc_type, file_id, file_name, created_at, status)
+                VALUES (?, ?, ?, ?, ?, ?, 'completed')""",
+                (file_hash, user_id, doc_type, file_id, file_name, time.time()),
+            )
+            self._conn.commit()
+
+    def claim_file(self, file_hash: str, user_id: str, doc_type: str, file_id: str, file_name: str) -> str:
+        """
+        Claim a hash for file_id before ingesting it, atomically.
+
+        Returns:
+            str: file_id if the claim is ours (new, or left by an earlier run of the same file),
+            otherwise the file_id of the identical file that holds it.
+        """
+        with self._lock:
+            self._conn.execute(
+                """INSERT OR IGNORE INTO file_hashes (file_hash, user_id, doc_type, file_id, file_name, created_at, status)
+                VALUES (?, ?, ?, ?, ?, ?, 'running')""",
+                (file_hash, user_id, doc_type, file_id, file_name, time.time()),
+            )
+            self._conn.commit()
+            row = self._conn.execute(
+                "SELECT file_id FROM file_hashes WHERE file_hash = ? AND user_id = ? AND doc_type = ?",
+                (file_hash, user_id, doc_type),
+            ).fetchone()
+        return row[0]
+
+    def release_file(self, file_hash: str, user_id: str, doc_type: str, file_id: str) -> None:
+        """Drop the claim of a file whose ingestion failed, so an identical file can be ingested."""
+        with self._lock:
+            self._conn.execute(
+                """DELETE FROM file_hashes
+                WHERE file_hash = ? AND user_id = ? AND doc_type = ? AND file_id = ? AND status = 'running'""",
+                (file_hash, user_id, doc_type, file_id),
+            )
+            self._conn.commit()
+
+    def remove_file(self, file_id: str) -> None:
+        """Forget a deleted file, so uploading it again ingests it again."""
+        with self._lock:
+            self._conn.execute("DELETE FROM file_hashes WHERE file_id = ?", (file_id,))
+            self._conn.execute("DELETE FROM embedding_batches WHERE file_id = ?", (file_id,))
+            self._conn.commit()
+
+    def file_owners(self) -> List[Tuple[str, str]]:
+        """(file_id, user_id) of every file in the hash index."""
+        with self._lock:
+            return self._conn.execute("SELECT file_id, user_id FROM file_hashes").fetchall()
+
+    def get_page(self, page_hash: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT restructured FROM page_cache WHERE page_hash = ?", (page_hash,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_page(self, page_hash: str, restructured: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO page_cache VALUES (?, ?, ?)",
+                (page_hash, restructured, time.time()),
+            )
+            self._conn.commit()
+            self._wrote()
+        if self._writes_since_prune >= self.prune_every:
+            self.prune()
+
+    def is_batch_committed(self, file_id: str, batch_key: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM embedding_batches WHERE file_id = ? AND batch_key = ?", (file_id, batch_key)
+            ).fetchone()
+        return row is not None
+
+    def mark_batch_committed(self, file_id: str, batch_key: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO embedding_batches VALUES (?, ?, ?)", (file_id, batch_key, time.time())
+            )
+            self._conn.commit()
+            self._wrote()
+        if self._writes_since_prune >= self.prune_every:
+            self.prune()
+
+    def clear_batches(self, file_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM embedding_batches WHERE file_id = ?", (file_id,))
+            self._conn.commit()
+
+
+content_cache = ContentCache(
+    CONTENT_CACHE_DIR,
+    page_ttl=float(os.getenv("PAGE_CACHE_TTL", 30 * 86400)),
+    max_pages=int(os.getenv("PAGE_CACHE_MAX_PAGES", 50000)),
+    batch_ttl=float(os.getenv("EMBED_BATCH_MARKER_TTL", 7 * 86400)),
+)
+
+# Embeddings of ingested texts (pages and chunks), reused for identical text across files and users.
+# Memory holds the recent ones (about 6 KB each at 1536 dimensions); the disk tier keeps more.
+document_embedding_cache = EmbeddingCache(
+    max_size=int(os.getenv("DOCUMENT_EMBED_CACHE_SIZE", 2000)),
+    ttl=float(os.getenv("DOCUMENT_EMBED_CACHE_TTL", 30 * 86400)),
+    cache_dir=CONTENT_CACHE_DIR,
+    db_name="document_embeddings.sqlite",
+    max_disk_entries=int(os.getenv("DOCUMENT_EMBED_CACHE_DISK_SIZE", 200000)),
+)
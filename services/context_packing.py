@@ -0,0 +1,212 @@
+from langchain_core.documents import Document
+from dotenv import load_dotenv
+from typing import List, Optional, Tuple
+import threading
+import tiktoken
+import re
+import os
+
+load_dotenv()
+
+#Token budget of the context block of the answer prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+#Parent pages are cut into passages of about this many tokens before ranking
+CONTEXT_PASSAGE_TOKENS = int(os.getenv("CONTEXT_PASSAGE_TOKENS", 256))
+#Passages sharing at least this share of token 8-grams with a kept passage are dropped
+CONTEXT_NEAR_DUPLICATE = float(os.getenv("CONTEXT_NEAR_DUPLICATE", 0.8))
+#Tokenizer of the answer model (GPT-4o)
+CONTEXT_ENCODING = os.getenv("CONTEXT_ENCODING", "o200k_base")
+
+SHINGLE_SIZE = 8
+
+
+class Passage:
+
+    def __init__(self, text: str, tokens: List[int], source_key: str, label: str,
+                 score: Optional[float], parent_rank: int, position: int):
+        self.text = text
+        self.tokens = tokens
+        self.source_key = source_key
+        self.label = label
+        self.score = score
+        self.parent_rank = parent_rank
+        self.position = position
+        self.shingles = {tuple(tokens[ix:ix + SHINGLE_SIZE]) for ix in range(max(1, len(tokens) - SHINGLE_SIZE + 1))}
+
+    def rank_key(self):
+        #Passages holding a retrieved chunk first (best chunk score first), then by parent rank and position
+        return (self.score is None, -(self.score or 0.0), self.parent_rank, self.position)
+
+
+class PackedContext:
+    """Context block of the answer prompt and its token accounting."""
+
+    def __init__(self, text: str, sources: List[str], packed_tokens: int, raw_tokens: int,
+                 passages_used: int, passages_dropped_duplicate: int, passages_dropped_budget: int):
+        self.text = text
+        self.sources = sources
+        self.packed_tokens = packed_tokens
+        self.raw_tokens = raw_tokens
+        self.tokens_saved = max(0, raw_tokens - packed_tokens)
+        self.passages_used = passages_used
+        self.passages_dropped_duplicate = passages_dropped_duplicate
+        self.passages_dropped_budget = passages_dropped_budget
+
+    def summary(self) -> dict:
+        return {
+            "packed_tokens": self.packed_tokens,
+            "raw_tokens": self.raw_tokens,
+            "tokens_saved": self.tokens_saved,
+            "passages_used": self.passages_used,
+            "passages_dropped_duplicate": self.passages_dropped_duplicate,
+            "passages_dropped_budget": self.passages_dropped_budget,
+            "sources": len(self.sources),
+        }
+
+
+class ContextPacker:
+    """
+    Build the answer context from retrieval results within a token budget.
+
+    Parent pages are cut into passages and ranked: passages containing a retrieved child
+    chunk come first (by chunk score), then the rest of the best parents. Child chunks of
+    parents that did not make the cut compete as passages of their own. Exact and near
+    duplicate passages (repeated headers, overlapping pages) are dropped, and the kept
+    passages are grouped per source under compact [n] citation labels.
+    """
+
+    def __init__(self, budget_tokens: int = CONTEXT_TOKEN_BUDGET, passage_tokens: int = CONTEXT_PASSAGE_TOKENS,
+                 near_duplicate: float = CONTEXT_NEAR_DUPLICATE, encoding_name: str = CONTEXT_ENCODING):
+        """
+        Args:
+            budget_tokens (int): Maximum tokens of the packed context.
+            passage_tokens (int): Target passage size.
+            near_duplicate (float): Shingle overlap from which a passage counts as a duplicate.
+            encoding_name (str): tiktoken encoding used to count tokens.
+        """
+        self.budget_tokens = budget_tokens
+        self.passage_tokens = passage_tokens
+        self.near_duplicate = near_duplicate
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        #Loaded on first use, so importing the module never loads (or downloads) the tokenizer
+        if self._encoding is None:
+            with self._lock:
+                if self._encoding is None:
+                    self._encoding = tiktoken.get_encoding(self.encoding_name)
+        return self._encoding
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    @staticmethod
+    def source_label(metadata: dict) -> str:
+        source = metadata.get("source") or f"document {str(metadata.get('document_id', ''))[:8]}"
+        page = metadata.get("page")
+        return f"{source}, p. {page}" if page else source
+
+    def split_passages(self, text: str) -> List[Tuple[str, List[int]]]:
+        """Cut text on line breaks into passages of about passage_tokens tokens; longer lines are cut by tokens."""
+        passages = []
+        current, current_tokens = [], []
+        for line in re.split(r"\n\s*\n|\n", text):
+            line = line.strip()
+            if not line:
+                continue
+            tokens = self.encoding.encode(line)
+            if current and len(current_tokens) + len(tokens) > self.passage_tokens:
+                passages.append(("\n".join(current), current_tokens))
+                current, current_tokens = [], []
+            if len(tokens) > self.passage_tokens:
+                for start in range(0, len(tokens), self.passage_tokens):
+                    piece = tokens[start:start + self.passage_tokens]
+                    passages.append((self.encoding.decode(piece), piece))
+                continue
+            current.append(line)
+            current_tokens = current_tokens + tokens
+        if current:
+            passages.append(("\n".join(current), current_tokens))
+        return passages
+
+    def candidates(self, child_chunks: List[Tuple[Document, float]], parent_docs: List[Document]) -> List[Passage]:
+        chunks_by_parent = {}
+        for chunk, score in child_chunks:
+            chunks_by_parent.setdefault(chunk.metadata.get("document_id"), []).append((chunk, score))
+
+        passages = []
+        for parent_rank, parent in enumerate(parent_docs):
+            document_id = parent.metadata.get("document_id")
+            label = self.source_label(parent.metadata)
+            chunks = chunks_by_parent.pop(document_id, [])
+            for position, (text, tokens) in enumerate(self.split_passages(parent.page_content)):
+                flat = " ".join(text.split())
+                hits = [score for chunk, score in chunks if " ".join(chunk.page_content.split())[:80] in flat]
+                passages.append(Passage(text, tokens, document_id, label, max(hits) if hits else None,
+                                        parent_rank, position))
+
+        #Chunks of pages that were not fetched as parents
+        for document_id, chunks in chunks_by_parent.items():
+            for position, (chunk, score) in enumerate(chunks):
+                tokens = self.encoding.encode(chunk.page_content)
+                passages.append(Passage(chunk.page_content, tokens, document_id, self.source_label(chunk.metadata),
+                                        score, len(parent_docs), position))
+        return passages
+
+    def _is_duplicate(self, passage: Passage, kept: List[Passage], seen_texts: set) -> bool:
+        normalized = " ".join(passage.text.lower().split())
+        if normalized in seen_texts:
+            return True
+        for other in kept:
+            if normalized in " ".join(other.text.lower().split()):
+                return True
+            overlap = len(passage.shingles & other.shingles) / max(1, min(len(passage.shingles), len(other.shingles)))
+            if overlap >= self.near_duplicate:
+                return True
+        return False
+
+    def pack(self, child_chunks: List[Tuple[Document, float]], parent_docs: List[Document]) -> PackedContext:
+        """
+        Args:
+            child_chunks: (chunk, score) pairs from the child search.
+            parent_docs: Parent pages, best first.
+
+        Returns:
+            PackedContext: The context text and token accounting. raw_tokens is the size of the
+            unpacked retrieval output, as it used to be put in the prompt.
+        """
+        raw_tokens = self.count_tokens(str((child_chunks, [parent.page_content for parent in parent_docs])))
+
+        kept, seen_texts = [], set()
+        used_tokens = dropped_duplicate = dropped_budget = 0
+        for passage in sorted(self.candidates(child_chunks, parent_docs), key=Passage.rank_key):
+            if self._is_duplicate(passage, kept, seen_texts):
+                dropped_duplicate += 1
+                continue
+            if used_tokens + len(passage.tokens) > self.budget_tokens:
+                dropped_budget += 1
+                continue
+            kept.append(passage)
+            seen_texts.add(" ".join(passage.text.lower().split()))
+            used_tokens += len(passage.tokens)
+
+        #Sources numbered by their best passage; passages of a source in page order
+        source_order = []
+        for passage in kept:
+            if passage.source_key not in source_order:
+                source_order.append(passage.source_key)
+        blocks, sources = [], []
+        for number, source_key in enumerate(source_order, start=1):
+            passages = sorted((p for p in kept if p.source_key == source_key), key=lambda p: p.position)
+            sources.append(f"[{number}] {passages[0].label}")
+            blocks.append(f"[{number}] {passages[0].label}\n" + "\n...\n".join(p.text for p in passages))
+        text = "\n\n".join(blocks)
+
+        return PackedContext(text, sources, self.count_tokens(text), raw_tokens, len(kept),
+                             dropped_duplicate, dropped_budget)
+
+
+context_packer = ContextPacker()
@@ -0,0 +1,241 @@
+from contextlib import contextmanager
+from psycopg2 import pool as pg_pool
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine
+from dotenv import load_dotenv
+from typing import Optional, Tuple
+import threading
+import psycopg2
+import time
+import os
+
+load_dotenv()
+
+def get_conn_params():
+    """
+    PostgreSQL connection parameters shared by every pooled connection.
+    """
+    return {
+        "dbname": os.getenv("DATABASE_NAME"),   # Database name
+        "user": os.getenv("DB_USER"),           # PostgreSQL username
+        "password": os.getenv("DB_PASSWORD"),   # PostgreSQL password
+        "host": os.getenv("HOST"),              # Database host
+        "port": os.getenv("PORT")               # Default PostgreSQL port
+    }
+
+
+class ConnectionPool:
+    """
+    Process-wide pool of psycopg2 connections.
+
+    connection() blocks while all max_size connections are in use (up to `timeout`
+    seconds), checks idle connections before handing them out, and commits or rolls
+    back the transaction when the block exits.
+    """
+
+    def __init__(self, conn_params: dict, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 30, health_check_after: float = 30):
+        """
+        Args:
+            conn_params (dict): psycopg2.connect keyword arguments.
+            min_size (int): Connections opened when the pool is created.
+            max_size (int): Upper bound on open connections.
+            timeout (float): Seconds to wait for a free connection before raising.
+            health_check_after (float): Idle seconds after which a connection is pinged before reuse.
+        """
+        self.conn_params = conn_params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used = {}
+
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.health_check_failures = 0
+
+    def _get_pool(self):
+        # Created on first use so importing a module never opens a connection
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = pg_pool.ThreadedConnectionPool(self.min_size, self.max_size, **self.conn_params)
+        return self._pool
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.waits += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                raise pg_pool.PoolError(f"No database connection available after {self.timeout}s")
+
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            while not self._is_healthy(conn):
+                with self._lock:
+                    self.health_check_failures += 1
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_seconds += time.monotonic() - started
+        return conn
+
+    def _checkin(self, conn, broken=False):
+        close = broken or bool(conn.closed)
+        if close:
+            self._last_used.pop(id(conn), None)
+        else:
+            self._last_used[id(conn)] = time.monotonic()
+        try:
+            self._get_pool().putconn(conn, close=close)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a `with` block.
+        The transaction is committed on success and rolled back on error.
+        """
+        conn = self._checkout()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            self._checkin(conn, broken)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "in_use": self.in_use,
+                "idle": len(self._pool._pool) if self._pool is not None else 0,
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_seconds": round(self.wait_seconds, 6),
+                "health_check_failures": self.health_check_failures,
+            }
+
+
+db_pool = ConnectionPool(
+    get_conn_params(),
+    min_size=int(os.getenv("DB_POOL_MIN", 1)),
+    max_size=int(os.getenv("DB_POOL_MAX", 10)),
+    timeout=float(os.getenv("DB_POOL_TIMEOUT", 30)),
+)
+
+# SQLAlchemy engines shared by every PGVector store (and the async chat history writes)
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_engine(async_mode: bool = False):
+    """
+    Return the process-wide SQLAlchemy engine for DATABASE_URL, creating it on first use.
+    """
+    with _engines_lock:
+        if async_mode not in _engines:
+            engine_args = {
+                "pool_size": int(os.getenv("DB_POOL_MAX", 10)),
+                "max_overflow": 0,
+                "pool_pre_ping": True,
+                "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+            }
+            if async_mode:
+                engine = create_async_engine(os.getenv("DATABASE_URL"), **engine_args)
+                event.listen(engine.sync_engine, "connect", _apply_vector_search_settings)
+            else:
+                engine = create_engine(os.getenv("DATABASE_URL"), **engine_args)
+                event.listen(engine, "connect", _apply_vector_search_settings)
+            _engines[async_mode] = engine
+        return _engines[async_mode]
+
+#Minimum pgvector version with iterative index scans
+ITERATIVE_SCAN_MIN_VERSION = (0, 8, 0)
+
+def pgvector_version(cursor) -> Optional[Tuple[int, ...]]:
+    """Installed pgvector version as a tuple, or None if the extension is missing."""
+    cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return tuple(int(part) for part in row[0].split(".") if part.isdigit())
+
+def _apply_vector_search_settings(dbapi_connection, connection_record):
+    """
+    Apply ANN query-time tuning to every new connection:
+    VECTOR_EF_SEARCH (HNSW candidate list size), VECTOR_IVFFLAT_PROBES (IVFFlat lists probed)
+    and VECTOR_ITERATIVE_SCAN (default relaxed_order, "off" to disable).
+
+    Retrieval always filters by tenant (user_id, doc_type). Without iterative scans an ANN
+    index returns its ef_search / probes candidates and the filter is applied afterwards, so
+    a small tenant in a large table gets fewer than k chunks, or none. Iterative scans
+    (pgvector >= 0.8.0; skipped on older versions) keep scanning the index until k rows pass
+    the filter.
+    """
+    settings = {"hnsw.ef_search": os.getenv("VECTOR_EF_SEARCH"), "ivfflat.probes": os.getenv("VECTOR_IVFFLAT_PROBES")}
+    settings = {name: int(value) for name, value in settings.items() if value}
+    iterative_scan = os.getenv("VECTOR_ITERATIVE_SCAN", "relaxed_order")
+    if iterative_scan not in ("off", "relaxed_order", "strict_order"):
+        raise ValueError(f"Unknown VECTOR_ITERATIVE_SCAN: {iterative_scan}")
+
+    cursor = dbapi_connection.cursor()
+    if iterative_scan != "off":
+        version = pgvector_version(cursor)
+        if version is not None and version >= ITERATIVE_SCAN_MIN_VERSION:
+            settings["hnsw.iterative_scan"] = iterative_scan
+            #IVFFlat only supports relaxed ordering
+            if iterative_scan == "relaxed_order":
+                settings["ivfflat.iterative_scan"] = iterative_scan
+    for name, value in settings.items():
+        cursor.execute(f"SET {name} = {value}")
+    cursor.close()
+    dbapi_connection.commit()
+
+def engine_stats() -> dict:
+    """Checked-out and idle connection counts of the shared SQLAlchemy engines."""
+    stats = {}
+    for async_mode, engine in list(_engines.items()):
+        engine_pool = engine.pool
+        stats["async" if async_mode else "sync"] = {
+            "size": engine_pool.size(),
+            "checked_out": engine_pool.checkedout(),
+            "checked_in": engine_pool.checkedin(),
+        }
+    return stats
@@ -0,0 +1,171 @@
+from services.user_doc_types import DatabaseOperations
+from services.db_pool import get_conn_params
+from dotenv import load_dotenv
+from typing import List, Optional, Tuple
+import threading
+import psycopg2
+import select
+import time
+import os
+
+load_dotenv()
+
+#Key of the doc_types of all users
+ALL_USERS = None
+
+class DocTypeCatalog:
+    """
+    In-memory catalog of the doc_types of each user, in front of user_doc_type_tbl.
+
+    Entries expire after ttl seconds. Adding an option invalidates the user's entry
+    right away, and NOTIFYs `channel` with the user_id in the inserting transaction;
+    every process running listen() drops that user's entry when the notification
+    arrives, so other workers see the new option without waiting for the TTL.
+    Each key has a generation bumped by invalidate(); a database read that raced
+    an invalidation is returned but not cached.
+    """
+
+    def __init__(self, db_op: DatabaseOperations, ttl: float = 300, channel: str = "user_doc_type_changed"):
+        """
+        Args:
+            db_op (DatabaseOperations): Database access.
+            ttl (float): Seconds an entry is served without asking Postgres.
+            channel (str): LISTEN/NOTIFY channel of doc_type changes.
+        """
+        self.db_op = db_op
+        self.ttl = ttl
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._entries = {}
+        #Per-key generation, and an epoch bumped when every entry is dropped
+        self._generations = {}
+        self._epoch = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.notifications = 0
+        self.listening = False
+
+    def _cached(self, key) -> Tuple[Optional[List[str]], tuple]:
+        """Return (doc_types or None on a miss, generation of the key to pass to _store)."""
+        with self._lock:
+            generation = (self._epoch, self._generations.get(key, 0))
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+                self.hits += 1
+                return list(entry[0]), generation
+            self.misses += 1
+            return None, generation
+
+    def _store(self, key, doc_types: List[str], generation: tuple) -> None:
+        with self._lock:
+            #Invalidated while the database was read: the result may predate the change
+            if generation != (self._epoch, self._generations.get(key, 0)):
+                return
+            self._entries[key] = (list(doc_types), time.monotonic())
+
+    def get(self, user_id: str) -> dict:
+        """Doc types of a user, as {"user_id": .., "doc_type": [..]}."""
+        doc_types, generation = self._cached(user_id)
+        if doc_types is None:
+            doc_types = self.db_op.extract_table_data_by_user_id(user_id)["doc_type"]
+            self._store(user_id, doc_types, generation)
+        return {"user_id": user_id, "doc_type": doc_types}
+
+    def all_doc_types(self) -> List[str]:
+        """Distinct doc types of all users."""
+        doc_types, generation = self._cached(ALL_USERS)
+        if doc_types is None:
+            doc_types = self.db_op.extract_doc_types()
+            self._store(ALL_USERS, doc_types, generation)
+        return doc_types
+
+    def add(self, user_id: str, doc_type: str) -> bool:
+        """Add a doc type for a user. Returns False if the user already had it."""
+        inserted = self.db_op.update_table_data(user_id, doc_type, notify_channel=self.channel)
+        if inserted:
+            self.invalidate(user_id)
+        return inserted
+
+    def invalidate(self, user_id: Optional[str] = None) -> None:
+        """Drop a user's entry (and the all-users list), or every entry without a user_id."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._generations.clear()
+                self._epoch += 1
+            else:
+                self._entries.pop(user_id, None)
+                self._entries.pop(ALL_USERS, None)
+                for key in (user_id, ALL_USERS):
+                    self._generations[key] = self._generations.get(key, 0) + 1
+            self.invalidations += 1
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self.listen, name="doc-type-catalog-listener", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def listen(self):
+        """
+        LISTEN on the channel over a dedicated connection (not a pooled one: it is held for the
+        life of the process) and invalidate on every notification. After a reconnect the whole
+        catalog is dropped, since notifications sent while disconnected are lost.
+        """
+        retry_delay = 1
+        while not self._stopping.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**get_conn_params())
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{self.channel}";')
+                self.invalidate()
+                self.listening = True
+                retry_delay = 1
+
+                while not self._stopping.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self.notifications += 1
+                        self.invalidate(notify.payload or None)
+            except Exception as e:
+                #Any error (not only psycopg2's) reconnects instead of ending the listener thread
+                print(f"Doc type catalog listener disconnected, retrying in {retry_delay}s: {e}")
+                self._stopping.wait(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+            finally:
+                self.listening = False
+                if conn is not None:
+                    conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "notifications": self.notifications,
+                "listening": int(self.listening),
+            }
+
+
+doc_type_catalog = DocTypeCatalog(
+    DatabaseOperations(),
+    ttl=float(os.getenv("DOC_TYPE_CACHE_TTL", 300)),
+    channel=os.getenv("DOC_TYPE_NOTIFY_CHANNEL", "user_doc_type_changed"),
+)
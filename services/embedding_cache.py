@@ -0,0 +1,217 @@
+from collections import OrderedDict
+from langchain_core.embeddings import Embeddings
+from services.metrics import stage, record_embedding_request
+from dotenv import load_dotenv
+from typing import List, Optional
+from array import array
+import unicodedata
+import threading
+import hashlib
+import sqlite3
+import time
+import os
+
+load_dotenv()
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize text before it is used as a cache key, so that the same question
+    typed with different spacing or unicode forms maps to the same entry.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split())
+
+
+class EmbeddingCache:
+    """
+    Bounded in-memory LRU cache of embedding vectors with TTL eviction,
+    optionally backed by a sqlite file on disk so entries survive restarts.
+
+    Vectors are held as packed float32 arrays (4 bytes per dimension instead of a
+    list of Python floats), in memory and on disk. The disk tier is pruned of
+    expired entries, and down to max_disk_entries, every prune_every writes.
+    """
+
+    def __init__(self, max_size: int = 2048, ttl: float = 86400, cache_dir: Optional[str] = None,
+                 db_name: str = "embeddings.sqlite", max_disk_entries: Optional[int] = None,
+                 prune_every: int = 1000):
+        """
+        Args:
+            max_size (int): Maximum number of vectors kept in memory.
+            ttl (float): Seconds an entry stays valid, in memory and on disk.
+            cache_dir (str, optional): Directory for the on-disk tier. Disabled if None.
+            db_name (str): File name of the on-disk tier inside cache_dir.
+            max_disk_entries (int, optional): Maximum number of vectors kept on disk (oldest
+                are deleted first). Only the TTL applies if None.
+            prune_every (int): Disk writes between two prunes of the disk tier.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.prune_every = prune_every
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes_since_prune = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_pruned = 0
+
+        self._disk = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._disk = sqlite3.connect(os.path.join(cache_dir, db_name), check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            #Schema 1: vectors moved from float64 blobs in `embeddings` to float32 in `embeddings_f32`
+            if self._disk.execute("PRAGMA user_version").fetchone()[0] < 1:
+                self._disk.execute("DROP TABLE IF EXISTS embeddings")
+                self._disk.execute("PRAGMA user_version = 1")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings_f32 (key TEXT PRIMARY KEY, vector BLOB, created REAL)"
+            )
+            self._disk.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_f32_created ON embeddings_f32 (created)")
+            self._disk.commit()
+            self.prune()
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                vector, created = entry
+                if now - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return vector.tolist()
+                del self._entries[key]
+
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT vector, created FROM embeddings_f32 WHERE key = ?", (key,)
+                ).fetchone()
+                if row and now - row[1] <= self.ttl:
+                    vector = array("f", row[0])
+                    self._put(key, vector, row[1])
+                    self.disk_hits += 1
+                    return vector.tolist()
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, vector: List[float]) -> None:
+        created = time.time()
+        packed = array("f", vector)
+        with self._lock:
+            self._put(key, packed, created)
+            if self._disk is not None:
+                self._disk.execute(
+                    "INSERT OR REPLACE INTO embeddings_f32 (key, vector, created) VALUES (?, ?, ?)",
+                    (key, packed.tobytes(), created),
+                )
+                self._disk.commit()
+                self._writes_since_prune += 1
+        if self._writes_since_prune >= self.prune_every:
+            self.prune()
+
+    def prune(self) -> int:
+        """Delete expired disk entries, then the oldest ones above max_disk_entries. Returns the count."""
+        if self._disk is None:
+            return 0
+        with self._lock:
+            self._writes_since_prune = 0
+            deleted = self._disk.execute(
+                "DELETE FROM embeddings_f32 WHERE created < ?", (time.time() - self.ttl,)
+            ).rowcount
+            if self.max_disk_entries is not None:
+                deleted += self._disk.execute(
+                    """DELETE FROM embeddings_f32 WHERE key IN (
+                        SELECT key FROM embeddings_f32 ORDER BY created DESC LIMIT -1 OFFSET ?)""",
+                    (self.max_disk_entries,),
+                ).rowcount
+            self._disk.commit()
+            self.disk_pruned += deleted
+            return deleted
+
+    def _put(self, key, vector, created):
+        self._entries[key] = (vector, created)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "disk_pruned": self.disk_pruned,
+                "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that serves repeated query embeddings from an EmbeddingCache.
+    Document embeddings are passed straight through to the wrapped model.
+    """
+
+    def __init__(self, embed: Embeddings, cache: EmbeddingCache, model_name: Optional[str] = None):
+        self.embed = embed
+        self.cache = cache
+        self.model_name = model_name or getattr(embed, "model", None) or type(embed).__name__
+
+    def __getattr__(self, name):
+        # Expose attributes of the wrapped model (e.g. embedding_ctx_length)
+        if name == "embed":
+            raise AttributeError(name)
+        return getattr(self.embed, name)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self.cache.make_key(self.model_name, text)
+        vector = self.cache.get(key)
+        if vector is None:
+            record_embedding_request("query", 1)
+            with stage("embed_query"):
+                vector = self.embed.embed_query(text)
+            self.cache.set(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self.cache.make_key(self.model_name, text)
+        vector = self.cache.get(key)
+        if vector is None:
+            record_embedding_request("query", 1)
+            with stage("embed_query"):
+                vector = await self.embed.aembed_query(text)
+            self.cache.set(key, vector)
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        record_embedding_request("documents", len(texts))
+        with stage("embed_documents"):
+            return self.embed.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        record_embedding_request("documents", len(texts))
+        with stage("embed_documents"):
+            return await self.embed.aembed_documents(texts)
+
+
+# Process-wide cache shared by every CachedEmbeddings built through Call_Models
+query_embedding_cache = EmbeddingCache(
+    max_size=int(os.getenv("EMBED_CACHE_SIZE", 2048)),
+    ttl=float(os.getenv("EMBED_CACHE_TTL", 86400)),
+    cache_dir=os.getenv("EMBED_CACHE_DIR"),
+)
@@ -1,16 +1,142 @@
 from dotenv import load_dotenv
 from langchain_openai import AzureChatOpenAI,AzureOpenAIEmbeddings
+from services.embedding_cache import CachedEmbeddings, query_embedding_cache
+from langchain_core.embeddings import Embeddings
+from openai import RateLimitError
+from typing import List
+import threading
+import asyncio
+import random
+import time
 import os
 
 load_dotenv()
 
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 5))
+BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", 1))
+BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", 60))
+
+def call_with_backoff(fn, *args, **kwargs):
+    """
+    Call fn(*args, **kwargs), retrying on 429 rate limit errors with exponential backoff
+    and jitter. A Retry-After header from the service takes precedence over the computed delay.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except RateLimitError as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1)
+            retry_after = e.response.headers.get("retry-after") if e.response is not None else None
+            if retry_after:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    pass
+            print(f"Rate limited, retrying in {delay:.1f}s (attempt {attempt + 1} of {MAX_RETRIES})")
+            time.sleep(delay)
+
+class RateLimiter:
+    """
+    Token bucket shared by every caller of a model: at most `per_minute` units per minute,
+    with bursts up to one second's worth. acquire() blocks until enough units are available.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate)
+        self._available = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount: float) -> float:
+        #Returns the seconds to wait; the units are taken right away so waiters queue up fairly
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(self.capacity, self._available + (now - self._updated) * self.rate)
+            self._updated = now
+            self._available -= amount
+            return 0.0 if self._available >= 0 else -self._available / self.rate
+
+    def acquire(self, amount: float = 1) -> None:
+        delay = self._reserve(amount)
+        if delay:
+            time.sleep(delay)
+
+    async def aacquire(self, amount: float = 1) -> None:
+        delay = self._reserve(amount)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class RateLimitedChatModel:
+    """Chat model wrapper that takes one request from `requests` before every call."""
+
+    def __init__(self, llm, requests: RateLimiter):
+        self.llm = llm
+        self.requests = requests
+
+    def __getattr__(self, name):
+        if name == "llm":
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    def invoke(self, *args, **kwargs):
+        self.requests.acquire()
+        return self.llm.invoke(*args, **kwargs)
+
+    async def ainvoke(self, *args, **kwargs):
+        await self.requests.aacquire()
+        return await self.llm.ainvoke(*args, **kwargs)
+
+    async def astream(self, *args, **kwargs):
+        await self.requests.aacquire()
+        async for chunk in self.llm.astream(*args, **kwargs):
+            yield chunk
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper limiting requests per minute and, with `tokens`, input tokens per
+    minute (counted with count_tokens), matching the RPM/TPM quotas of the deployment.
+    """
+
+    def __init__(self, embed: Embeddings, requests: RateLimiter, tokens: RateLimiter = None, count_tokens=None):
+        self.embed = embed
+        self.requests = requests
+        self.tokens = tokens
+        self.count_tokens = count_tokens or (lambda text: len(text) // 4 + 1)
+
+    def __getattr__(self, name):
+        #Expose attributes of the wrapped model (model_name, embedding_ctx_length)
+        if name == "embed":
+            raise AttributeError(name)
+        return getattr(self.embed, name)
+
+    def _acquire(self, texts: List[str]) -> None:
+        self.requests.acquire()
+        if self.tokens is not None:
+            self.tokens.acquire(sum(self.count_tokens(text) for text in texts))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._acquire(texts)
+        return self.embed.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        self._acquire([text])
+        return self.embed.embed_query(text)
+
+
 class Call_Models:
     def __init__(self):
         pass
 
     def get_open_ai_model(self):
+        #stream_usage: streamed answers report token usage in their last chunk
         llm = AzureChatOpenAI(azure_deployment= "gpt-4o",
-                          temperature=0)
+                          temperature=0,
+                          stream_usage=True)
         
         embed = AzureOpenAIEmbeddings(
                 model=os.getenv("EMBEDDING_MODEL"),
@@ -19,6 +145,9 @@ class Call_Models:
                 openai_api_version=os.getenv("AZURE_OPENAI_API_VERSION")
             )
         
+        #Repeated questions are served from the shared query embedding cache
+        embed = CachedEmbeddings(embed, query_embedding_cache, model_name=os.getenv("EMBEDDING_MODEL"))
+        
         return llm,embed
 
 
@@ -0,0 +1,306 @@
+from concurrent.futures import ThreadPoolExecutor
+from services.pdf_preprocessing import PDF_reader
+from services.content_cache import content_cache, sha256_file
+from services.answer_cache import answer_cache
+from services.user_doc_types import DatabaseOperations
+from dotenv import load_dotenv
+from typing import List, Tuple, Optional
+import threading
+import sqlite3
+import socket
+import json
+import uuid
+import time
+import os
+
+load_dotenv()
+
+class IngestionJobs:
+    """
+    Persistent queue of PDF ingestion jobs.
+
+    Every upload becomes one job with one row per file in a local sqlite database,
+    and files are processed by a bounded thread pool off the request path.
+
+    The database is shared by every worker process. A process claims a file with a
+    conditional UPDATE that records it as owner (hostname:pid:random) with a lease, and renews
+    the leases of its running files every lease_seconds / 3. start() picks up queued
+    files and running files whose lease expired (their process died), so a restarting
+    worker never re-runs a file that a live process is still ingesting.
+    """
+
+    def __init__(self, db_path: str, max_workers: int = 2, lease_seconds: float = 120):
+        """
+        Args:
+            db_path (str): Path of the sqlite file holding the job queue.
+            max_workers (int): Number of files ingested concurrently.
+            lease_seconds (float): Seconds a running file stays owned without a heartbeat.
+        """
+        self.db_path = db_path
+        self.max_workers = max_workers
+        self.lease_seconds = lease_seconds
+        #The random part tells apart a restarted process that got the same pid (pid 1 in containers)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.executor = None
+        self.db_op = DatabaseOperations()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._heartbeat = None
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS ingestion_jobs (
+                job_id TEXT PRIMARY KEY,
+                user_id TEXT,
+                doc_type TEXT,
+                created_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS ingestion_job_files (
+                job_id TEXT,
+                file_name TEXT,
+                file_path TEXT,
+                file_id TEXT,
+                status TEXT,
+                stage TEXT,
+                pages_done INTEGER DEFAULT 0,
+                pages_total INTEGER DEFAULT 0,
+                error TEXT,
+                result TEXT,
+                updated_at REAL,
+                PRIMARY KEY (job_id, file_name)
+            );
+            CREATE INDEX IF NOT EXISTS ix_ingestion_job_files_file_id ON ingestion_job_files (file_id);
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(ingestion_job_files)")}
+        for column, column_type in (("owner", "TEXT"), ("lease_until", "REAL")):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE ingestion_job_files ADD COLUMN {column} {column_type}")
+        self._conn.commit()
+
+    def _execute(self, query, params=()):
+        with self._lock:
+            cur = self._conn.execute(query, params)
+            self._conn.commit()
+            return cur.fetchall()
+
+    def _execute_update(self, query, params=()) -> int:
+        """Run an UPDATE and return the number of rows it changed."""
+        with self._lock:
+            cur = self._conn.execute(query, params)
+            self._conn.commit()
+            return cur.rowcount
+
+    def start(self):
+        """
+        Start the worker pool and the lease heartbeat, and pick up queued files and files
+        whose owner stopped renewing its lease.
+        """
+        if self.executor is not None:
+            return
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ingestion")
+        self._stopping.clear()
+        self._heartbeat = threading.Thread(target=self._renew_leases, name="ingestion-lease", daemon=True)
+        self._heartbeat.start()
+
+        #Queued files may also sit in another live process's pool: _run_file's claim lets only one run them
+        pending = self._execute(
+            """SELECT job_id, file_name FROM ingestion_job_files
+            WHERE status = 'queued' OR (status = 'running' AND coalesce(lease_until, 0) < ?)""",
+            (time.time(),),
+        )
+        for row in pending:
+            print(f"Resuming ingestion of {row['file_name']} (job {row['job_id']})")
+            self.executor.submit(self._run_file, row["job_id"], row["file_name"])
+
+    def stop(self):
+        """
+        Stop accepting work and renewing leases. Files in progress are picked up by any
+        process's start() once their lease expires.
+        """
+        self._stopping.set()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def _renew_leases(self):
+        while not self._stopping.wait(self.lease_seconds / 3):
+            try:
+                self._execute_update(
+                    "UPDATE ingestion_job_files SET lease_until = ? WHERE owner = ? AND status = 'running'",
+                    (time.time() + self.lease_seconds, self.owner),
+                )
+            except sqlite3.Error as e:
+                print(f"Error renewing ingestion leases: {e}")
+
+    def _claim_file(self, job_id, file_name) -> bool:
+        """Take a queued file (or one whose lease expired) for this process. False if another process owns it."""
+        now = time.time()
+        return bool(self._execute_update(
+            """UPDATE ingestion_job_files
+            SET status = 'running', stage = 'parsing', error = NULL, owner = ?, lease_until = ?, updated_at = ?
+            WHERE job_id = ? AND file_name = ?
+              AND (status = 'queued' OR (status = 'running' AND coalesce(lease_until, 0) < ?))""",
+            (self.owner, now + self.lease_seconds, now, job_id, file_name, now),
+        ))
+
+    def create_job(self, user_id: str, doc_type: str, files: List[Tuple[str, str]],
+                   file_ids: Optional[List[str]] = None) -> str:
+        """
+        Record a new job and queue its files.
+
+        Args:
+            user_id (str): Unique User ID.
+            doc_type (str): Document type the files are ingested under.
+            files (List[Tuple[str, str]]): (file_name, file_path) of every saved file.
+            file_ids (List[str], optional): file_id the chunks of each file are stored under
+                (the doc_id of its upload record). New UUIDs by default.
+
+        Returns:
+            str: The new job id.
+        """
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        self._execute(
+            "INSERT INTO ingestion_jobs (job_id, user_id, doc_type, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, user_id, doc_type, now),
+        )
+        file_ids = file_ids or [str(uuid.uuid4()) for _ in files]
+        for (file_name, file_path), file_id in zip(files, file_ids):
+            self._execute(
+                """INSERT INTO ingestion_job_files (job_id, file_name, file_path, file_id, status, updated_at)
+                VALUES (?, ?, ?, ?, 'queued', ?)""",
+                (job_id, file_name, file_path, file_id, now),
+            )
+
+        self.start()
+        for file_name, _ in files:
+            self.executor.submit(self._run_file, job_id, file_name)
+        return job_id
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        """
+        Return the job with per-file status and page progress, or None if unknown.
+        """
+        job = self._execute("SELECT * FROM ingestion_jobs WHERE job_id = ?", (job_id,))
+        if not job:
+            return None
+        files = self._execute(
+            """SELECT file_name, file_id, status, stage, pages_done, pages_total, error, result
+            FROM ingestion_job_files WHERE job_id = ? ORDER BY rowid""",
+            (job_id,),
+        )
+        files = [dict(row) for row in files]
+        for f in files:
+            f["result"] = json.loads(f["result"]) if f["result"] else None
+
+        statuses = {f["status"] for f in files}
+        if statuses & {"queued", "running"}:
+            status = "running" if statuses & {"running", "completed", "failed"} else "queued"
+        elif "failed" in statuses:
+            status = "failed"
+        else:
+            status = "completed"
+
+        return {
+            "job_id": job_id,
+            "user_id": job[0]["user_id"],
+            "doc_type": job[0]["doc_type"],
+            "status": status,
+            "pages_done": sum(f["pages_done"] for f in files),
+            "pages_total": sum(f["pages_total"] for f in files),
+            "cache": self._cache_summary(files),
+            "files": files,
+        }
+
+    def _cache_summary(self, files):
+        """Aggregate dedup and cache hit ratios over the finished files of a job."""
+        results = [f["result"] for f in files if f["result"]]
+        summary = {"files_deduplicated": sum(1 for r in results if r.get("deduplicated"))}
+        for cache_name in ("page_cache", "embedding_cache"):
+            hits = sum(r.get(f"{cache_name}_hits", 0) for r in results)
+            misses = sum(r.get(f"{cache_name}_misses", 0) for r in results)
+            summary[f"{cache_name}_hits"] = hits
+            summary[f"{cache_name}_misses"] = misses
+            summary[f"{cache_name}_hit_ratio"] = hits / (hits + misses) if hits + misses else 0.0
+        return summary
+
+    def file_owners(self) -> List[Tuple[str, str]]:
+        """(file_id, user_id) of every file ingested through the job queue."""
+        rows = self._execute(
+            """SELECT f.file_id, j.user_id FROM ingestion_job_files f
+            JOIN ingestion_jobs j ON j.job_id = f.job_id WHERE f.status = 'completed'"""
+        )
+        return [(row["file_id"], row["user_id"]) for row in rows]
+
+    def is_ingesting(self, file_id: str) -> bool:
+        """True while a file_id is queued or being ingested (its chunks are still being written)."""
+        rows = self._execute(
+            "SELECT 1 FROM ingestion_job_files WHERE file_id = ? AND status IN ('queued', 'running') LIMIT 1",
+            (file_id,),
+        )
+        return bool(rows)
+
+    def _update_file(self, job_id, file_name, **fields):
+        fields["updated_at"] = time.time()
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        self._execute(
+            f"UPDATE ingestion_job_files SET {assignments} WHERE job_id = ? AND file_name = ?",
+            (*fields.values(), job_id, file_name),
+        )
+
+    def _run_file(self, job_id, file_name):
+        if not self._claim_file(job_id, file_name):
+            return
+        job = self._execute("SELECT user_id, doc_type FROM ingestion_jobs WHERE job_id = ?", (job_id,))[0]
+        file_row = self._execute(
+            "SELECT file_path, file_id FROM ingestion_job_files WHERE job_id = ? AND file_name = ?",
+            (job_id, file_name),
+        )[0]
+
+        def progress(stage, pages_done, pages_total):
+            self._update_file(job_id, file_name, stage=stage, pages_done=pages_done, pages_total=pages_total)
+
+        file_hash = None
+        try:
+            # Claimed before parsing: identical files in one upload, or in concurrent uploads,
+            # are ingested once (a resumed file finds its own claim)
+            file_hash = sha256_file(file_row["file_path"])
+            existing_file_id = content_cache.claim_file(
+                file_hash, job["user_id"], job["doc_type"], file_row["file_id"], file_name
+            )
+            if existing_file_id != file_row["file_id"]:
+                # No chunks are written under this file's id: drop its upload record so the
+                # document list only shows the doc_id holding the content (duplicate_of)
+                self.db_op.delete_user_document(job["user_id"], file_row["file_id"])
+                result = {"deduplicated": True, "file_hash": file_hash, "duplicate_of": existing_file_id}
+                self._update_file(job_id, file_name, status="completed", stage="done", result=json.dumps(result))
+                return
+
+            pdf_reader = PDF_reader(job["doc_type"], user_id=job["user_id"])
+            file_id = pdf_reader.create_embeddings(
+                filename=file_row["file_path"],
+                file_id=file_row["file_id"],
+                progress_callback=progress,
+            )
+            content_cache.add_file(file_hash, job["user_id"], job["doc_type"], file_id, file_name)
+            # The tenant's corpus changed: cached answers may be stale
+            answer_cache.invalidate(job["user_id"], job["doc_type"])
+
+            result = {"deduplicated": False, "file_hash": file_hash, **pdf_reader.cache_summary()}
+            self._update_file(job_id, file_name, status="completed", stage="done", result=json.dumps(result))
+        except Exception as e:
+            if file_hash is not None:
+                content_cache.release_file(file_hash, job["user_id"], job["doc_type"], file_row["file_id"])
+            print(f"Error ingesting {file_name} (job {job_id}): {e}")
+            self._update_file(job_id, file_name, status="failed", error=str(e))
+
+ingestion_jobs = IngestionJobs(
+    db_path=os.getenv("INGEST_JOB_DB", os.path.join("saved_files", "ingestion_jobs.sqlite")),
+    max_workers=int(os.getenv("INGEST_WORKERS", 2)),
+    lease_seconds=float(os.getenv("INGEST_LEASE_SECONDS", 120)),
+)
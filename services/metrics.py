@@ -0,0 +1,257 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dotenv import load_dotenv
+from typing import Callable, Dict, List, Optional, Tuple
+import functools
+import threading
+import asyncio
+import time
+import os
+
+load_dotenv()
+
+# Estimated LLM cost, in USD per 1000 tokens (0 disables the cost counter)
+LLM_INPUT_COST_PER_1K = float(os.getenv("LLM_INPUT_COST_PER_1K", 0))
+LLM_OUTPUT_COST_PER_1K = float(os.getenv("LLM_OUTPUT_COST_PER_1K", 0))
+
+# Requests slower than this print their per-stage trace
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 5))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(label_names, label_values) -> str:
+    if not label_names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(label_names, label_values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """Monotonic counter with optional labels, rendered in the Prometheus text format."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """Value that can go up and down."""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            bucket_counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for ix, bound in enumerate(self.buckets):
+                if value <= bound:
+                    bucket_counts[ix] += 1
+            self._values[key] = (bucket_counts, total + value, count + 1)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (bucket_counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts + [count]):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.label_names + ('le',), key + (bound,))} {bucket_count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    In-process metrics, exported by render() in the Prometheus text exposition format.
+
+    Gauges that mirror the state of other components (queue depths, pool usage, cache
+    sizes) are registered as callbacks and read at scrape time.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._callbacks: List[Tuple[str, str, Callable[[], Dict[str, float]]]] = []
+
+    def counter(self, name, documentation, label_names=()):
+        metric = Counter(name, documentation, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, label_names=()):
+        metric = Gauge(name, documentation, label_names)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, documentation, label_names, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_callback(self, name: str, documentation: str, callback: Callable[[], Dict[str, float]]):
+        """
+        Register a gauge family read at scrape time. callback returns {suffix: value};
+        each value is exported as `<name>_<suffix>`.
+        """
+        self._callbacks.append((name, documentation, callback))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        for name, documentation, callback in self._callbacks:
+            try:
+                values = callback()
+            except Exception as e:
+                print(f"Error collecting metric {name}: {e}")
+                continue
+            for suffix, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# HELP {name}_{suffix} {documentation}")
+                lines.append(f"# TYPE {name}_{suffix} gauge")
+                lines.append(f"{name}_{suffix} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+HTTP_REQUESTS = metrics.counter("sherlock_http_requests_total", "HTTP requests", ("method", "route", "status"))
+HTTP_SECONDS = metrics.histogram("sherlock_http_request_seconds", "HTTP request latency", ("method", "route"))
+STAGE_SECONDS = metrics.histogram("sherlock_stage_seconds", "Latency of pipeline stages", ("stage",))
+DB_QUERY_SECONDS = metrics.histogram("sherlock_db_query_seconds", "Latency of database operations", ("operation",))
+LLM_REQUESTS = metrics.counter("sherlock_llm_requests_total", "LLM calls", ("purpose",))
+LLM_TOKENS = metrics.counter("sherlock_llm_tokens_total", "LLM tokens", ("purpose", "kind"))
+LLM_COST = metrics.counter("sherlock_llm_cost_usd_total", "Estimated LLM cost in USD", ("purpose",))
+EMBEDDING_REQUESTS = metrics.counter("sherlock_embedding_requests_total", "Embedding API calls", ("kind",))
+EMBEDDING_INPUTS = metrics.counter("sherlock_embedding_inputs_total", "Texts sent to the embedding API", ("kind",))
+CONTEXT_TOKENS = metrics.counter("sherlock_context_tokens_total", "Answer context tokens: raw retrieval output, packed, and saved by packing", ("kind",))
+INGESTED_PAGES = metrics.counter("sherlock_ingested_pages_total", "PDF pages ingested")
+INGESTED_FILES = metrics.counter("sherlock_ingested_files_total", "PDF files ingested")
+INGESTION_PAGES_PER_SECOND = metrics.gauge("sherlock_ingestion_pages_per_second", "Throughput of the last ingested file")
+
+
+# Request id and per-stage trace of the request being handled
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_trace_var: ContextVar[Optional[list]] = ContextVar("request_trace", default=None)
+
+def start_trace(request_id: str):
+    """Bind a request id and an empty stage trace to the current context."""
+    return request_id_var.set(request_id), _trace_var.set([])
+
+def end_trace(tokens) -> None:
+    request_id_var.reset(tokens[0])
+    _trace_var.reset(tokens[1])
+
+def current_trace() -> List[Tuple[str, float]]:
+    return list(_trace_var.get() or [])
+
+def format_trace(total_seconds: float) -> str:
+    stages = " ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in current_trace())
+    return f"[request {request_id_var.get()}] total={total_seconds * 1000:.1f}ms {stages}"
+
+def _record(histogram, label_name, name, seconds):
+    histogram.observe(seconds, **{label_name: name})
+    trace = _trace_var.get()
+    if trace is not None:
+        trace.append((name, seconds))
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block as pipeline stage `name` (histogram and request trace)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(STAGE_SECONDS, "stage", name, time.perf_counter() - started)
+
+@contextmanager
+def db_operation(name: str):
+    """Time a block as database operation `name` (histogram and request trace)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(DB_QUERY_SECONDS, "operation", f"db.{name}", time.perf_counter() - started)
+
+
+def _timed(timer, name):
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with timer(name):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with timer(name):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed_stage(name: str):
+    """Decorator version of stage() for sync and async functions."""
+    return _timed(stage, name)
+
+def timed_db(name: str):
+    """Decorator version of db_operation() for sync and async functions."""
+    return _timed(db_operation, name)
+
+
+def record_llm_usage(purpose: str, message) -> None:
+    """
+    Count an LLM call and its prompt/completion tokens, read from the usage metadata of
+    the returned message (or final stream chunk). Tokens are skipped if the model did not report them.
+    """
+    LLM_REQUESTS.inc(purpose=purpose)
+    usage = getattr(message, "usage_metadata", None) or {}
+    input_tokens = usage.get("input_tokens", 0)
+    output_tokens = usage.get("output_tokens", 0)
+    if input_tokens or output_tokens:
+        LLM_TOKENS.inc(input_tokens, purpose=purpose, kind="prompt")
+        LLM_TOKENS.inc(output_tokens, purpose=purpose, kind="completion")
+        cost = input_tokens / 1000 * LLM_INPUT_COST_PER_1K + output_tokens / 1000 * LLM_OUTPUT_COST_PER_1K
+        if cost:
+            LLM_COST.inc(cost, purpose=purpose)
+
+def record_embedding_request(kind: str, inputs: int) -> None:
+    EMBEDDING_REQUESTS.inc(kind=kind)
+    EMBEDDING_INPUTS.inc(inputs, kind=kind)
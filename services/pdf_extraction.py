@@ -0,0 +1,183 @@
+from concurrent.futures import ProcessPoolExecutor
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from PyPDF2 import PdfReader
+from dotenv import load_dotenv
+from typing import Iterator, List, Optional, Tuple
+import multiprocessing
+import threading
+import hashlib
+import mmap
+import time
+import os
+
+load_dotenv()
+
+#Extraction backend: "auto" (parallel for large files), "serial", "parallel", or a registered name
+PDF_EXTRACTOR = os.getenv("PDF_EXTRACTOR", "auto")
+#Processes used by the parallel extractor, and pages per task sent to a process
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", os.cpu_count() or 2))
+EXTRACT_PAGES_PER_TASK = int(os.getenv("EXTRACT_PAGES_PER_TASK", 8))
+#"auto" only pays the process hop for files with at least this many pages
+EXTRACT_PARALLEL_MIN_PAGES = int(os.getenv("EXTRACT_PARALLEL_MIN_PAGES", 32))
+
+#(page number, text, extraction seconds)
+ExtractedPage = Tuple[int, str, float]
+
+
+class _MappedPDF:
+    """A PDF opened through a read-only memory map; pages are parsed from the mapped file."""
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.reader = PdfReader(self.mapped)
+
+    def close(self):
+        self.mapped.close()
+        self.file.close()
+
+
+#Per process: recently opened PDFs, so consecutive page ranges of one file parse its structure once
+_open_pdfs = OrderedDict()
+_open_pdfs_lock = threading.Lock()
+
+def _open_pdf(path: str) -> _MappedPDF:
+    key = (path, os.path.getmtime(path))
+    with _open_pdfs_lock:
+        pdf = _open_pdfs.get(key)
+        if pdf is None:
+            pdf = _MappedPDF(path)
+            _open_pdfs[key] = pdf
+            while len(_open_pdfs) > 2:
+                _open_pdfs.popitem(last=False)[1].close()
+        _open_pdfs.move_to_end(key)
+        return pdf
+
+def _extract_one(pdf: _MappedPDF, page_number: int) -> ExtractedPage:
+    started = time.perf_counter()
+    text = pdf.reader.pages[page_number].extract_text()
+    return page_number, text, time.perf_counter() - started
+
+def extract_page_range(path: str, start: int, stop: int) -> List[ExtractedPage]:
+    """Extract pages [start, stop) of a PDF. Runs in the extraction processes."""
+    pdf = _open_pdf(path)
+    return [_extract_one(pdf, page_number) for page_number in range(start, stop)]
+
+
+class PDFExtractor(ABC):
+    """
+    Interface of text extraction backends. A backend returns the page count of a file
+    and yields (page number, text, seconds) for every page, in page order.
+
+    iter_pages takes the page count when the caller already has it, so a file's page
+    tree is only parsed for counting once.
+    """
+
+    def page_count(self, path: str) -> int:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return len(PdfReader(mapped).pages)
+
+    @abstractmethod
+    def iter_pages(self, path: str, page_count: Optional[int] = None) -> Iterator[ExtractedPage]:
+        """Yield (page number, text, seconds) of every page of path, in page order."""
+
+
+class SerialExtractor(PDFExtractor):
+    """PyPDF2 in the calling thread, one page at a time."""
+
+    def iter_pages(self, path: str, page_count: Optional[int] = None) -> Iterator[ExtractedPage]:
+        pdf = _MappedPDF(path)
+        try:
+            if page_count is None:
+                page_count = len(pdf.reader.pages)
+            for page_number in range(page_count):
+                yield _extract_one(pdf, page_number)
+        finally:
+            pdf.close()
+
+
+class ParallelExtractor(PDFExtractor):
+    """
+    PyPDF2 across a process pool: the page range is split into tasks of pages_per_task
+    pages, each process maps the file instead of receiving its bytes, and results are
+    yielded in page order. At most two tasks per process are in flight, so a long PDF
+    does not pile up extracted text ahead of the consumer.
+    """
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, workers: int = EXTRACT_WORKERS, pages_per_task: int = EXTRACT_PAGES_PER_TASK):
+        self.workers = workers
+        self.pages_per_task = pages_per_task
+
+    def executor(self) -> ProcessPoolExecutor:
+        #One pool per process, shared by every extraction (spawn: the server runs threads)
+        with ParallelExtractor._executor_lock:
+            if ParallelExtractor._executor is None:
+                ParallelExtractor._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            return ParallelExtractor._executor
+
+    def iter_pages(self, path: str, page_count: Optional[int] = None) -> Iterator[ExtractedPage]:
+        path = os.path.abspath(path)
+        total_pages = page_count if page_count is not None else self.page_count(path)
+        executor = self.executor()
+        in_flight = deque()
+        for start in range(0, total_pages, self.pages_per_task):
+            stop = min(start + self.pages_per_task, total_pages)
+            in_flight.append(executor.submit(extract_page_range, path, start, stop))
+            if len(in_flight) >= 2 * self.workers:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+
+class AutoExtractor(PDFExtractor):
+    """Serial for small files, parallel from min_pages pages on."""
+
+    def __init__(self, min_pages: int = EXTRACT_PARALLEL_MIN_PAGES):
+        self.min_pages = min_pages
+        self.serial = SerialExtractor()
+        self.parallel = ParallelExtractor()
+
+    def iter_pages(self, path: str, page_count: Optional[int] = None) -> Iterator[ExtractedPage]:
+        if page_count is None:
+            page_count = self.page_count(path)
+        extractor = self.parallel if page_count >= self.min_pages else self.serial
+        return extractor.iter_pages(path, page_count)
+
+
+EXTRACTORS = {
+    "auto": AutoExtractor,
+    "serial": SerialExtractor,
+    "parallel": ParallelExtractor,
+}
+
+def register_extractor(name: str, extractor_class) -> None:
+    """Make a backend (a PDFExtractor subclass) selectable with PDF_EXTRACTOR=name."""
+    EXTRACTORS[name] = extractor_class
+
+def get_extractor(name: Optional[str] = None) -> PDFExtractor:
+    name = name or PDF_EXTRACTOR
+    if name not in EXTRACTORS:
+        raise ValueError(f"Unknown PDF extractor: {name} (available: {', '.join(EXTRACTORS)})")
+    return EXTRACTORS[name]()
+
+def parse_pdf(path: str, chunk_size: int = 1024 * 1024) -> Tuple[List[str], str]:
+    """
+    Process pool worker of bulk ingestion: extract the text of every page and hash the file.
+    Lives here so spawned workers only import the extraction code.
+
+    Returns:
+        tuple: (page texts, sha256 hex digest)
+    """
+    #Files are already spread across processes, so each one is extracted serially
+    pages = [text for _, text, _ in SerialExtractor().iter_pages(path)]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return pages, digest.hexdigest()
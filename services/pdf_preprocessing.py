@@ -1,34 +1,65 @@
-from PyPDF2 import PdfReader
-from services.get_model import Call_Models
-from services.vectorDB import PGVectorDB
+from services.get_model import call_with_backoff
+from services.registry import registry
+from services.pdf_extraction import get_extractor
+from services.metrics import STAGE_SECONDS, INGESTED_FILES, INGESTED_PAGES, INGESTION_PAGES_PER_SECOND, stage, record_llm_usage
+from concurrent.futures import ThreadPoolExecutor
+from services.content_cache import content_cache, document_embedding_cache, sha256_text
 from langchain_core.documents import Document
+from collections import deque
 import tiktoken
+import threading
+import time
 import uuid
 import os
 import re
-from glob import glob
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-#Call Embedding model
-model_call = Call_Models()
-llm,embed = model_call.get_open_ai_model()
+#LLM, embeddings and vector stores are built lazily by the shared registry
 
-#Call VectorDB
-open_vecDB = PGVectorDB(embed)
-parent_vecDB = open_vecDB.call_vectorDB("parent_embedding")
-child_vecDB = open_vecDB.call_vectorDB("child_embedding")
+#Maximum number of concurrent table restructuring calls per file
+TABLE_CONCURRENCY = int(os.getenv("TABLE_CONCURRENCY", 4))
+
+#Embedding requests: token budget and input count per request, and requests in flight per file
+EMBED_BATCH_TOKENS = int(os.getenv("EMBED_BATCH_TOKENS", 64000))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 256))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", 4))
+
+#Pages held in memory at once during ingestion: pages being restructured, and pages waiting to be embedded
+PAGE_WINDOW = int(os.getenv("INGEST_PAGE_WINDOW", 16))
 
 #Class to read PDF files
 class PDF_reader:
     
-    def __init__(self,doc_type):
+    def __init__(self,doc_type,user_id=None,extractor=None):
         self.existing_ids = []
-        self.emb_ctx_length = embed.embedding_ctx_length
+        #Text extraction backend (services.pdf_extraction, PDF_EXTRACTOR)
+        self.extractor = extractor or get_extractor()
+        self.page_timings = []
+        self.emb_ctx_length = registry.embed.embedding_ctx_length
         self.doc_type = doc_type
+        self.user_id = user_id
+        self.total_pages = None
+        self.source_name = None
+        self.tiktoken_encoder()
+        self._stats_lock = threading.Lock()
+        self.cache_stats = {"page_cache_hits": 0, "page_cache_misses": 0,
+                            "embedding_cache_hits": 0, "embedding_cache_misses": 0}
 
     def read_pdf(self,path):
-        file = PdfReader(path)
-        self.extracted_pages = [page.extract_text() for page in file.pages]
+        self.extracted_pages = list(self.iter_pages(path))
+
+    def iter_pages(self,path):
+        """
+        Yield the text of each page in order, as the extractor produces it.
+        Per-page extraction times are kept in self.page_timings.
+        Sets self.total_pages before the first page is yielded.
+        """
+        self.total_pages = self.extractor.page_count(path)
+        self.page_timings = []
+        for page_number, text, seconds in self.extractor.iter_pages(path, self.total_pages):
+            STAGE_SECONDS.observe(seconds, stage="extract_page")
+            self.page_timings.append(seconds)
+            yield text
     
     def get_unique_id(self):
         new_id = str(uuid.uuid4())
@@ -37,39 +68,64 @@ class PDF_reader:
             self.existing_ids.extend(new_id)
         return new_id
 
-    def create_child_docs(self,page,parent_id, file_id):
+    def create_child_docs(self,page,parent_id, file_id, page_number=None):
         text_splitter = RecursiveCharacterTextSplitter(chunk_size=200, chunk_overlap=50)
         child_chunks = text_splitter.split_text(page)
 
-        for chunk in child_chunks:
-            doc = Document(page_content = chunk,
+        child_docs = []
+        for ix,chunk in enumerate(child_chunks):
+            doc = Document(id = str(uuid.uuid5(uuid.UUID(parent_id), str(ix))),
+                            page_content = chunk,
                             metadata = {"file_id": file_id,
                                             "document_id":parent_id,
-                                            "doc_type":self.doc_type})
-            
-            self.child_docs.append(doc)
+                                            "doc_type":self.doc_type,
+                                            "user_id":self.user_id,
+                                            "source":self.source_name,
+                                            "page":page_number})
             
+            child_docs.append(doc)
+        return child_docs
 
-    def create_parent_docs(self, file_id):
-        self.parent_docs = []
-        self.child_docs = []
-        for ix,page in enumerate(self.extracted_pages):
-            print("Page No {} processed out of {} pages".format(ix+1,len(self.extracted_pages)))
-            #Create Id
-            doc_id = self.get_unique_id()
-
-            #Table identification
-            page = self.table_identification(page)
-
-            doc = Document(page_content = page,
-                           metadata = {"file_id": file_id,
-                                        "document_id":doc_id,
-                                        "doc_type":self.doc_type})
-            
-            self.parent_docs.append(doc)
-            
-            #create child docs
-            self.create_child_docs(page,doc_id, file_id)
+    def restructure_pages(self, pages, executor):
+        """
+        Run table_identification on pages concurrently and yield the results in page order.
+        At most PAGE_WINDOW pages are in flight: the next page is only extracted once the
+        consumer has taken a result, so a slow embedding stage holds back extraction.
+        """
+        in_flight = deque()
+        for page in pages:
+            in_flight.append(executor.submit(self.table_identification, page))
+            if len(in_flight) >= PAGE_WINDOW:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+    def create_parent_docs(self, pages, file_id, progress_callback=None):
+        """
+        Yield (parent document, child documents) for each page, in page order.
+        Table restructuring calls run concurrently, up to TABLE_CONCURRENCY at a time,
+        while parent ids stay the same as in a sequential run.
+        """
+        with ThreadPoolExecutor(max_workers=TABLE_CONCURRENCY) as executor:
+            for ix,page in enumerate(self.restructure_pages(pages, executor)):
+                print("Page No {} processed out of {} pages".format(ix+1,self.total_pages))
+
+                #Id derived from file id and page number, so a re-run produces the same ids
+                doc_id = str(uuid.uuid5(uuid.UUID(file_id), str(ix)))
+                doc = Document(id = doc_id,
+                               page_content = page,
+                               metadata = {"file_id": file_id,
+                                            "document_id":doc_id,
+                                            "doc_type":self.doc_type,
+                                            "user_id":self.user_id,
+                                            #File name and page number, used for answer citations
+                                            "source":self.source_name,
+                                            "page":ix+1})
+
+                if progress_callback:
+                    progress_callback("processing", ix+1, self.total_pages)
+
+                yield doc, self.create_child_docs(page,doc_id, file_id, page_number=ix+1)
 
     def table_identification(self,page_content,threshold=30):
         """
@@ -97,9 +153,20 @@ class PDF_reader:
         
         # Determine if the page likely contains tables based on the threshold
         if number_count > threshold:
-            page_content = self.table_processing(page_content)
+            # Identical pages (in any file, for any user) reuse the earlier restructured output
+            page_hash = sha256_text(page_content)
+            restructured = content_cache.get_page(page_hash)
+            self.count_cache("page_cache", restructured is not None)
+            if restructured is None:
+                restructured = self.table_processing(page_content)
+                content_cache.set_page(page_hash, restructured)
+            page_content = restructured
         
         return page_content
+
+    def count_cache(self, cache_name, hit, count=1):
+        with self._stats_lock:
+            self.cache_stats[f"{cache_name}_{'hits' if hit else 'misses'}"] += count
     
     def table_processing(self,page_content):
         prompt = f"""
@@ -119,21 +186,159 @@ class PDF_reader:
         //
 
         """
-        result = llm.invoke(prompt).content
-        return result
+        with stage("restructure_llm"):
+            message = call_with_backoff(registry.llm.invoke, prompt)
+        record_llm_usage("table_restructure", message)
+        return message.content
                         
-    def create_embeddings(self,filename):
+    def create_embeddings(self,filename,file_id=None,progress_callback=None,pages=None):
+        """
+        Parse, restructure and embed one PDF into the parent/child collections.
+
+        Args:
+            filename (str): Path of the saved PDF.
+            file_id (str, optional): Id stored in the chunk metadata. Generated if None.
+            progress_callback (callable, optional): Called as progress_callback(stage, pages_done, pages_total).
+            pages (list, optional): Page texts already extracted from filename (e.g. by a parser process).
+
+        Returns:
+            str: The file_id stored in the chunk metadata.
+        """
         # pdf_path = f'.\saved_files\{user_id}'
         file_path = filename
-        self.read_pdf(file_path)
-        file_id = str(uuid.uuid4())
-        self.create_parent_docs(file_id)
-        
-        parent_vecDB.add_documents(self.parent_docs) 
-        child_vecDB.add_documents(self.child_docs)
+        self.cache_stats = dict.fromkeys(self.cache_stats, 0)
+        file_id = file_id or str(uuid.uuid4())
+        self.source_name = os.path.basename(file_path)
+        started = time.perf_counter()
+
+        #Pages flow extract -> restructure -> split -> embed -> write, PAGE_WINDOW pages at a time,
+        #so memory does not grow with the length of the PDF
+        parent_docs, child_docs = [], []
+        pages_done = 0
+        if pages is None:
+            pages = self.iter_pages(file_path)
+        else:
+            self.total_pages = len(pages)
+        for parent_doc, page_child_docs in self.create_parent_docs(pages, file_id, progress_callback):
+            parent_docs.append(parent_doc)
+            child_docs.extend(page_child_docs)
+            pages_done += 1
+            if len(parent_docs) >= PAGE_WINDOW:
+                self.write_window(parent_docs, child_docs, file_id, pages_done, progress_callback)
+                parent_docs, child_docs = [], []
+        if parent_docs:
+            self.write_window(parent_docs, child_docs, file_id, pages_done, progress_callback)
+
+        #Every batch is committed, a future run of this file_id starts from scratch
+        content_cache.clear_batches(file_id)
+
+        elapsed = time.perf_counter() - started
+        INGESTED_FILES.inc()
+        INGESTED_PAGES.inc(pages_done)
+        INGESTION_PAGES_PER_SECOND.set(pages_done / elapsed if elapsed else 0)
+        print(f"Ingested {pages_done} pages in {elapsed:.1f}s ({pages_done / elapsed if elapsed else 0:.2f} pages/s)")
+        return file_id
+
+    def write_window(self, parent_docs, child_docs, file_id, pages_done, progress_callback=None):
+        """Embed and write the parent and child documents of a window of pages."""
+        if progress_callback:
+            progress_callback("embedding", pages_done, self.total_pages)
+        self.add_docs(registry.vector_store("parent_embedding"), parent_docs, file_id)
+        self.add_docs(registry.vector_store("child_embedding"), child_docs, file_id)
+
+    def embed_texts(self, texts):
+        """
+        Embed texts for ingestion, reusing cached vectors of identical texts and
+        sending only the misses to the embedding model.
+        """
+        keys = [document_embedding_cache.make_key(registry.embed.model_name, text) for text in texts]
+        vectors = [document_embedding_cache.get(key) for key in keys]
+
+        missing = [ix for ix,vector in enumerate(vectors) if vector is None]
+        self.count_cache("embedding_cache", True, len(texts) - len(missing))
+        self.count_cache("embedding_cache", False, len(missing))
+        if missing:
+            new_vectors = call_with_backoff(registry.embed.embed_documents, [texts[ix] for ix in missing])
+            for ix,vector in zip(missing, new_vectors):
+                vectors[ix] = vector
+                document_embedding_cache.set(keys[ix], vector)
+        return vectors
+
+    def embedding_input(self, text):
+        """
+        Text sent to the embedding model and its token count. Pages longer than the
+        model context are truncated for embedding; the full text is still stored and
+        the child chunks cover the remainder.
+        """
+        tokens = self.encoding.encode(text)
+        if len(tokens) <= self.emb_ctx_length:
+            return text, len(tokens)
+        return self.encoding.decode(tokens[:self.emb_ctx_length]), self.emb_ctx_length
+
+    def make_batches(self, docs):
+        """
+        Pack documents, in order, into embedding requests of at most EMBED_BATCH_TOKENS
+        tokens and EMBED_BATCH_SIZE inputs.
+
+        Returns:
+            list: Batches of (document, embedding input text) pairs.
+        """
+        batches = []
+        current, current_tokens = [], 0
+        for doc in docs:
+            text, token_count = self.embedding_input(doc.page_content)
+            if current and (current_tokens + token_count > EMBED_BATCH_TOKENS or len(current) >= EMBED_BATCH_SIZE):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append((doc, text))
+            current_tokens += token_count
+        if current:
+            batches.append(current)
+        return batches
+
+    def add_docs(self, vector_store, docs, file_id):
+        """
+        Embed docs in token-budgeted batches (EMBED_CONCURRENCY at a time) and bulk insert
+        each batch as soon as it is embedded. Committed batches are checkpointed, so a
+        re-run for the same file_id skips them and resumes with the rest.
+        """
+        def write_batch(batch):
+            batch_key = sha256_text(vector_store.collection_name + "".join(doc.id for doc,_ in batch))
+            if content_cache.is_batch_committed(file_id, batch_key):
+                return
+            embeddings = self.embed_texts([text for _,text in batch])
+            with stage("vector_write"):
+                vector_store.add_embeddings(
+                    texts = [doc.page_content for doc,_ in batch],
+                    embeddings = embeddings,
+                    metadatas = [doc.metadata for doc,_ in batch],
+                    ids = [doc.id for doc,_ in batch],
+                )
+            content_cache.mark_batch_committed(file_id, batch_key)
+
+        batches = self.make_batches(docs)
+        with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as executor:
+            list(executor.map(write_batch, batches))
+
+    def cache_summary(self):
+        """Cache hit counters and hit ratios of the last processed file."""
+        summary = dict(self.cache_stats)
+        for cache_name in ("page_cache", "embedding_cache"):
+            lookups = summary[f"{cache_name}_hits"] + summary[f"{cache_name}_misses"]
+            summary[f"{cache_name}_hit_ratio"] = summary[f"{cache_name}_hits"] / lookups if lookups else 0.0
+        return summary
     
-    def tiktoken_encoder(self):
-        self.encoding = tiktoken.get_encoding("o200k_base")
+    def tiktoken_encoder(self, encoding_name="cl100k_base"):
+        #cl100k_base is the tokenizer of the OpenAI embedding models; loaded on first use
+        self.encoding_name = encoding_name
+        self._encoding = None
+
+    @property
+    def encoding(self):
+        #tiktoken downloads the BPE file on first load unless TIKTOKEN_CACHE_DIR holds it
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        return self._encoding
 
 
     def count_tokens(self,page):
@@ -1,22 +1,27 @@
-import uuid
-from services.get_model import Call_Models
-from services.vectorDB import PGVectorDB
-import pandas as pd
+import os
+from services.registry import registry
+from services.answer_cache import answer_cache
+from services.metrics import STAGE_SECONDS, CONTEXT_TOKENS, stage, timed_stage, record_llm_usage
+from services.context_packing import context_packer
+from services.reranking import reranker
 from services.chat_history import *
-import numpy as np
+import asyncio
+import time
 
 
-#Call Embedding model
-model_call = Call_Models()
-llm,embed = model_call.get_open_ai_model()
-
 #Chat History Object
 chat_history_obj = ChatHistory()
 
-#Call VectorDB
-open_vecDB = PGVectorDB(embed)
-parent_vecDB = open_vecDB.call_vectorDB("parent_embedding")
-child_vecDB = open_vecDB.call_vectorDB("child_embedding")
+#LLM, embeddings and vector stores are built lazily by the shared registry
+
+#Child retrieval: "vector" (pgvector only) or "hybrid" (full-text + vector, rank fused)
+RETRIEVER = os.getenv("RETRIEVER", "vector")
+#Child candidates re-ranked locally (see services.reranking)
+CHILD_K = int(os.getenv("CHILD_K", 20))
+HYBRID_K = int(os.getenv("HYBRID_K", 15))
+
+#Strong references to streaming generations that outlive their HTTP response
+_background_tasks = set()
 
 #Class to read PDF files
 class RUN_Inference:
@@ -25,36 +30,49 @@ class RUN_Inference:
         pass
 
     def get_unique_docids(self,docs):
-        unique_ids = []
-        unique_metadata = []
+        unique_metadata = {}
         for doc in docs:
-            meta_data = doc.metadata
-            id_ = meta_data['document_id']
-            if id_ not in unique_ids:
-                unique_metadata.append(meta_data)
-                unique_ids.append(id_)
-        return unique_metadata
+            unique_metadata.setdefault(doc.metadata['document_id'], doc.metadata)
+        return list(unique_metadata.values())
 
 
+    def tenant_filter(self,document_type,user_id=None):
+        """Metadata filter restricting retrieval to one user's documents of one doc_type."""
+        if user_id is None:
+            return {"doc_type":document_type}
+        return {"user_id":user_id,"doc_type":document_type}
+
+    @timed_stage("parent_fetch")
+    def get_parent_docs(self,filtered_metadata,k=5,user_id=None):
+        """
+        Fetch the parent pages for the given child metadata in one query, without embedding.
+        Keeps the order of filtered_metadata (best child score first) and cuts it to k parents.
+        """
+        document_ids = [meta_data['document_id'] for meta_data in filtered_metadata][:k]
+        parent_filter = {"user_id":user_id} if user_id is not None else None
+        parent_docs = registry.vector_store("parent_embedding").get_by_metadata("document_id",document_ids,filter=parent_filter)
+
+        parents_by_id = {doc.metadata['document_id']: doc for doc in parent_docs}
+        return [parents_by_id[id_] for id_ in document_ids if id_ in parents_by_id]
+
     def get_docs(self,question,threshold = 0.8):
         child_chunks = []
-        get_parent_docs =  parent_vecDB.similarity_search(question,k=10)
+        get_parent_docs =  registry.vector_store("parent_embedding").similarity_search(question,k=10)
 
         #Extract unique document ids
         filtered_metadata = self.get_unique_docids(get_parent_docs)
         
         #Child chunks
         for filter_sample in filtered_metadata:
-            temp_child_docs = child_vecDB.similarity_search_with_relevance_scores(question,filter = filter_sample,k=30)
+            temp_child_docs = registry.vector_store("child_embedding").similarity_search_with_relevance_scores(question,filter = filter_sample,k=30)
             for chunk in temp_child_docs:
                 if chunk[1] >= threshold:
                     child_chunks.append(chunk)
         return child_chunks
     
-    def get_docs_v1(self,question,document_type,threshold=0.6,k=5):
+    def get_docs_v1(self,question,document_type,threshold=0.6,k=5,user_id=None):
         thresh_filter_chunks = []
-        parent_chunk_filtered = []
-        child_chunks = child_vecDB.similarity_search_with_relevance_scores(question,k=30,filter = {"doc_type":document_type})
+        child_chunks = registry.vector_store("child_embedding").similarity_search_with_relevance_scores(question,k=30,filter = self.tenant_filter(document_type,user_id))
         print(child_chunks)
         for chunk in child_chunks:
                 if chunk[1] >= threshold:
@@ -62,68 +80,131 @@ class RUN_Inference:
         
         filtered_metadata = self.get_unique_docids(thresh_filter_chunks)
 
-        for filter in filtered_metadata:
-             parent_chunk_filtered.append(parent_vecDB.similarity_search(question,k=1,filter = filter)[0])
-        
-        parent_chunk_filtered = parent_chunk_filtered[:k]
+        parent_chunk_filtered = self.get_parent_docs(filtered_metadata,k=k,user_id=user_id)
         parent_chunk_filtered = [i.page_content for i in parent_chunk_filtered]
         return parent_chunk_filtered
     
-    def get_docs_v2(self,question,document_type,threshold=None,k=5):
-        thresh_filter_chunks = []
-        parent_chunk_filtered = []
-        child_chunks = child_vecDB.similarity_search_with_relevance_scores(question,k=30,filter = {"doc_type":document_type})
-        chunk_scores = [chunk[1] for chunk in child_chunks]
-        threshold = np.mean(chunk_scores)
-        for chunk in child_chunks:
-                if chunk[1] >= threshold:
-                    thresh_filter_chunks.append(chunk[0])
-        
-        filtered_metadata = self.get_unique_docids(thresh_filter_chunks)
+    @timed_stage("child_search")
+    def search_child_chunks(self,question,document_type,user_id=None):
+        """
+        Child chunks from the retriever selected by RETRIEVER, with their stored embeddings.
 
-        for filter in filtered_metadata:
-             parent_chunk_filtered.append(parent_vecDB.similarity_search(question,k=1,filter = filter)[0])
-        
-        parent_chunk_filtered = parent_chunk_filtered[:k]
-        parent_chunk_filtered = [i.page_content for i in parent_chunk_filtered]
+        Returns:
+            tuple: (question embedding, [(chunk, score, embedding)])
+        """
+        child_vecDB = registry.vector_store("child_embedding")
+        if RETRIEVER == "hybrid":
+            return child_vecDB.hybrid_search_with_embeddings(question,k=HYBRID_K,filter = self.tenant_filter(document_type,user_id))
+        return child_vecDB.similarity_search_with_embeddings(question,k=CHILD_K,filter = self.tenant_filter(document_type,user_id))
+
+    @timed_stage("child_search")
+    async def asearch_child_chunks(self,question,document_type,user_id=None):
+        """Async version of search_child_chunks."""
+        child_vecDB = registry.vector_store("child_embedding", async_mode=True)
+        if RETRIEVER == "hybrid":
+            return await child_vecDB.ahybrid_search_with_embeddings(question,k=HYBRID_K,filter = self.tenant_filter(document_type,user_id))
+        return await child_vecDB.asimilarity_search_with_embeddings(question,k=CHILD_K,filter = self.tenant_filter(document_type,user_id))
+
+    def rerank_child_chunks(self,question_embedding,hits):
+        """
+        MMR-diversified child chunks and parent ids ranked by aggregate chunk score.
+        Hybrid hits keep their fused ranking as relevance, vector hits are scored by cosine.
+        """
+        ranked = reranker.rerank(question_embedding,hits,use_retriever_scores=(RETRIEVER == "hybrid"))
+        filtered_metadata = [{"document_id":id_} for id_,_ in ranked.parents]
+        return ranked.chunks,filtered_metadata
+
+    def get_docs_v2(self,question,document_type,threshold=None,k=5,user_id=None):
+        """Child chunks with scores and the parent documents with the most evidence."""
+        question_embedding,hits = self.search_child_chunks(question,document_type,user_id)
+        child_chunks,filtered_metadata = self.rerank_child_chunks(question_embedding,hits)
+
+        parent_chunk_filtered = self.get_parent_docs(filtered_metadata,k=k,user_id=user_id)
+        return child_chunks,parent_chunk_filtered
+
+    @timed_stage("parent_fetch")
+    async def aget_parent_docs(self,filtered_metadata,k=5,user_id=None):
+        """Async version of get_parent_docs."""
+        document_ids = [meta_data['document_id'] for meta_data in filtered_metadata][:k]
+        parent_filter = {"user_id":user_id} if user_id is not None else None
+        parent_docs = await registry.vector_store("parent_embedding", async_mode=True).aget_by_metadata("document_id",document_ids,filter=parent_filter)
+
+        parents_by_id = {doc.metadata['document_id']: doc for doc in parent_docs}
+        return [parents_by_id[id_] for id_ in document_ids if id_ in parents_by_id]
+
+    async def aget_docs_v2(self,question,document_type,threshold=None,k=5,user_id=None):
+        """Async version of get_docs_v2."""
+        question_embedding,hits = await self.asearch_child_chunks(question,document_type,user_id)
+        child_chunks,filtered_metadata = self.rerank_child_chunks(question_embedding,hits)
+
+        parent_chunk_filtered = await self.aget_parent_docs(filtered_metadata,k=k,user_id=user_id)
         return child_chunks,parent_chunk_filtered
     
-    def conversation_rephrase(self,question,selected_doc_type,session_id):
-        #Get history
-        df_history = chat_history_obj.get_chat_history(selected_doc_type,session_id=session_id)
+    def rephrase_prompt(self,question,df_history):
+        json_history = df_history[['question','response','time_stamp']].to_dict(orient='records')
+
+        prompt = f"""
+            Your job is to read the chat history and if the question is a follow up question of chat history then add details of history in the question and rephrase it.
+            If question is unrelated to history then return the original question as it is as rephrased question.
+
+            User question: {question}
+
+            Chat history:
+            {json_history}
+
+            Rephrased question:
+            **Only return rephrased question in the output**
+            """
+        return prompt
+
+    @timed_stage("rephrase")
+    def conversation_rephrase(self,question,selected_doc_type,session_id,user_id=None):
+        #Get history (only the user's own session)
+        df_history = chat_history_obj.get_chat_history(selected_doc_type,session_id=session_id,user_id=user_id)
         
         if df_history.shape[0]==0:
             return question
         
         else:
-            json_history = df_history[['question','response','time_stamp']].to_dict(orient='records')
-
-            prompt = f"""
-                Your job is to read the chat history and if the question is a follow up question of chat history then add details of history in the question and rephrase it.
-                If question is unrelated to history then return the original question as it is as rephrased question.
-
-                User question: {question}
-
-                Chat history:
-                {json_history}
-
-                Rephrased question:
-                **Only return rephrased question in the output**
-                """
-            result = llm.invoke(prompt).content
+            prompt = self.rephrase_prompt(question,df_history)
+            message = registry.llm.invoke(prompt)
+            record_llm_usage("rephrase", message)
+            result = message.content
             print("Rephrased question: ",result)
             return result
 
-    
-
-    def get_answer(self,question,selected_doc_type, user_id):
-
-        session_id = str(uuid.uuid4())
-        
-        context = self.get_docs_v2(question,document_type=selected_doc_type)
+    @timed_stage("rephrase")
+    async def aconversation_rephrase(self,question,selected_doc_type,session_id,user_id=None):
+        """Async version of conversation_rephrase."""
+        #Get history (only the user's own session)
+        df_history = await chat_history_obj.aget_chat_history(selected_doc_type,session_id=session_id,user_id=user_id)
         
-        question = self.conversation_rephrase(question,selected_doc_type, session_id)
+        if df_history.shape[0]==0:
+            return question
         
+        else:
+            prompt = self.rephrase_prompt(question,df_history)
+            message = await registry.llm.ainvoke(prompt)
+            record_llm_usage("rephrase", message)
+            result = message.content
+            print("Rephrased question: ",result)
+            return result
+
+    @timed_stage("context_pack")
+    def pack_context(self,retrieved):
+        """
+        Pack the retrieval output of get_docs_v2 into the context block of the answer prompt:
+        deduplicated passages within the token budget, grouped under [n] source labels.
+        """
+        child_chunks,parent_docs = retrieved
+        packed = context_packer.pack(child_chunks,parent_docs)
+        CONTEXT_TOKENS.inc(packed.raw_tokens, kind="raw")
+        CONTEXT_TOKENS.inc(packed.packed_tokens, kind="packed")
+        CONTEXT_TOKENS.inc(packed.tokens_saved, kind="saved")
+        print("Context packing: ",packed.summary())
+        return packed.text
+
+    def answer_prompt(self,question,context):
         #context = ''.join(context)
         prompt = f"""
         <Problem Statement>
@@ -133,15 +214,163 @@ class RUN_Inference:
 
         <Answer Structure>
         **Detailed answer here**
-        **Cite the source of your answer here**
+        **Cite the sources of your answer by their [n] labels, e.g. [1], [2]**
         </Answer Structure>
         
         <content>
         {context}
         </context>
         """
-        result = llm.invoke(prompt).content
+        return prompt
+
+    def get_answer(self,question,selected_doc_type, user_id, session_id=None):
+
+        session_id = chat_history_obj.start_session(session_id, user_id)
+        started = time.perf_counter()
+        user_question = question
+        
+        question = self.conversation_rephrase(question,selected_doc_type, session_id, user_id)
+
+        #Semantic answer cache, keyed by the embedding of the rephrased question
+        corpus_version = answer_cache.corpus_version(user_id,selected_doc_type)
+        question_embedding = registry.embed.embed_query(question)
+        result = answer_cache.lookup(user_id,selected_doc_type,question_embedding,corpus_version)
+        
+        if result is None:
+            context = self.pack_context(self.get_docs_v2(user_question,document_type=selected_doc_type,user_id=user_id))
+            
+            prompt = self.answer_prompt(question,context)
+            with stage("generate"):
+                message = registry.llm.invoke(prompt)
+            record_llm_usage("answer", message)
+            result = message.content
+            answer_cache.store(user_id,selected_doc_type,question,question_embedding,result,
+                               time.perf_counter()-started,corpus_version)
         
         #add to chat history
         chat_history_obj.update_chat_history(user_id, session_id,selected_doc_type,question,result)
-        return result
\ No newline at end of file
+        return result
+
+    async def _aprepare_answer(self,question,selected_doc_type,user_id,session_id):
+        """
+        Rephrase the question and look it up in the answer cache while retrieval runs concurrently.
+        Retrieval is cancelled on a cache hit.
+
+        Returns:
+            tuple: (question, context, cached_answer, question_embedding, corpus_version);
+                   context is None on a cache hit, cached_answer is None on a miss.
+        """
+        retrieval = asyncio.create_task(
+            self.aget_docs_v2(question,document_type=selected_doc_type,user_id=user_id)
+        )
+        try:
+            question = await self.aconversation_rephrase(question,selected_doc_type, session_id, user_id)
+            #The corpus version is read from Postgres with a blocking driver
+            corpus_version = await asyncio.to_thread(answer_cache.corpus_version,user_id,selected_doc_type)
+            question_embedding = await registry.embed.aembed_query(question)
+        except BaseException:
+            retrieval.cancel()
+            raise
+
+        cached_answer = answer_cache.lookup(user_id,selected_doc_type,question_embedding,corpus_version)
+        if cached_answer is not None:
+            retrieval.cancel()
+            return question, None, cached_answer, question_embedding, corpus_version
+
+        #Tokenizing the passages is CPU-bound: keep it off the event loop
+        context = await asyncio.to_thread(self.pack_context, await retrieval)
+        return question, context, None, question_embedding, corpus_version
+
+    async def aget_answer(self,question,selected_doc_type, user_id, session_id=None):
+        """
+        Async version of get_answer. Retrieval runs concurrently with question rephrasing
+        and the answer cache lookup; nothing here blocks the event loop.
+        """
+        session_id = chat_history_obj.start_session(session_id, user_id)
+        started = time.perf_counter()
+        
+        question, context, result, question_embedding, corpus_version = await self._aprepare_answer(
+            question,selected_doc_type,user_id,session_id
+        )
+        
+        if result is None:
+            prompt = self.answer_prompt(question,context)
+            with stage("generate"):
+                message = await registry.llm.ainvoke(prompt)
+            record_llm_usage("answer", message)
+            result = message.content
+            await asyncio.to_thread(answer_cache.store,user_id,selected_doc_type,question,question_embedding,result,
+                                    time.perf_counter()-started,corpus_version)
+        
+        #add to chat history
+        await chat_history_obj.aupdate_chat_history(user_id, session_id,selected_doc_type,question,result)
+        return result
+
+    async def _astream_to_queue(self,prompt,queue,user_id,session_id,selected_doc_type,question,cache_entry):
+        """
+        Stream the completion into queue (None marks the end, an exception marks a failure),
+        then cache and persist the full answer. Runs as its own task so the answer is still
+        completed and saved when the client disconnects mid-stream.
+        """
+        question_embedding, corpus_version, started = cache_entry
+        tokens = []
+        usage_chunk = None
+        generate_started = time.perf_counter()
+        try:
+            with stage("generate_stream"):
+                async for chunk in registry.llm.astream(prompt):
+                    if chunk.content:
+                        if not tokens:
+                            STAGE_SECONDS.observe(time.perf_counter() - generate_started, stage="first_token")
+                        tokens.append(chunk.content)
+                        queue.put_nowait(chunk.content)
+                    #Token usage comes with the last chunk (stream_usage)
+                    if getattr(chunk, "usage_metadata", None):
+                        usage_chunk = chunk
+        except Exception as e:
+            print(f"Error streaming answer: {e}")
+            queue.put_nowait(e)
+            return
+        queue.put_nowait(None)
+        record_llm_usage("answer", usage_chunk)
+        
+        result = ''.join(tokens)
+        await asyncio.to_thread(answer_cache.store,user_id,selected_doc_type,question,question_embedding,result,
+                                time.perf_counter()-started,corpus_version)
+
+        #add to chat history
+        await chat_history_obj.aupdate_chat_history(user_id, session_id,selected_doc_type,question,result)
+
+    async def astream_answer(self,question,selected_doc_type, user_id, session_id=None):
+        """
+        Streaming version of aget_answer: yields answer tokens as the model produces them.
+        """
+        session_id = chat_history_obj.start_session(session_id, user_id)
+        started = time.perf_counter()
+        
+        question, context, cached_answer, question_embedding, corpus_version = await self._aprepare_answer(
+            question,selected_doc_type,user_id,session_id
+        )
+
+        if cached_answer is not None:
+            #Saved before yielding: a client that disconnects closes the generator at the yield
+            await chat_history_obj.aupdate_chat_history(user_id, session_id,selected_doc_type,question,cached_answer)
+            yield cached_answer
+            return
+        
+        prompt = self.answer_prompt(question,context)
+        queue = asyncio.Queue()
+        task = asyncio.create_task(
+            self._astream_to_queue(prompt,queue,user_id,session_id,selected_doc_type,question,
+                                   (question_embedding,corpus_version,started))
+        )
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+        while True:
+            token = await queue.get()
+            if token is None:
+                break
+            if isinstance(token, Exception):
+                raise token
+            yield token
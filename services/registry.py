@@ -0,0 +1,113 @@
+from services.get_model import Call_Models
+from services.vectorDB import PGVectorDB
+from services.db_pool import db_pool
+import threading
+import time
+
+class ModelRegistry:
+    """
+    Process-wide, lazily initialized holder of the LLM, the embedding model and
+    the PGVector stores.
+
+    Nothing is constructed at import time: each component is built on first use
+    (or by warm_up() at application startup) and then shared by every module.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._llm = None
+        self._embed = None
+        self._vector_db = None
+        self._stores = {}
+        self.warmed_up_at = None
+        self.last_error = None
+
+    def _load_models(self):
+        with self._lock:
+            if self._llm is None or self._embed is None:
+                llm, embed = Call_Models().get_open_ai_model()
+                self._llm = self._llm or llm
+                self._embed = self._embed or embed
+
+    @property
+    def llm(self):
+        if self._llm is None:
+            self._load_models()
+        return self._llm
+
+    @property
+    def embed(self):
+        if self._embed is None:
+            self._load_models()
+        return self._embed
+
+    def vector_store(self, collection_name: str, async_mode: bool = False):
+        """
+        Return the shared vector store for a collection ("parent_embedding" / "child_embedding").
+        """
+        key = (collection_name, async_mode)
+        store = self._stores.get(key)
+        if store is None:
+            with self._lock:
+                store = self._stores.get(key)
+                if store is None:
+                    if self._vector_db is None:
+                        self._vector_db = PGVectorDB(self.embed)
+                    store = self._vector_db.call_vectorDB(collection_name, async_mode=async_mode)
+                    self._stores[key] = store
+        return store
+
+    def override(self, llm=None, embed=None, stores=None):
+        """
+        Replace components, e.g. with local stand-ins in tests or benchmarks.
+
+        Args:
+            llm: Chat model to use instead of Azure GPT-4o.
+            embed: Embeddings to use instead of Azure embeddings.
+            stores (dict, optional): {(collection_name, async_mode): vector_store}.
+        """
+        with self._lock:
+            if llm is not None:
+                self._llm = llm
+            if embed is not None:
+                self._embed = embed
+                self._vector_db = None
+            if stores:
+                self._stores.update(stores)
+
+    def warm_up(self):
+        """
+        Build every component and check the database, so the first request does not pay
+        for client construction and collection checks. Errors are recorded, not raised.
+        """
+        try:
+            self.llm
+            self.embed
+            for collection_name in ("parent_embedding", "child_embedding"):
+                for async_mode in (False, True):
+                    self.vector_store(collection_name, async_mode=async_mode)
+            with db_pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+            self.warmed_up_at = time.time()
+            self.last_error = None
+        except Exception as e:
+            print(f"Warm-up failed: {e}")
+            self.last_error = str(e)
+        return self.is_ready()
+
+    def is_ready(self) -> bool:
+        return self.warmed_up_at is not None
+
+    def status(self) -> dict:
+        return {
+            "ready": self.is_ready(),
+            "llm_loaded": self._llm is not None,
+            "embeddings_loaded": self._embed is not None,
+            "vector_stores": sorted(f"{name}{' (async)' if async_mode else ''}" for name, async_mode in self._stores),
+            "warmed_up_at": self.warmed_up_at,
+            "last_error": self.last_error,
+        }
+
+
+registry = ModelRegistry()
@@ -0,0 +1,111 @@
+from services.metrics import timed_stage
+from langchain_core.documents import Document
+from dotenv import load_dotenv
+from typing import List, Sequence, Tuple
+import numpy as np
+import os
+
+load_dotenv()
+
+#Child chunks kept by MMR out of the retrieved candidates
+RERANK_MMR_K = int(os.getenv("RERANK_MMR_K", 12))
+#MMR trade-off: 1 ranks by relevance only, 0 by diversity only
+RERANK_MMR_LAMBDA = float(os.getenv("RERANK_MMR_LAMBDA", 0.7))
+#Parent score from the scores of its kept child chunks: "sum" (aggregate evidence) or "max"
+RERANK_PARENT_SCORE = os.getenv("RERANK_PARENT_SCORE", "sum")
+
+#(chunk, relevance score, stored embedding)
+ChildHit = Tuple[Document, float, Sequence[float]]
+
+
+class RerankResult:
+    """Child chunks kept by MMR (with relevance, best first) and parent ids ranked by aggregate score."""
+
+    def __init__(self, chunks: List[Tuple[Document, float]], parents: List[Tuple[str, float]]):
+        self.chunks = chunks
+        self.parents = parents
+
+
+class LocalReranker:
+    """
+    Re-rank child search hits in process from the embeddings returned with them.
+
+    One NumPy pass scores every candidate against the question (cosine), picks a diverse
+    subset with maximal marginal relevance, and aggregates the kept chunk scores per
+    document_id to rank the parent pages, so parents are chosen by evidence rather than
+    by first appearance, without another round trip to Postgres.
+    """
+
+    def __init__(self, mmr_k: int = RERANK_MMR_K, mmr_lambda: float = RERANK_MMR_LAMBDA,
+                 parent_score: str = RERANK_PARENT_SCORE):
+        if parent_score not in ("sum", "max"):
+            raise ValueError(f"Unknown parent score aggregation: {parent_score}")
+        self.mmr_k = mmr_k
+        self.mmr_lambda = mmr_lambda
+        self.parent_score = parent_score
+
+    @staticmethod
+    def _normalize(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    def mmr(self, relevance: np.ndarray, similarity: np.ndarray) -> np.ndarray:
+        """Indices picked by maximal marginal relevance, in pick order."""
+        n = len(relevance)
+        selected = []
+        available = np.ones(n, dtype=bool)
+        #Highest similarity of each candidate to the picked ones (negative similarity is no penalty)
+        redundancy = np.zeros(n, dtype=np.float32)
+        for _ in range(min(self.mmr_k, n)):
+            scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+            scores[~available] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            available[best] = False
+            redundancy = np.maximum(redundancy, similarity[best])
+        return np.array(selected, dtype=int)
+
+    def aggregate_parents(self, document_ids: List[str], scores: np.ndarray) -> List[Tuple[str, float]]:
+        """Parent document ids with the sum (or max) of their chunk scores, best first."""
+        unique_ids, first_seen, inverse = np.unique(np.array(document_ids, dtype=object),
+                                                    return_index=True, return_inverse=True)
+        if self.parent_score == "sum":
+            totals = np.bincount(inverse, weights=scores, minlength=len(unique_ids))
+        else:
+            totals = np.full(len(unique_ids), -np.inf)
+            np.maximum.at(totals, inverse, scores)
+        #Ties keep retrieval order
+        order = np.lexsort((first_seen, -totals))
+        return [(unique_ids[ix], float(totals[ix])) for ix in order]
+
+    @timed_stage("rerank")
+    def rerank(self, query_embedding: Sequence[float], hits: List[ChildHit], use_retriever_scores: bool = False) -> RerankResult:
+        """
+        Args:
+            query_embedding: Embedding of the question.
+            hits: Child search results with their stored embeddings.
+            use_retriever_scores (bool): Rank by the retriever's scores (e.g. hybrid fusion scores,
+                scaled to [0, 1]) instead of the cosine similarity to the question.
+
+        Returns:
+            RerankResult
+        """
+        if not hits:
+            return RerankResult([], [])
+
+        embeddings = self._normalize(np.asarray([embedding for _, _, embedding in hits], dtype=np.float32))
+        query = self._normalize(np.asarray(query_embedding, dtype=np.float32))
+        if use_retriever_scores:
+            relevance = np.asarray([score for _, score, _ in hits], dtype=np.float32)
+            relevance = relevance / max(float(relevance.max()), 1e-9)
+        else:
+            relevance = embeddings @ query
+        similarity = embeddings @ embeddings.T
+
+        picked = self.mmr(relevance, similarity)
+        chunks = [(hits[ix][0], float(relevance[ix])) for ix in picked]
+        parents = self.aggregate_parents([hits[ix][0].metadata["document_id"] for ix in picked], relevance[picked])
+        return RerankResult(chunks, parents)
+
+
+reranker = LocalReranker()
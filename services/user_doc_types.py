@@ -1,32 +1,64 @@
 from fastapi import HTTPException, status
 import psycopg2
-from typing import List, Dict, Any
-import pandas as pd
-from psycopg2.extras import RealDictCursor
+from typing import List, Dict, Any, Optional
+from psycopg2.extras import RealDictCursor, execute_values
+from services.db_pool import db_pool
+from services.metrics import timed_db
 import uuid
-import os 
 
 class DatabaseOperations:
     def __init__(self):
         """
-        Initialize database connection parameters.
-        These values should match your PostgreSQL configuration.
+        Database operations share the process-wide connection pool.
+        Connection parameters come from the environment (see services.db_pool).
         """
-        self.conn_params = {
-            "dbname": os.getenv("DATABASE_NAME"),   # Database name
-            "user": os.getenv("DB_USER"),           # PostgreSQL username
-            "password": os.getenv("DB_PASSWORD"),   # PostgreSQL password
-            "host": os.getenv("HOST"),              # Database host
-            "port": os.getenv("PORT")               # Default PostgreSQL port
-        }
+        self.pool = db_pool
 
     def _get_connection(self):
         """
-        Create and return a new database connection.
-        Uses connection parameters stored in self.conn_params.
+        Borrow a connection from the shared pool.
+        Use as a context manager; the connection is returned to the pool on exit.
         """
-        return psycopg2.connect(**self.conn_params)
+        return self.pool.connection()
 
+    @timed_db("ensure_doc_type_constraint")
+    def ensure_doc_type_constraint(self) -> None:
+        """
+        Remove duplicate (user_id, doc_type) rows and add the unique index that
+        update_table_data upserts against. Safe to run on every startup: workers
+        starting together serialize on an advisory lock, and once the index exists
+        nothing is deleted or created.
+        Raises on error: without the index every add-option call fails.
+        """
+        lock_query = "SELECT pg_advisory_xact_lock(hashtext('user_doc_type_tbl_user_id_doc_type_key'));"
+        exists_query = "SELECT to_regclass('public.user_doc_type_tbl_user_id_doc_type_key') IS NOT NULL;"
+        dedupe_query = """
+        DELETE FROM public.user_doc_type_tbl a
+        USING public.user_doc_type_tbl b
+        WHERE a.ctid > b.ctid AND a.user_id = b.user_id AND a.doc_type = b.doc_type;
+        """
+        index_query = """
+        CREATE UNIQUE INDEX IF NOT EXISTS user_doc_type_tbl_user_id_doc_type_key
+        ON public.user_doc_type_tbl (user_id, doc_type);
+        """
+
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cur:
+                    #Held until the transaction commits, so the DELETE never races another worker's CREATE INDEX
+                    cur.execute(lock_query)
+                    cur.execute(exists_query)
+                    if cur.fetchone()[0]:
+                        return
+                    cur.execute(dedupe_query)
+                    if cur.rowcount:
+                        print(f"Removed {cur.rowcount} duplicate rows from user_doc_type_tbl")
+                    cur.execute(index_query)
+        except psycopg2.Error as e:
+            print(f"Error creating doc_type constraint: {e}")
+            raise
+
+    @timed_db("extract_table_data")
     def extract_table_data(self) -> List[Dict[str, Any]]:
         """
         Extract all user_id and doc_type data from user_doc_type_tbl table.
@@ -40,13 +72,31 @@ class DatabaseOperations:
             with self._get_connection() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
                     cur.execute(query)
-                    results = cur.fetchall()
-                    df = pd.DataFrame(results)  # Convert results to Pandas DataFrame
-                    return df
+                    return cur.fetchall()
         except psycopg2.Error as e:
             print(f"Error extracting data: {e}")
             return []
+
+    @timed_db("extract_doc_types")
+    def extract_doc_types(self) -> List[str]:
+        """
+        Distinct doc_types across all users, sorted.
+
+        Returns:
+            List[str]: Document types.
+        """
+        query = """SELECT DISTINCT doc_type FROM public.user_doc_type_tbl ORDER BY doc_type;"""
+
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query)
+                    return [row[0] for row in cur.fetchall()]
+        except psycopg2.Error as e:
+            print(f"Error extracting doc types: {e}")
+            return []
     
+    @timed_db("extract_table_data_by_user_id")
     def extract_table_data_by_user_id(self, user_id: str) -> Dict[str, Any]:
         """
         Extract all doc_type data according to the given user id from user_doc_type_tbl table.
@@ -74,79 +124,172 @@ class DatabaseOperations:
         except psycopg2.Error as e:
             print(f"Error extracting data: {e}")
 
-            raise HTTPException(status_code = status, detail = str(e))  
+            raise HTTPException(status_code = status.HTTP_500_INTERNAL_SERVER_ERROR, detail = str(e))  
 
-    def update_table_data(self, user_id: str, doc_type: str) -> None:
+    @timed_db("update_table_data")
+    def update_table_data(self, user_id: str, doc_type: str, notify_channel: Optional[str] = None) -> bool:
         """
-        Insert a new record into user_doc_type_tbl table.
+        Insert a (user_id, doc_type) record into user_doc_type_tbl table, unless it already exists.
 
         Args:
             user_id (str): Unique User ID.
             doc_type (str): Document type associated with the user.
+            notify_channel (str, optional): NOTIFY this channel with the user_id when a row is
+                inserted; the notification is delivered when the insert commits.
+
+        Returns:
+            bool: True if a new row was inserted, False if the user already had the doc_type.
+
+        Raises:
+            HTTPException: 500 on a database error.
         """
         query = """
-        INSERT INTO public.user_doc_type_tbl (user_id, doc_type) VALUES (%s, %s);
+        INSERT INTO public.user_doc_type_tbl (user_id, doc_type) VALUES (%s, %s)
+        ON CONFLICT (user_id, doc_type) DO NOTHING
+        RETURNING user_id;
         """
         
         try:
             with self._get_connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute(query, (user_id, doc_type))
-                conn.commit()  # Commit the transaction after insertion
+                    inserted = cur.fetchone() is not None
+                    if inserted and notify_channel:
+                        cur.execute("SELECT pg_notify(%s, %s);", (notify_channel, user_id))
+            return inserted
         except psycopg2.Error as e:
             print(f"Error inserting data: {e}")
+            raise HTTPException(status_code = status.HTTP_500_INTERNAL_SERVER_ERROR, detail = str(e))
 
-    def check_doc_id_exists(self, doc_id: str) -> str:
+    @timed_db("ensure_upload_table")
+    def ensure_upload_table(self) -> None:
         """
-        Check if a specific document ID exists in the user_doc_upload_tbl table.
+        Add the doc_type and created_at columns of user_doc_upload_tbl, the unique doc_id index
+        that register_uploads relies on, and the (user_id, doc_type) index used to list a user's
+        documents. Safe to run on every startup.
+        """
+        queries = [
+            "ALTER TABLE public.user_doc_upload_tbl ADD COLUMN IF NOT EXISTS doc_type TEXT;",
+            "ALTER TABLE public.user_doc_upload_tbl ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT now();",
+            """CREATE UNIQUE INDEX IF NOT EXISTS user_doc_upload_tbl_doc_id_key
+            ON public.user_doc_upload_tbl (doc_id);""",
+            """CREATE INDEX IF NOT EXISTS user_doc_upload_tbl_user_id_doc_type_idx
+            ON public.user_doc_upload_tbl (user_id, doc_type);""",
+        ]
+
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor() as cur:
+                    for query in queries:
+                        cur.execute(query)
+        except psycopg2.Error as e:
+            print(f"Error preparing user_doc_upload_tbl: {e}")
+
+    @timed_db("register_uploads")
+    def register_uploads(self, user_id: str, doc_type: str, doc_names: List[str],
+                         doc_ids: Optional[List[str]] = None) -> List[str]:
+        """
+        Record uploaded documents in user_doc_upload_tbl with one multi-row INSERT.
+        The returned doc_id of each document is the file_id its chunks are stored under.
 
         Args:
-            doc_id (str): Unique document ID.
+            user_id (str): Unique User ID.
+            doc_type (str): Document type the documents are ingested under.
+            doc_names (List[str]): Names of the uploaded documents.
+            doc_ids (List[str], optional): Ids to register the documents under (e.g. the file_id of
+                a resumed ingestion). An id that is already registered is left as it is.
+                New UUIDs are generated by default.
 
         Returns:
-            str: The existing doc_id if found, otherwise an empty string.
+            List[str]: The doc_id of every document, in the order of doc_names.
         """
         query = """
-        SELECT doc_id FROM public.user_doc_upload_tbl 
-        WHERE doc_id = %s;
+        INSERT INTO public.user_doc_upload_tbl (user_id, doc_type, doc_name, doc_id)
+        VALUES %s
+        ON CONFLICT (doc_id) DO NOTHING
+        RETURNING doc_id;
         """
+        generated = doc_ids is None
+        doc_ids = list(doc_ids) if doc_ids is not None else [str(uuid.uuid4()) for _ in doc_names]
 
         try:
             with self._get_connection() as conn:
                 with conn.cursor() as cur:
-                    cur.execute(query, (doc_id,))
-                    result = cur.fetchone()
-                    return result[0] if result else ""  # Return doc_id if exists, else empty string
+                    pending = list(range(len(doc_names)))
+                    while pending:
+                        rows = [(user_id, doc_type, doc_names[ix], doc_ids[ix]) for ix in pending]
+                        inserted = {row[0] for row in execute_values(cur, query, rows, fetch=True)}
+                        # A generated UUID that collided with an existing doc_id gets a new one
+                        pending = [ix for ix in pending if doc_ids[ix] not in inserted] if generated else []
+                        for ix in pending:
+                            doc_ids[ix] = str(uuid.uuid4())
+            return doc_ids
         except psycopg2.Error as e:
-            print(f"Error checking doc_id: {e}")
-            return ""
+            print(f"Error registering uploads: {e}")
+            raise HTTPException(status_code = status.HTTP_500_INTERNAL_SERVER_ERROR, detail = str(e))
 
-    def document_upload_info(self, doc_name: str, user_id: str):
+    def document_upload_info(self, doc_name: str, user_id: str, doc_type: Optional[str] = None) -> str:
         """
         Insert a new document upload entry into user_doc_upload_tbl.
-        Ensures that the generated document ID (UUID) is unique.
 
-        Args:
-            doc_name (str): Name of the uploaded document.
-            user_id (str): Unique User ID.
+        Returns:
+            str: The new doc_id.
         """
-        while True:
-            new_doc_id = str(uuid.uuid4())  # Generate a new UUID for the document
-            
-            # Check if the generated doc_id already exists in the table
-            if not self.check_doc_id_exists(new_doc_id):  # If doc_id does not exist, insert it
-                query = """
-                INSERT INTO public.user_doc_upload_tbl (user_id, doc_name, doc_id) 
-                VALUES (%s, %s, %s);
-                """
-
-                try:
-                    with self._get_connection() as conn:
-                        with conn.cursor() as cur:
-                            cur.execute(query, (user_id, doc_name, new_doc_id))
-                        conn.commit()  # Commit the transaction
-                    print(f"✅ New document inserted with doc_id: {new_doc_id}")
-                except psycopg2.Error as e:
-                    print(f"Error inserting document: {e}")      
-                
-                break  # Exit the loop once a valid doc_id is inserted
+        return self.register_uploads(user_id, doc_type, [doc_name])[0]
+
+    @timed_db("list_user_documents")
+    def list_user_documents(self, user_id: str, doc_type: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Documents uploaded by a user, newest first, optionally of one doc_type.
+
+        Returns:
+            List[Dict[str, Any]]: doc_id, doc_name, doc_type and created_at of every document.
+        """
+        query = """
+        SELECT doc_id, doc_name, doc_type, created_at FROM public.user_doc_upload_tbl
+        WHERE user_id = %s AND (%s::text IS NULL OR doc_type = %s)
+        ORDER BY created_at DESC NULLS LAST;
+        """
+
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(query, (user_id, doc_type, doc_type))
+                    return cur.fetchall()
+        except psycopg2.Error as e:
+            print(f"Error listing documents: {e}")
+            raise HTTPException(status_code = status.HTTP_500_INTERNAL_SERVER_ERROR, detail = str(e))
+
+    @timed_db("delete_user_document")
+    def delete_user_document(self, user_id: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Delete a user's document and its parent and child chunks in one transaction.
+        Chunks are found through the (collection_id, cmetadata->>'file_id') index.
+
+        Returns:
+            Dict[str, Any]: doc_name, doc_type and the number of deleted chunks,
+            or None if the user has no such document.
+        """
+        document_query = """
+        DELETE FROM public.user_doc_upload_tbl WHERE user_id = %s AND doc_id = %s
+        RETURNING doc_name, doc_type;
+        """
+        chunks_query = """
+        DELETE FROM public.langchain_pg_embedding
+        WHERE collection_id IN (SELECT uuid FROM public.langchain_pg_collection WHERE name IN ('parent_embedding', 'child_embedding'))
+          AND cmetadata->>'file_id' = %s
+          AND cmetadata->>'user_id' = %s;
+        """
+
+        try:
+            with self._get_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(document_query, (user_id, doc_id))
+                    document = cur.fetchone()
+                    if document is None:
+                        return None
+                    cur.execute(chunks_query, (doc_id, user_id))
+                    return {**document, "deleted_chunks": cur.rowcount}
+        except psycopg2.Error as e:
+            print(f"Error deleting document: {e}")
+            raise HTTPException(status_code = status.HTTP_500_INTERNAL_SERVER_ERROR, detail = str(e))
@@ -1,23 +1,251 @@
 from langchain_postgres import PGVector
 from langchain_postgres.vectorstores import PGVector
+from langchain_core.documents import Document
+from sqlalchemy import and_, select, text
+from services.db_pool import get_engine
+from typing import List, Optional, Tuple
 from dotenv import load_dotenv
+import numpy as np
+import json
 import os
+import re
 
 load_dotenv()
 
+#Text search configuration of the tsvector expression index (see services.vector_index)
+TS_CONFIG = os.getenv("HYBRID_TS_CONFIG", "english")
+
+#Candidates taken from each ranking before fusion, and the reciprocal rank fusion constant
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 50))
+RRF_K = int(os.getenv("HYBRID_RRF_K", 60))
+
+HYBRID_QUERY = """
+WITH vector_ranked AS (
+    SELECT id, row_number() OVER (ORDER BY embedding <=> CAST(:embedding AS vector)) AS rank
+    FROM langchain_pg_embedding
+    WHERE collection_id = :collection_id {metadata_filter}
+    ORDER BY embedding <=> CAST(:embedding AS vector)
+    LIMIT :candidates
+),
+lexical_ranked AS (
+    SELECT id, row_number() OVER (ORDER BY ts_rank_cd(to_tsvector('{ts_config}', document), query) DESC) AS rank
+    FROM langchain_pg_embedding, websearch_to_tsquery('{ts_config}', :query) AS query
+    WHERE collection_id = :collection_id {metadata_filter}
+      AND to_tsvector('{ts_config}', document) @@ query
+    ORDER BY ts_rank_cd(to_tsvector('{ts_config}', document), query) DESC
+    LIMIT :candidates
+),
+fused AS (
+    SELECT coalesce(v.id, l.id) AS id,
+           coalesce(1.0 / (:rrf_k + v.rank), 0) + coalesce(1.0 / (:rrf_k + l.rank), 0) AS score
+    FROM vector_ranked v FULL OUTER JOIN lexical_ranked l ON v.id = l.id
+)
+SELECT e.id, e.document, e.cmetadata, e.embedding, f.score
+FROM fused f JOIN langchain_pg_embedding e ON e.id = f.id
+ORDER BY f.score DESC
+LIMIT :k
+"""
+
+def _as_vector(value) -> np.ndarray:
+    #pgvector columns read through text() come back in their text form, "[0.1,0.2,...]"
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+class SherlockPGVector(PGVector):
+    """
+    PGVector store with lookups that go straight to the metadata column,
+    so fetching known documents never calls the embedding model, a hybrid
+    (full-text + vector) search fused with reciprocal rank fusion in SQL, and
+    searches that return the stored embeddings for local re-ranking.
+    """
+
+    def _create_filter_clause(self, filters):
+        """
+        Compile flat string equality filters ({"user_id": .., "doc_type": ..}) to
+        `cmetadata->>'key' = value`, which the (collection_id, cmetadata->>key) expression
+        indexes and the tenant index can serve. PGVector compiles them to jsonb_path_match,
+        which no btree index can. Any other filter keeps the PGVector semantics.
+        """
+        if (isinstance(filters, dict) and filters
+                and all(not key.startswith("$") and isinstance(value, str) for key, value in filters.items())):
+            return and_(*[self.EmbeddingStore.cmetadata[key].astext == value for key, value in filters.items()])
+        return super()._create_filter_clause(filters)
+
+    def get_by_metadata(self, key: str, values: List[str], filter: Optional[dict] = None) -> List[Document]:
+        """
+        Fetch every document of this collection whose metadata `key` is one of `values`
+        in a single query.
+
+        Args:
+            key (str): Metadata key to match on (e.g. "document_id").
+            values (List[str]): Accepted values for the key.
+            filter (dict, optional): Extra metadata filter in the usual PGVector syntax.
+
+        Returns:
+            List[Document]: Matching documents, in no particular order.
+        """
+        if not values:
+            return []
+
+        with self._make_sync_session() as session:
+            collection = self.get_collection(session)
+            if not collection:
+                raise ValueError("Collection not found")
+
+            filter_by = [
+                self.EmbeddingStore.collection_id == collection.uuid,
+                self.EmbeddingStore.cmetadata[key].astext.in_([str(value) for value in values]),
+            ]
+            if filter:
+                filter_by.append(self._create_filter_clause(filter))
+
+            rows = session.query(self.EmbeddingStore).filter(*filter_by).all()
+
+        return [Document(id=str(row.id), page_content=row.document, metadata=row.cmetadata) for row in rows]
+
+    async def aget_by_metadata(self, key: str, values: List[str], filter: Optional[dict] = None) -> List[Document]:
+        """Async version of get_by_metadata, for stores created with async_mode=True."""
+        if not values:
+            return []
+
+        # aget_collection runs the store's lazy async init (extension, tables, collection)
+        async with self._make_async_session() as session:
+            collection = await self.aget_collection(session)
+            if not collection:
+                raise ValueError("Collection not found")
+
+            filter_by = [
+                self.EmbeddingStore.collection_id == collection.uuid,
+                self.EmbeddingStore.cmetadata[key].astext.in_([str(value) for value in values]),
+            ]
+            if filter:
+                filter_by.append(self._create_filter_clause(filter))
+
+            result = await session.execute(select(self.EmbeddingStore).filter(*filter_by))
+            rows = result.scalars().all()
+
+        return [Document(id=str(row.id), page_content=row.document, metadata=row.cmetadata) for row in rows]
+
+    def _hybrid_statement(self, query: str, embedding: List[float], collection_id, k: int, filter: Optional[dict]):
+        """
+        Build the hybrid search statement. filter is a flat {metadata_key: value} equality filter.
+        """
+        params = {
+            "embedding": str(list(embedding)),
+            "collection_id": collection_id,
+            "query": query,
+            "candidates": max(HYBRID_CANDIDATES, k),
+            "rrf_k": RRF_K,
+            "k": k,
+        }
+        conditions = []
+        for ix,(key,value) in enumerate((filter or {}).items()):
+            # Keys are inlined so the (cmetadata->>'key') expression indexes can be used
+            if not re.fullmatch(r"\w+", key):
+                raise ValueError(f"Invalid metadata key: {key}")
+            conditions.append(f"AND cmetadata->>'{key}' = :filter_value_{ix}")
+            params[f"filter_value_{ix}"] = str(value)
+
+        statement = text(HYBRID_QUERY.format(metadata_filter=" ".join(conditions), ts_config=TS_CONFIG))
+        return statement, params
+
+    @staticmethod
+    def _hybrid_results(rows) -> List[Tuple[Document, float, np.ndarray]]:
+        return [
+            (Document(id=str(row.id), page_content=row.document, metadata=row.cmetadata), float(row.score), _as_vector(row.embedding))
+            for row in rows
+        ]
+
+    def _vector_results(self, rows) -> List[Tuple[Document, float, np.ndarray]]:
+        relevance = self._select_relevance_score_fn()
+        return [
+            (Document(id=str(row.EmbeddingStore.id), page_content=row.EmbeddingStore.document, metadata=row.EmbeddingStore.cmetadata),
+             relevance(row.distance), _as_vector(row.EmbeddingStore.embedding))
+            for row in rows
+        ]
+
+    def similarity_search_with_embeddings(self, query: str, k: int = 4, filter: Optional[dict] = None):
+        """
+        Like similarity_search_with_relevance_scores, but every hit also carries its stored
+        embedding, so the caller can re-rank locally without another query.
+
+        Returns:
+            tuple: (query embedding, [(Document, relevance score, embedding)] best first)
+        """
+        embedding = self.embeddings.embed_query(query)
+        rows = self._PGVector__query_collection(embedding=embedding, k=k, filter=filter)
+        return embedding, self._vector_results(rows)
+
+    async def asimilarity_search_with_embeddings(self, query: str, k: int = 4, filter: Optional[dict] = None):
+        """Async version of similarity_search_with_embeddings, for stores created with async_mode=True."""
+        embedding = await self.embeddings.aembed_query(query)
+        rows = await self._PGVector__aquery_collection(None, embedding=embedding, k=k, filter=filter)
+        return embedding, self._vector_results(rows)
+
+    def hybrid_search_with_scores(self, query: str, k: int = 15, filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        """
+        Rank chunks by full-text match and by embedding distance, fuse both rankings with
+        reciprocal rank fusion and return the top k, all in one round trip.
+
+        Args:
+            query (str): User question.
+            k (int): Number of fused results.
+            filter (dict, optional): Flat metadata equality filter, e.g. {"user_id": .., "doc_type": ..}.
+
+        Returns:
+            List[Tuple[Document, float]]: Documents with their RRF score, best first.
+        """
+        _, hits = self.hybrid_search_with_embeddings(query, k=k, filter=filter)
+        return [(doc, score) for doc, score, _ in hits]
+
+    def hybrid_search_with_embeddings(self, query: str, k: int = 15, filter: Optional[dict] = None):
+        """
+        hybrid_search_with_scores that also returns the question embedding and the stored
+        embedding of every hit.
+
+        Returns:
+            tuple: (query embedding, [(Document, RRF score, embedding)] best first)
+        """
+        embedding = self.embeddings.embed_query(query)
+        with self._make_sync_session() as session:
+            collection = self.get_collection(session)
+            if not collection:
+                raise ValueError("Collection not found")
+            statement, params = self._hybrid_statement(query, embedding, collection.uuid, k, filter)
+            rows = session.execute(statement, params).all()
+        return embedding, self._hybrid_results(rows)
+
+    async def ahybrid_search_with_scores(self, query: str, k: int = 15, filter: Optional[dict] = None) -> List[Tuple[Document, float]]:
+        """Async version of hybrid_search_with_scores, for stores created with async_mode=True."""
+        _, hits = await self.ahybrid_search_with_embeddings(query, k=k, filter=filter)
+        return [(doc, score) for doc, score, _ in hits]
+
+    async def ahybrid_search_with_embeddings(self, query: str, k: int = 15, filter: Optional[dict] = None):
+        """Async version of hybrid_search_with_embeddings."""
+        embedding = await self.embeddings.aembed_query(query)
+        async with self._make_async_session() as session:
+            collection = await self.aget_collection(session)
+            if not collection:
+                raise ValueError("Collection not found")
+            statement, params = self._hybrid_statement(query, embedding, collection.uuid, k, filter)
+            rows = (await session.execute(statement, params)).all()
+        return embedding, self._hybrid_results(rows)
+
+
 class PGVectorDB:
     def __init__(self,embed):
         self.embed = embed
         self.connection = os.getenv("DATABASE_URL")  # Uses psycopg3!
 
-    def call_vectorDB(self,collection_name):
-        vector_store = PGVector(
+    def call_vectorDB(self,collection_name,async_mode=False):
+        # All stores share one engine (and connection pool) per mode
+        vector_store = SherlockPGVector(
             embeddings=self.embed,
             collection_name=collection_name,
-            connection=self.connection,
+            connection=get_engine(async_mode),
             use_jsonb=True,
+            async_mode=async_mode,
         )
         return vector_store
-        
-
-
@@ -0,0 +1,278 @@
+from services.db_pool import ITERATIVE_SCAN_MIN_VERSION, get_engine, pgvector_version
+from services.vectorDB import TS_CONFIG
+from sqlalchemy import text
+from typing import List, Optional, Tuple
+import argparse
+import json
+
+EMBEDDING_TABLE = "langchain_pg_embedding"
+COLLECTION_TABLE = "langchain_pg_collection"
+
+# JSONB metadata keys used in retrieval filters and lookups
+METADATA_INDEX_KEYS = ["doc_type", "document_id", "file_id"]
+
+# Retrieval is scoped to one tenant: (user_id, doc_type)
+TENANT_INDEX_KEYS = ["user_id", "doc_type"]
+
+class VectorIndexManager:
+    """
+    Create, rebuild and inspect the indexes behind the parent_embedding /
+    child_embedding collections:
+
+    - an ANN index (HNSW or IVFFlat, cosine distance) on the embedding column
+    - expression indexes on (collection_id, cmetadata->>key) for the filter keys
+    - a tenant index on (collection_id, user_id, doc_type). Both retrievers filter the
+      tenant with `cmetadata->>key = value` (SherlockPGVector._create_filter_clause and the
+      hybrid query), so when the planner picks this index (small tenants) it scans only
+      that tenant's rows and sorts them exactly
+    - a GIN index on to_tsvector(document) for the hybrid retriever's full-text ranking
+
+    When the planner picks the ANN index instead, the tenant filter is applied to the
+    ef_search / probes candidates the index returns, which can leave a small tenant
+    with fewer than k chunks. Every connection of the shared engine therefore enables
+    pgvector's iterative index scans (hnsw.iterative_scan / ivfflat.iterative_scan,
+    pgvector >= 0.8.0), which keep scanning until k filtered rows are found; see
+    services.db_pool. Query-time tuning (hnsw.ef_search / ivfflat.probes) is applied
+    from VECTOR_EF_SEARCH / VECTOR_IVFFLAT_PROBES.
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or get_engine()
+
+    def _autocommit(self):
+        # CREATE/REINDEX ... CONCURRENTLY cannot run inside a transaction
+        return self.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+    def ann_index_name(self, method: str) -> str:
+        return f"ix_{EMBEDDING_TABLE}_{method}"
+
+    def ensure_dimensions(self, conn) -> Optional[int]:
+        """
+        ANN indexes need a fixed-size vector column. If the column was created without
+        a size, pin it to the dimension of the stored embeddings.
+        """
+        column_type = conn.execute(text(
+            """SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+            WHERE attrelid = CAST(:table AS regclass) AND attname = 'embedding'"""
+        ), {"table": EMBEDDING_TABLE}).scalar()
+        if column_type and column_type != "vector":
+            return int(column_type[len("vector("):-1])
+
+        dimensions = conn.execute(text(f"SELECT vector_dims(embedding) FROM {EMBEDDING_TABLE} LIMIT 1")).scalar()
+        if dimensions is None:
+            print("No embeddings stored yet, ANN index not created")
+            return None
+        print(f"Pinning {EMBEDDING_TABLE}.embedding to vector({dimensions})")
+        conn.execute(text(f"ALTER TABLE {EMBEDDING_TABLE} ALTER COLUMN embedding TYPE vector({dimensions})"))
+        return dimensions
+
+    def create_indexes(self, method: str = "hnsw", m: int = 16, ef_construction: int = 64, lists: int = 100):
+        """
+        Create the ANN index and the metadata expression indexes if they do not exist.
+
+        Args:
+            method (str): "hnsw" or "ivfflat".
+            m (int): HNSW graph degree.
+            ef_construction (int): HNSW build-time candidate list size.
+            lists (int): IVFFlat number of lists (rule of thumb: rows / 1000).
+        """
+        if method not in ("hnsw", "ivfflat"):
+            raise ValueError(f"Unknown index method: {method}")
+
+        with self._autocommit() as conn:
+            for key in METADATA_INDEX_KEYS:
+                print(f"Creating metadata index on {key}")
+                conn.execute(text(
+                    f"""CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{EMBEDDING_TABLE}_{key}
+                    ON {EMBEDDING_TABLE} (collection_id, (cmetadata->>'{key}'))"""
+                ))
+
+            tenant_columns = ", ".join(f"(cmetadata->>'{key}')" for key in TENANT_INDEX_KEYS)
+            print(f"Creating tenant index on {', '.join(TENANT_INDEX_KEYS)}")
+            conn.execute(text(
+                f"""CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{EMBEDDING_TABLE}_tenant
+                ON {EMBEDDING_TABLE} (collection_id, {tenant_columns})"""
+            ))
+
+            print(f"Creating full-text index ({TS_CONFIG})")
+            conn.execute(text(
+                f"""CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_{EMBEDDING_TABLE}_document_tsv
+                ON {EMBEDDING_TABLE} USING gin (to_tsvector('{TS_CONFIG}', document))"""
+            ))
+
+            if self.ensure_dimensions(conn) is None:
+                return
+            version = pgvector_version(conn.connection.cursor())
+            if version is None or version < ITERATIVE_SCAN_MIN_VERSION:
+                print(f"pgvector {'.'.join(map(str, version or ()))} has no iterative index scans: tenant-filtered "
+                      f"ANN queries can return fewer than k rows. Upgrade to pgvector >= "
+                      f"{'.'.join(map(str, ITERATIVE_SCAN_MIN_VERSION))}")
+            options = f"m = {int(m)}, ef_construction = {int(ef_construction)}" if method == "hnsw" else f"lists = {int(lists)}"
+            print(f"Creating {method} index ({options})")
+            conn.execute(text(
+                f"""CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.ann_index_name(method)}
+                ON {EMBEDDING_TABLE} USING {method} (embedding vector_cosine_ops) WITH ({options})"""
+            ))
+
+    def rebuild(self, index_name: Optional[str] = None):
+        """Rebuild one index, or every index of the embedding table, without blocking writes."""
+        with self._autocommit() as conn:
+            names = [index_name] if index_name else [row["index_name"] for row in self.inspect()]
+            for name in names:
+                print(f"Rebuilding {name}")
+                conn.execute(text(f'REINDEX INDEX CONCURRENTLY "{name}"'))
+
+    def backfill_user_ids(self, file_owners: List[Tuple[str, str]]) -> dict:
+        """
+        Add user_id to the metadata of chunks ingested before it was recorded.
+
+        Owners are resolved from, in order:
+        1. file_owners: known (file_id, user_id) pairs (ingestion job queue, content index)
+        2. user_doc_type_tbl, for doc_types that belong to exactly one user. This is a
+           heuristic: user_doc_type_tbl lists the doc_types a user has added, not who uploaded
+           each file, so a doc_type shared by several users (or owned by nobody) resolves to
+           no one, and its chunks are left with a NULL user_id.
+        Chunks that remain without user_id are reported and stay out of tenant-scoped retrieval
+        until their owner is set by hand.
+        """
+        updated_by_file = 0
+        with self.engine.begin() as conn:
+            for file_id, user_id in file_owners:
+                updated_by_file += conn.execute(text(
+                    f"""UPDATE {EMBEDDING_TABLE}
+                    SET cmetadata = cmetadata || jsonb_build_object('user_id', CAST(:user_id AS text))
+                    WHERE cmetadata->>'file_id' = :file_id AND cmetadata->>'user_id' IS NULL"""
+                ), {"file_id": file_id, "user_id": user_id}).rowcount
+
+            updated_by_doc_type = conn.execute(text(
+                f"""UPDATE {EMBEDDING_TABLE} e
+                SET cmetadata = e.cmetadata || jsonb_build_object('user_id', owners.user_id)
+                FROM (SELECT doc_type, min(user_id) AS user_id FROM public.user_doc_type_tbl
+                      GROUP BY doc_type HAVING count(DISTINCT user_id) = 1) owners
+                WHERE e.cmetadata->>'doc_type' = owners.doc_type AND e.cmetadata->>'user_id' IS NULL"""
+            )).rowcount
+
+            remaining = conn.execute(text(
+                f"SELECT count(*) FROM {EMBEDDING_TABLE} WHERE cmetadata->>'user_id' IS NULL"
+            )).scalar()
+
+        return {
+            "updated_by_file_id": updated_by_file,
+            "updated_by_doc_type_owner": updated_by_doc_type,
+            "remaining_without_user_id": remaining,
+        }
+
+    def inspect(self) -> List[dict]:
+        """Definition, size and usage counters of every index on the embedding table."""
+        with self.engine.connect() as conn:
+            rows = conn.execute(text(
+                """SELECT i.indexrelname AS index_name,
+                          pg_get_indexdef(i.indexrelid) AS definition,
+                          pg_size_pretty(pg_relation_size(i.indexrelid)) AS size,
+                          i.idx_scan AS scans,
+                          i.idx_tup_read AS tuples_read
+                FROM pg_stat_user_indexes i
+                WHERE i.relname = :table
+                ORDER BY i.indexrelname"""
+            ), {"table": EMBEDDING_TABLE}).mappings().all()
+        return [dict(row) for row in rows]
+
+    def recall(self, collection_name: str, sample: int = 20, k: int = 10,
+               ef_search: Optional[int] = None, probes: Optional[int] = None) -> dict:
+        """
+        Estimate ANN recall@k against exact search, using `sample` stored embeddings of the
+        collection as queries.
+        """
+        query = text(
+            f"""SELECT e.id FROM {EMBEDDING_TABLE} e
+            WHERE e.collection_id = :collection_id
+            ORDER BY e.embedding <=> CAST(:query AS vector) LIMIT :k"""
+        )
+        recalls = []
+        with self.engine.connect() as conn:
+            collection_id = conn.execute(
+                text(f"SELECT uuid FROM {COLLECTION_TABLE} WHERE name = :name"), {"name": collection_name}
+            ).scalar()
+            if collection_id is None:
+                raise ValueError(f"Collection {collection_name} not found")
+
+            queries = conn.execute(text(
+                f"""SELECT embedding::text FROM {EMBEDDING_TABLE}
+                WHERE collection_id = :collection_id ORDER BY random() LIMIT :sample"""
+            ), {"collection_id": collection_id, "sample": sample}).scalars().all()
+            conn.commit()
+
+            for vector in queries:
+                params = {"collection_id": collection_id, "query": vector, "k": k}
+                with conn.begin():
+                    conn.execute(text("SET LOCAL enable_indexscan = off"))
+                    exact = set(conn.execute(query, params).scalars().all())
+                with conn.begin():
+                    conn.execute(text("SET LOCAL enable_seqscan = off"))
+                    if ef_search:
+                        conn.execute(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+                    if probes:
+                        conn.execute(text(f"SET LOCAL ivfflat.probes = {int(probes)}"))
+                    approximate = set(conn.execute(query, params).scalars().all())
+                if exact:
+                    recalls.append(len(exact & approximate) / len(exact))
+
+        return {
+            "collection": collection_name,
+            "queries": len(recalls),
+            "k": k,
+            "ef_search": ef_search,
+            "probes": probes,
+            f"recall_at_{k}": sum(recalls) / len(recalls) if recalls else None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage vector and metadata indexes of the embedding collections")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create = subparsers.add_parser("create", help="Create ANN and metadata indexes")
+    create.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+    create.add_argument("--m", type=int, default=16)
+    create.add_argument("--ef-construction", type=int, default=64)
+    create.add_argument("--lists", type=int, default=100)
+
+    rebuild = subparsers.add_parser("rebuild", help="Rebuild indexes concurrently")
+    rebuild.add_argument("--index", default=None)
+
+    subparsers.add_parser("inspect", help="List indexes with size and usage")
+
+    subparsers.add_parser("backfill-user-id", help="Add user_id to chunks ingested before tenant scoping")
+
+    report = subparsers.add_parser("report", help="Index usage and ANN recall against exact search")
+    report.add_argument("--collection", default="child_embedding")
+    report.add_argument("--sample", type=int, default=20)
+    report.add_argument("--k", type=int, default=10)
+    report.add_argument("--ef-search", type=int, default=None)
+    report.add_argument("--probes", type=int, default=None)
+
+    args = parser.parse_args()
+    manager = VectorIndexManager()
+
+    if args.command == "create":
+        manager.create_indexes(args.method, m=args.m, ef_construction=args.ef_construction, lists=args.lists)
+    elif args.command == "rebuild":
+        manager.rebuild(args.index)
+    elif args.command == "backfill-user-id":
+        from services.ingestion_jobs import ingestion_jobs
+        from services.content_cache import content_cache
+        file_owners = set(ingestion_jobs.file_owners()) | set(map(tuple, content_cache.file_owners()))
+        print(json.dumps(manager.backfill_user_ids(sorted(file_owners)), indent=2))
+    elif args.command == "inspect":
+        print(json.dumps(manager.inspect(), indent=2, default=str))
+    elif args.command == "report":
+        result = {
+            "indexes": manager.inspect(),
+            "recall": manager.recall(args.collection, sample=args.sample, k=args.k,
+                                     ef_search=args.ef_search, probes=args.probes),
+        }
+        print(json.dumps(result, indent=2, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("langchain_openai")
+
+import psycopg2
+
+from services.chat_history import ChatHistoryWriter
+
+
+class RecordingWriter(ChatHistoryWriter):
+    """Writer whose inserts go to a list; rows with a NUL byte fail like psycopg2 does."""
+
+    def __init__(self, **kwargs):
+        super().__init__(pool=None, **kwargs)
+        self.rows = []
+        self.database_down = False
+
+    def _insert(self, rows):
+        if self.database_down:
+            raise psycopg2.OperationalError("connection refused")
+        if any("\x00" in row[3] for row in rows):
+            raise ValueError("A string literal cannot contain NUL (0x00) characters.")
+        self.rows.extend(rows)
+
+
+def test_bad_row_is_dropped_and_does_not_block_later_rows():
+    writer = RecordingWriter(batch_size=10)
+    writer._stopping.set()  # no background thread, flush by hand
+    for question in ["first", "bad\x00question", "third"]:
+        writer.enqueue("user", "session", "report", question, "answer")
+
+    assert writer.flush()
+    assert [row[3] for row in writer.rows] == ["first", "third"]
+    assert writer.stats()["dead_lettered"] == 1
+
+
+def test_connection_errors_keep_rows_pending_within_the_cap():
+    writer = RecordingWriter(batch_size=10, max_queue=3)
+    writer._stopping.set()
+    writer.database_down = True
+    for ix in range(6):
+        writer.enqueue("user", "session", "report", f"q{ix}", "answer")
+    assert not writer.flush()
+    assert writer.stats()["pending_retry"] == 3
+
+    writer.database_down = False
+    assert writer.flush()
+    assert len(writer.rows) == 3
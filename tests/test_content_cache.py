@@ -0,0 +1,36 @@
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+# The module-level caches are created on import: keep them out of the working tree
+os.environ.setdefault("CONTENT_CACHE_DIR", tempfile.mkdtemp(prefix="content-cache-test-"))
+
+from services.content_cache import ContentCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ContentCache(str(tmp_path))
+
+
+def test_first_claim_wins_and_duplicates_map_to_it(cache):
+    assert cache.claim_file("hash", "user", "report", "file-a", "a.pdf") == "file-a"
+    assert cache.claim_file("hash", "user", "report", "file-b", "b.pdf") == "file-a"
+    # A resumed ingestion finds its own claim
+    assert cache.claim_file("hash", "user", "report", "file-a", "a.pdf") == "file-a"
+
+
+def test_released_claim_can_be_taken_by_another_file(cache):
+    cache.claim_file("hash", "user", "report", "file-a", "a.pdf")
+    cache.release_file("hash", "user", "report", "file-a")
+    assert cache.claim_file("hash", "user", "report", "file-b", "b.pdf") == "file-b"
+
+
+def test_completed_file_is_not_released(cache):
+    cache.claim_file("hash", "user", "report", "file-a", "a.pdf")
+    cache.add_file("hash", "user", "report", "file-a", "a.pdf")
+    cache.release_file("hash", "user", "report", "file-a")
+    assert cache.find_file("hash", "user", "report") == "file-a"
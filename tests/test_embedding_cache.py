@@ -0,0 +1,23 @@
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from services.embedding_cache import EmbeddingCache
+
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    cache = EmbeddingCache(max_size=1, cache_dir=str(tmp_path))
+    cache.set("key", [0.5, -1.0, 2.0])
+
+    restarted = EmbeddingCache(max_size=1, cache_dir=str(tmp_path))
+    assert restarted.get("key") == [0.5, -1.0, 2.0]
+    assert restarted.stats()["disk_hits"] == 1
+
+
+def test_disk_tier_is_pruned_to_max_disk_entries(tmp_path):
+    cache = EmbeddingCache(max_size=1, cache_dir=str(tmp_path), max_disk_entries=2, prune_every=100)
+    for ix in range(4):
+        cache.set(f"key-{ix}", [float(ix)])
+    assert cache.prune() == 2
+    assert cache.get("key-0") is None
+    assert cache.get("key-3") == [3.0]
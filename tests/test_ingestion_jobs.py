@@ -0,0 +1,43 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+pytest.importorskip("langchain_core")
+pytest.importorskip("psycopg2")
+
+# The module-level queue and caches are created on import: keep them out of the working tree
+_workdir = tempfile.mkdtemp(prefix="ingestion-jobs-test-")
+os.environ.setdefault("INGEST_JOB_DB", os.path.join(_workdir, "ingestion_jobs.sqlite"))
+os.environ.setdefault("CONTENT_CACHE_DIR", os.path.join(_workdir, "content_cache"))
+
+from services.ingestion_jobs import IngestionJobs
+
+
+@pytest.fixture
+def workers(tmp_path):
+    db_path = str(tmp_path / "jobs.sqlite")
+    first, second = IngestionJobs(db_path, lease_seconds=60), IngestionJobs(db_path, lease_seconds=60)
+    first._execute("INSERT INTO ingestion_jobs VALUES ('job', 'user', 'report', ?)", (time.time(),))
+    first._execute(
+        """INSERT INTO ingestion_job_files (job_id, file_name, file_path, file_id, status, updated_at)
+        VALUES ('job', 'a.pdf', '/tmp/a.pdf', 'file-a', 'queued', ?)""",
+        (time.time(),),
+    )
+    return first, second
+
+
+def test_a_file_is_claimed_by_one_process(workers):
+    first, second = workers
+    assert first._claim_file("job", "a.pdf")
+    assert not second._claim_file("job", "a.pdf")
+
+
+def test_a_file_with_an_expired_lease_is_taken_over(workers):
+    first, second = workers
+    assert first._claim_file("job", "a.pdf")
+    first._execute("UPDATE ingestion_job_files SET lease_until = ?", (time.time() - 1,))
+    assert second._claim_file("job", "a.pdf")
+    owner = second._execute("SELECT owner FROM ingestion_job_files")[0]["owner"]
+    assert owner == second.owner != first.owner
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("langchain_postgres")
+pytest.importorskip("psycopg")
+
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from benchmarks.fakes import FakeEmbeddings
+from langchain_postgres.vectorstores import _get_embedding_collection_store
+from services.vectorDB import SherlockPGVector
+
+
+@pytest.fixture
+def store():
+    # An async store does not connect until its first query
+    engine = create_async_engine("postgresql+psycopg://user@localhost:5432/unused")
+    vector_store = SherlockPGVector(
+        embeddings=FakeEmbeddings(dimensions=4, latency=0, latency_per_input=0),
+        collection_name="unused",
+        connection=engine,
+        use_jsonb=True,
+        async_mode=True,
+    )
+    # The ORM classes the lazy async init would set up on first use
+    vector_store.EmbeddingStore, vector_store.CollectionStore = _get_embedding_collection_store()
+    return vector_store
+
+
+def compiled(clause) -> str:
+    return str(clause.compile(dialect=postgresql.dialect()))
+
+
+def test_tenant_filter_compiles_to_indexable_equality(store):
+    sql = compiled(store._create_filter_clause({"user_id": "user-1", "doc_type": "report"}))
+    assert "->>" in sql
+    assert "jsonb_path_match" not in sql
+
+
+def test_operator_filters_keep_pgvector_semantics(store):
+    sql = compiled(store._create_filter_clause({"page": {"$gt": 3}}))
+    assert "jsonb_path_match" in sql